@@ -3,9 +3,82 @@ import string
 import subprocess
 import sys
 import signal
+import os
+import json
+import heapq
+import hashlib
+import logging
+from collections import deque
 
+import config
+
+# For the parse trees and fuzzingbook's parser, the grammar analyses below are iterative.
 sys.setrecursionlimit(10000) 
 
+# Logging: every module has its own logger, so it can be switched on and off separately.
+# Pass the arguments of a message separately, log.debug("x: %s", x), so that the message is
+# only formatted when it is output.
+# STALAGMITE_LOG overrides the levels in config.py, e.g.
+#   STALAGMITE_LOG=quiet                          no output at all
+#   STALAGMITE_LOG=DEBUG                          everything
+#   STALAGMITE_LOG=WARNING,traces_to_grammar=INFO one module more verbose than the rest
+_logging_is_setup = False
+def _is_level(name) -> bool:
+    return isinstance(logging.getLevelName(name), int)
+
+def setup_logging(quiet: bool = False):
+    global _logging_is_setup
+    if quiet:
+        logging.disable(logging.CRITICAL) # checked before anything is formatted
+    if _logging_is_setup:
+        return
+    _logging_is_setup = True
+
+    level = config.log_level
+    levels = dict(config.log_levels)
+    quiet = quiet or config.log_quiet
+    invalid = [] # entries with an unknown level are ignored, with a warning below
+    for part in os.environ.get("STALAGMITE_LOG", "").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if part.lower() == "quiet":
+            quiet = True
+        elif "=" in part:
+            name, name_level = part.split("=", 1)
+            if _is_level(name_level.strip().upper()):
+                levels[name.strip()] = name_level.strip().upper()
+            else:
+                invalid.append(part)
+        elif _is_level(part.upper()):
+            level = part.upper()
+        else:
+            invalid.append(part)
+    if not _is_level(level):
+        invalid.append(f"config.log_level={level}")
+        level = "INFO"
+    for name, name_level in list(levels.items()):
+        if not _is_level(name_level):
+            invalid.append(f"{name}={name_level}")
+            del levels[name]
+
+    handler = logging.StreamHandler(sys.stdout) # the output used to be print()s
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(level)
+    for name, name_level in levels.items():
+        logging.getLogger(name).setLevel(name_level)
+    if invalid:
+        logging.getLogger("common").warning("Ignoring unknown log levels: %s", ", ".join(invalid))
+    if quiet:
+        logging.disable(logging.CRITICAL)
+
+def get_logger(name: str) -> logging.Logger:
+    # name: the module name (not __name__, which is "__main__" for scripts)
+    setup_logging()
+    return logging.getLogger(name)
+
 def is_nt(v):
     return len(v) > 2 and (v[0], v[-1]) == ('<', '>')
 
@@ -16,6 +89,271 @@ def tree_to_str(tree):
     else:
         return '' if is_nt(symbol) else symbol
     
+class CompactGrammar:
+    """A grammar with its symbols interned to ints. The code of a symbol is its index in
+    symbols shifted left by one, with the lowest bit (NT) set if the symbol is_nt, so tokens
+    need no string tests. The rules of all nonterminals are tuples of codes in one flat
+    table; those of a nonterminal are rules[start:end], (start, end) = spans[code].
+    to_dict gives back the usual form (nt => list of rules), in the same order."""
+    NT = 1
+
+    def __init__(self, grammar: dict = None):
+        self.symbols = [] # symbol index => str
+        self.codes = {} # str => code
+        self.rules = [] # rule id => tuple of codes
+        self.spans = {} # code of a defined nt => (start, end) of its rule ids, in grammar order
+        self.str_rules = set() # ids of the rules given as a str (of one-char tokens), see to_dict
+        if grammar:
+            for nt, rules in grammar.items():
+                self.define(nt, rules)
+
+    def code(self, symbol: str) -> int:
+        code = self.codes.get(symbol)
+        if code is None:
+            code = self.codes[symbol] = len(self.symbols) << 1 | (CompactGrammar.NT if is_nt(symbol) else 0)
+            self.symbols.append(symbol)
+        return code
+
+    def name(self, code: int) -> str:
+        return self.symbols[code >> 1]
+
+    def define(self, nt: str, rules: list):
+        code = self.code(nt)
+        assert code not in self.spans, f"{nt} is already defined"
+        start = len(self.rules)
+        codes = self.codes
+        for rule in rules:
+            if isinstance(rule, str): self.str_rules.add(len(self.rules))
+            self.rules.append(tuple([codes[tok] if tok in codes else self.code(tok) for tok in rule]))
+        self.spans[code] = (start, len(self.rules))
+
+    def __contains__(self, code: int):
+        return code in self.spans
+
+    def rule_ids(self, code: int) -> range:
+        return range(*self.spans[code])
+
+    def alternatives(self, code: int) -> list:
+        start, end = self.spans[code]
+        return self.rules[start:end]
+
+    def to_dict(self) -> dict:
+        return {self.name(code): [self.rule_to_list(i) for i in self.rule_ids(code)] for code in self.spans}
+
+    def rule_to_list(self, rule_id: int):
+        symbols = self.symbols
+        rule = [symbols[tok >> 1] for tok in self.rules[rule_id]]
+        return ''.join(rule) if rule_id in self.str_rules else rule
+
+class GrammarAnalysis:
+    """Reachability, productivity, nullability, strongly connected components and minimal
+    derivation costs of one grammar. All are computed iteratively (no recursion limit) and
+    only when first asked for. Symbols that are not keys of the grammar count as terminals.
+
+    The analysis works on its own copy of the grammar. set_rules changes the rules of one
+    nonterminal and only invalidates what depends on them: the costs and nullability of the
+    nonterminals that can reach it, and the reachable sets that contain it."""
+    def __init__(self, grammar: dict):
+        self.grammar = {} # nt => list of rules (tuples)
+        self.refs = {} # nt => set of nts with a rule that refers to nt
+        self.fingerprint = None # set by analyze
+        self.reachable_sets = {} # start => frozenset of the nts reachable from start
+        self.costs = None # nt => minimal cost (inf if unproductive)
+        self.nullables = None # set of nts that derive the empty string
+        self.components = None # list of SCCs, see sccs
+        for nt, rules in grammar.items():
+            self._set_rules(nt, rules)
+
+    def _set_rules(self, nt, rules):
+        for rule in self.grammar.get(nt, ()):
+            for tok in rule:
+                if is_nt(tok): self.refs[tok].discard(nt)
+        self.grammar[nt] = [tuple(rule) for rule in rules]
+        for rule in self.grammar[nt]:
+            for tok in rule:
+                if is_nt(tok): self.refs.setdefault(tok, set()).add(nt)
+
+    def set_rules(self, nt, rules: list):
+        affected = self.ancestors(nt)
+        self._set_rules(nt, rules)
+        if self.fingerprint is not None:
+            # The rules do not match the fingerprint any more
+            _analyses.pop(self.fingerprint, None)
+            self.fingerprint = None
+        self.reachable_sets = {start: nts for start, nts in self.reachable_sets.items() if nt not in nts}
+        if self.costs is not None:
+            for other in affected: del self.costs[other]
+            self._compute_costs(affected | {nt})
+        if self.nullables is not None:
+            self.nullables -= affected
+            self._compute_nullables(affected | {nt})
+        self.components = None
+
+    def ancestors(self, nt) -> set:
+        # nt and the nts that can reach it
+        found = {nt}
+        work = [nt]
+        while work:
+            for ref_nt in self.refs.get(work.pop(), ()):
+                if ref_nt not in found:
+                    found.add(ref_nt)
+                    work.append(ref_nt)
+        return found & self.grammar.keys()
+
+    def reachable(self, start) -> frozenset:
+        # start and the nts reachable from it (including undefined ones)
+        nts = self.reachable_sets.get(start)
+        if nts is None:
+            found = {start}
+            work = [start]
+            while work:
+                for rule in self.grammar.get(work.pop(), ()):
+                    for tok in rule:
+                        if is_nt(tok) and tok not in found:
+                            found.add(tok)
+                            work.append(tok)
+            nts = self.reachable_sets[start] = frozenset(found)
+        return nts
+
+    def cost(self, nt) -> float:
+        # The minimal depth of a derivation tree of nt, as in LimitFuzzer
+        if self.costs is None:
+            self.costs = {}
+            self._compute_costs(self.grammar.keys())
+        return self.costs[nt]
+
+    def rule_cost(self, rule) -> float:
+        cost = 0
+        for tok in rule:
+            if tok in self.grammar:
+                cost = max(cost, self.cost(tok))
+        return cost + 1
+
+    def productive(self, nt) -> bool:
+        return self.cost(nt) != float('inf')
+
+    def _compute_costs(self, nts):
+        # Knuth's generalization of Dijkstra: the costs of nts are final in the order they
+        # are popped, so a rule is done once the last of its nts in nts is popped.
+        waiting = {} # nt => [[number of distinct nts in nts still to pop, cost so far, nt of the rule]]
+        heap = []
+        for nt in nts:
+            ready = float('inf') # the cheapest rule without nts in nts
+            for rule in self.grammar[nt]:
+                pending = set()
+                known = 0
+                for tok in rule:
+                    if tok in nts:
+                        pending.add(tok)
+                    elif tok in self.grammar:
+                        known = max(known, self.costs[tok])
+                if not pending:
+                    ready = min(ready, known + 1)
+                    continue
+                entry = [len(pending), known, nt]
+                for tok in pending:
+                    waiting.setdefault(tok, []).append(entry)
+            if ready != float('inf'):
+                heapq.heappush(heap, (ready, nt))
+        while heap:
+            cost, nt = heapq.heappop(heap)
+            if nt in self.costs: continue
+            self.costs[nt] = cost
+            for entry in waiting.pop(nt, ()):
+                entry[0] -= 1
+                if entry[0] == 0:
+                    heapq.heappush(heap, (max(entry[1], cost) + 1, entry[2]))
+        for nt in nts:
+            self.costs.setdefault(nt, float('inf'))
+
+    def nullable(self, nt) -> bool:
+        if self.nullables is None:
+            self.nullables = set()
+            self._compute_nullables(self.grammar.keys())
+        return nt in self.nullables
+
+    def _compute_nullables(self, nts):
+        waiting = {} # nt => [[number of distinct nts still to become nullable, nt of the rule]]
+        work = []
+        for nt in nts:
+            for rule in self.grammar[nt]:
+                if any(tok != '' and tok not in self.grammar for tok in rule): continue
+                pending = {tok for tok in rule if tok in nts}
+                if any(tok not in nts and tok in self.grammar and tok not in self.nullables for tok in rule): continue
+                if not pending:
+                    work.append(nt)
+                    continue
+                entry = [len(pending), nt]
+                for tok in pending:
+                    waiting.setdefault(tok, []).append(entry)
+        while work:
+            nt = work.pop()
+            if nt in self.nullables: continue
+            self.nullables.add(nt)
+            for entry in waiting.pop(nt, ()):
+                entry[0] -= 1
+                if entry[0] == 0:
+                    work.append(entry[1])
+
+    def sccs(self) -> list:
+        # The strongly connected components (lists of nts), each after all the components it
+        # refers to (iterative Tarjan)
+        if self.components is None:
+            self.components = []
+            order = {} # nt => DFS number
+            low = {}
+            stack = [] # nts of the open components
+            on_stack = set()
+            for root in self.grammar:
+                if root in order: continue
+                work = [(root, None)]
+                while work:
+                    nt, it = work[-1]
+                    if it is None:
+                        order[nt] = low[nt] = len(order)
+                        stack.append(nt)
+                        on_stack.add(nt)
+                        it = iter(tok for rule in self.grammar[nt] for tok in rule if tok in self.grammar)
+                        work[-1] = (nt, it)
+                    for tok in it:
+                        if tok not in order:
+                            work.append((tok, None))
+                            break
+                        if tok in on_stack:
+                            low[nt] = min(low[nt], order[tok])
+                    else:
+                        work.pop()
+                        if work:
+                            parent = work[-1][0]
+                            low[parent] = min(low[parent], low[nt])
+                        if low[nt] == order[nt]:
+                            component = []
+                            while True:
+                                member = stack.pop()
+                                on_stack.discard(member)
+                                component.append(member)
+                                if member == nt: break
+                            self.components.append(component)
+        return self.components
+
+def grammar_fingerprint(grammar: dict) -> str:
+    return hashlib.blake2b(json.dumps(grammar).encode('utf-8'), digest_size=16).hexdigest()
+
+ANALYSIS_CACHE_SIZE = 4 # grammars
+_analyses = {} # fingerprint => GrammarAnalysis, least recently used first
+def analyze(grammar: dict) -> GrammarAnalysis:
+    """The GrammarAnalysis of grammar, shared by all callers with an equal grammar.
+    Use GrammarAnalysis directly for an analysis to change with set_rules."""
+    fingerprint = grammar_fingerprint(grammar)
+    analysis = _analyses.pop(fingerprint, None)
+    if analysis is None:
+        analysis = GrammarAnalysis(grammar)
+        analysis.fingerprint = fingerprint
+        while len(_analyses) >= ANALYSIS_CACHE_SIZE:
+            _analyses.pop(next(iter(_analyses))).fingerprint = None
+    _analyses[fingerprint] = analysis
+    return analysis
+
 # From Mimid; not used by STALAGMITE.
 ASCII_MAP = {
         '[__WHITESPACE__]': string.whitespace,
@@ -38,54 +376,40 @@ class Fuzzer:
 FUZZRANGE = 10
 
 class LimitFuzzer(Fuzzer):
-    def symbol_cost(self, grammar, symbol, seen):
-        if symbol in self.key_cost: return self.key_cost[symbol]
-        if symbol in seen:
-            self.key_cost[symbol] = float('inf')
-            return float('inf')
-        v = min((self.expansion_cost(grammar, rule, seen | {symbol})
-                    for rule in grammar.get(symbol, [])), default=0)
-        self.key_cost[symbol] = v
-        return v
-
-    def expansion_cost(self, grammar, tokens, seen):
-        return max((self.symbol_cost(grammar, token, seen)
-                    for token in tokens if token in grammar), default=0) + 1
-
     def nonterminals(self, rule):
         return [t for t in rule if is_nt(t)]
 
     def iter_gen_key(self, key, max_depth, first_choice = None):
-        def get_def(t):
-            if t in ASCII_MAP:
-                return [random.choice(ASCII_MAP[t]), []]
-            elif t and t[-1] == '+' and t[0:-1] in ASCII_MAP:
+        compact = self.compact
+        symbols = compact.symbols
+        def get_def(code):
+            if code in self.ascii_chars:
+                return [random.choice(self.ascii_chars[code]), []]
+            elif code in self.ascii_plus_chars:
                 num = random.randrange(FUZZRANGE) + 1
-                val = [random.choice(ASCII_MAP[t[0:-1]]) for i in range(num)]
+                chars = self.ascii_plus_chars[code]
+                val = [random.choice(chars) for i in range(num)]
                 return [''.join(val), []]
-            elif is_nt(t):
-                return [t, None]
+            elif code & CompactGrammar.NT:
+                return [symbols[code >> 1], None]
             else:
-                return [t, []]
+                return [symbols[code >> 1], []]
 
         root = [key, None]
-        queue = [(0, root)]
+        queue = deque([(0, compact.codes[key], root)]) # only the nts still to expand
         while queue:
-            # get one item to expand from the queue
-            (depth, item), *queue = queue
-            key = item[0]
-            if item[1] is not None: continue
-            grammar = self.grammar if depth < max_depth else self.cheap_grammar
+            depth, code, item = queue.popleft()
+            rule_ids = self.all_rules[code] if depth < max_depth else self.cheap_rules[code]
             if first_choice is not None:
-                chosen_rule = grammar[key][first_choice]
+                chosen_rule = rule_ids[first_choice]
                 first_choice = None
             else:
-                chosen_rule = random.choice(grammar[key])
-            expansion = [get_def(t) for t in chosen_rule]
+                chosen_rule = random.choice(rule_ids)
+            rule = compact.rules[chosen_rule]
+            expansion = [get_def(t) for t in rule]
             item[1] = expansion
-            for t in expansion: queue.append((depth+1, t))
-            #print("Fuzz: %s" % key, len(queue), file=sys.stderr)
-        #print(file=sys.stderr)
+            for t, child in zip(rule, expansion):
+                if child[1] is None: queue.append((depth+1, t, child))
         return root
 
     def gen_key(self, key, depth, max_depth):
@@ -97,7 +421,8 @@ class LimitFuzzer(Fuzzer):
         if key not in self.grammar: return (key, [])
         if depth > max_depth:
             #return self.gen_key_cheap_iter(key)
-            clst = sorted([(self.cost[key][str(rule)], rule) for rule in self.grammar[key]])
+            rule_ids = self.compact.rule_ids(self.compact.codes[key])
+            clst = sorted([(self.rule_costs[i], rule) for i, rule in zip(rule_ids, self.grammar[key])])
             rules = [r for c,r in clst if c == clst[0][0]]
         else:
             rules = self.grammar[key]
@@ -113,23 +438,37 @@ class LimitFuzzer(Fuzzer):
 
     def __init__(self, grammar):
         super().__init__(grammar)
-        self.key_cost = {}
-        self.cost = self.compute_cost(grammar)
+        self.compact = CompactGrammar(grammar)
+        # The random characters of the ASCII_MAP symbols, see iter_gen_key
+        self.ascii_chars = {}
+        self.ascii_plus_chars = {}
+        for symbol, code in self.compact.codes.items():
+            if symbol in ASCII_MAP:
+                self.ascii_chars[code] = ASCII_MAP[symbol]
+            elif symbol and symbol[-1] == '+' and symbol[0:-1] in ASCII_MAP:
+                self.ascii_plus_chars[code] = ASCII_MAP[symbol[0:-1]]
+        self.rule_costs = self.compute_cost(grammar)
+        self.all_rules = {} # code of nt => ids of its rules
+        self.cheap_rules = {} # code of nt => ids of its cheapest rules
         self.cheap_grammar = {}
-        for k in self.cost:
-            rules = self.grammar[k]
-            min_cost = min([self.cost[k][str(r)] for r in rules])
-            self.cheap_grammar[k] = [r for r in self.grammar[k] if self.cost[k][str(r)] == min_cost]
+        for k, code in zip(self.grammar, self.compact.spans):
+            rule_ids = self.all_rules[code] = self.compact.rule_ids(code)
+            min_cost = min([self.rule_costs[i] for i in rule_ids])
+            self.cheap_rules[code] = [i for i in rule_ids if self.rule_costs[i] == min_cost]
+            self.cheap_grammar[k] = [r for i, r in zip(rule_ids, self.grammar[k]) if self.rule_costs[i] == min_cost]
 
     def compute_cost(self, grammar):
-        cost = {}
-        for k in grammar:
-            cost[k] = {}
-            for rule in grammar[k]:
-                cost[k][str(rule)] = self.expansion_cost(grammar, rule, set())
-            if len(grammar[k]):
-                assert len([v for v in cost[k] if v != float('inf')]) > 0
-        return cost
+        # The minimal depth of a derivation tree starting with each rule (by rule id of self.compact)
+        analysis = analyze(grammar)
+        nt_costs = {code: analysis.cost(self.compact.name(code)) for code in self.compact.spans}
+        rule_costs = []
+        for rule in self.compact.rules:
+            cost = 0
+            for tok in rule:
+                if tok in nt_costs:
+                    cost = max(cost, nt_costs[tok])
+            rule_costs.append(cost + 1)
+        return rule_costs
     
         
 def put_can_parse(put, inp):
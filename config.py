@@ -35,4 +35,15 @@ max_refinement_time_seconds = 60*60 # 1 hour
 k_shortest = 100
 cnt_inputs_refinement = cnt_inputs
 min_count_valid = 1
-k_subtrees =  10
\ No newline at end of file
+k_subtrees =  10
+
+###############################################
+################### Logging ###################
+###############################################
+
+# Level of all loggers (see common.get_logger), and levels of single modules
+# on top of it, e.g. {"traces_to_grammar": "DEBUG"}.
+# The environment variable STALAGMITE_LOG overrides both, see common.setup_logging.
+log_level = "INFO"
+log_levels = {}
+log_quiet = False # no log output at all (and no formatting of log messages)
@@ -11,6 +11,7 @@ from precision import compute_precision, get_valid_inputs, run_inputs
 from recall import compute_recall
 from readability import get_grammar_stats
 from subject import Subject
+from common import setup_logging
 
 import config
 
@@ -25,15 +26,19 @@ def epilogue(old_wd, old_path):
     os.chdir(old_wd)
     sys.path = old_path
 
-def mine(subject: Subject):
+def mine(subject: Subject, watch: bool = False):
     old_wd, old_path = prologue(subject)
 
     print('[-] Cleaning')
     os.system("make clean")
     os.system("make")
     os.system("echo event,seconds,formatted > timestamps")
-    os.system("make mine")
-    os.system("make convert-simplify-coarse")
+    if watch:
+        # converts the traces while klee is still running, see mine-watch-% in common.mk
+        os.system("make mine-watch-simplify-coarse")
+    else:
+        os.system("make mine")
+        os.system("make convert-simplify-coarse")
     assert os.path.exists("initial_grammar.json"), "initial grammar mining failed"
     os.system(f"cp initial_grammar.json {subject.initial_grammar}")
     if os.path.exists("tokengrammar.json"):
@@ -163,17 +168,22 @@ def main():
     group.add_argument('--refine', action='store_true',help='reduces overapproximation. requirement: grammars were already mined via --mine')
     group.add_argument('--data', action='store_true', help='generates precision/recall table + readability table. requirement: (refined) grammars were already mined via --refine')
     group.add_argument('--all', action='store_true', help="mine+refine+data")
+    parser.add_argument('--quiet', action='store_true', help='no log output from mining, refinement and evaluation (sets STALAGMITE_LOG=quiet, see common.setup_logging)')
+    parser.add_argument('--watch', action='store_true', help='with --mine: convert traces to a grammar while klee is still running, writing grammar snapshots along the way')
 
     args = parser.parse_args()
     if args.all:
         args.mine = args.refine = args.data = True
+    if args.quiet:
+        os.environ["STALAGMITE_LOG"] = "quiet" # also for the make targets
+        setup_logging(quiet=True)
 
     assert os.path.exists(os.path.join(config.root, f'subjects/{args.subject}')), "subject does not exist"
     subject = Subject(args.subject)
     print("Processing subject=", subject.subject)
 
     if args.mine:
-        mine(subject)
+        mine(subject, args.watch)
     if args.refine :
         refine(subject)
     if args.data:
@@ -5,7 +5,9 @@ import signal
 import json
 import argparse
 import subprocess
-from common import LimitFuzzer, put_can_parse
+from common import LimitFuzzer, put_can_parse, get_logger
+
+log = get_logger("precision")
 
 class TimeoutException(Exception):
     pass
@@ -24,7 +26,7 @@ def _compute_precision(put, grammar, max_depth: int, count: int):
         try:
             inp, _ = fuzzer.fuzz("<start>", max_depth=max_depth)
         except TimeoutException:
-            print('Timeout in _compute_precision')
+            log.info("Timeout in _compute_precision")
             continue
         finally:
             signal.alarm(0)
@@ -40,12 +42,12 @@ def _compute_precision(put, grammar, max_depth: int, count: int):
                     continue
                 case _:
                     assert False, "unmatched"
-            print(f"Inp ({len(inputs)}/{count} {repr(inp)} is valid=", parsed)
+            log.debug("Inp (%d/%d %r is valid=%s", len(inputs), count, inp, parsed)
             inputs.add(inp)
 
-    print("invalid: ", invalid)
-    print("valid: ", valid)
-    print(f"Precision ({len(valid)}/{len(valid)+len(invalid)})")
+    log.debug("invalid: %s", invalid)
+    log.debug("valid: %s", valid)
+    log.info("Precision (%d/%d)", len(valid), len(valid)+len(invalid))
     precision = len(valid)/(len(valid)+len(invalid))
     assert count == len(valid)+len(invalid)
     return precision, valid
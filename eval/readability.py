@@ -1,6 +1,8 @@
 import sys
 import json
 
+from common import analyze
+
 # inspired by: https://rahul.gopinath.org/post/2021/09/09/fault-inducing-grammar/
 
 debug = False
@@ -14,30 +16,16 @@ def display_definition(grammar, key, r, rule_lengths):
         rule_lengths.append(len(rule))
     return r, rule_lengths
 
-def recurse_grammar(grammar, key, order, undefined=None):
-    undefined = undefined or {}
-    rules = sorted(grammar[key])
-    old_len = len(order)
-    for rule in rules:
-        for token in rule:
-            if not is_nt(token): continue
-            if token not in grammar:
-                if token in undefined:
-                    undefined[token].append(key)
-                else:
-                    undefined[token] = [key]
-                continue
-            if token not in order:
-                order.append(token)
-    new = order[old_len:]
-    for ckey in new:
-        recurse_grammar(grammar, ckey, order, undefined)
-    return undefined
-
 def sort_grammar(grammar, start_symbol):
-    order = [start_symbol]
-    undefined = recurse_grammar(grammar, start_symbol, order)
-    return order, [k for k in grammar if k not in order], undefined
+    reachable = analyze(grammar).reachable(start_symbol)
+    order = [start_symbol] + [k for k in grammar if k in reachable and k != start_symbol]
+    undefined = {}
+    for key in order:
+        for rule in grammar[key]:
+            for token in rule:
+                if is_nt(token) and token not in grammar:
+                    undefined.setdefault(token, []).append(key)
+    return order, [k for k in grammar if k not in reachable], undefined
 
 def get_grammar_stats(grammar, start, tokens, verbose=0) -> tuple[int, int]:
     count_keys = 0
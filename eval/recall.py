@@ -5,10 +5,12 @@ import json
 import argparse
 import fuzzingbook.Parser as P
 import signal
-from common import LimitFuzzer, put_can_parse, tree_to_str
+from common import LimitFuzzer, put_can_parse, tree_to_str, get_logger
+
+log = get_logger("recall")
 
 def timeout_handler(signum, frame):
-    print("Timeout reached! Operation took too long.")
+    log.warning("Timeout reached! Operation took too long.")
     raise TimeoutError("Operation timed out")
 
 def compute_recall(put, goldengrammar, minedgrammar, max_depth: int, count: int) -> float:
@@ -16,32 +18,32 @@ def compute_recall(put, goldengrammar, minedgrammar, max_depth: int, count: int)
     inputs = set()
     while len(inputs) < count:
         inp, _ = f.fuzz('<start>', max_depth=max_depth)
-        print("recall -- generated inp: ", inp)
+        log.debug("recall -- generated inp: %s", inp)
         if inp not in inputs:
             if put_can_parse(put, inp) == True:
                 inputs.add(inp)
-                print("inputs: ", len(inputs))
+                log.debug("inputs: %d", len(inputs))
 
     parser = P.IterativeEarleyParser(P.non_canonical(minedgrammar), start_symbol='<start>')
     valid = []
     invalid = []
     for inp in inputs:
         try:
-            print("trying to parse: ", repr(inp), flush=True)
+            log.debug("trying to parse: %r", inp)
             #signal.alarm(3) # 3 seconds
             result = parser.parse(inp)
             parsed = False
             for tree in result:
                 s = tree_to_str(tree)
                 if s == inp:
-                    print("parsed=True")
+                    log.debug("parsed=True")
                     parsed = True
                     break
                 else:
-                    print('Invalid match %s' % repr(inp))
+                    log.debug("Invalid match %r", inp)
             #signal.alarm(0)
         except SyntaxError:
-            print('Can not parse - syntax %s' % repr(inp))
+            log.debug("Can not parse - syntax %r", inp)
         #except TimeoutError:
         #    print('timeout, skip parsing of: ', inp)
   
@@ -50,9 +52,9 @@ def compute_recall(put, goldengrammar, minedgrammar, max_depth: int, count: int)
         else:
             invalid.append(inp)
 
-    print("invalid: ", invalid)
-    print("valid: ", valid)
-    print(f"Recall ({len(valid)}/{len(valid)+len(invalid)})")
+    log.debug("invalid: %s", invalid)
+    log.debug("valid: %s", valid)
+    log.info("Recall (%d/%d)", len(valid), len(valid)+len(invalid))
     recall = len(valid)/(len(valid)+len(invalid))
     return recall
 
@@ -1,4 +1,4 @@
-.PHONY: output-variables all orig symex combined.bc pre-mine mine clean clean-all clean-grammars clean-logs precision recall convert-% convert-simplify-%
+.PHONY: output-variables all orig symex combined.bc pre-mine mine clean clean-all clean-grammars clean-logs precision recall pack-traces convert-% convert-simplify-% mine-watch-% mine-watch-simplify-%
 
 SHELL := /bin/bash
 GCC := gcc
@@ -21,6 +21,23 @@ SWITCH_TYPE ?= simple
 SEARCH_STRATEGY ?= bfs
 SCC ?=
 KLEEFLAGS ?=
+JOBS ?= 1
+# Trace directory or trace archive (see pack-traces)
+TRACES ?= reads/
+TRACE_ARCHIVE ?= reads.tracepack
+# Set to a file (e.g. CHECKPOINT=grammar.checkpoint) to only merge traces that are new since the last convert
+CHECKPOINT ?=
+# Set to N to merge traces in shuffled order until the grammar has not grown for N traces (see saturation.csv)
+SATURATE ?=
+# Set to a directory (e.g. TOKEN_CACHE=../.token-cache) to reuse token generalizations across runs and subjects
+TOKEN_CACHE ?=
+TOKEN_CACHE_SIZE ?= 256
+
+# Window sizes for ctx=window (convert-window) and ctx=all (convert-all, one grammar per ctx)
+WINDOW_SIZES ?= 5
+
+# Seconds between two grammar snapshots (snapshots/) in mine-watch-%
+SNAPSHOT_INTERVAL ?= 600
 
 # Quick check precision / recall
 GRAMMARFILE ?= initial_grammar.json
@@ -60,6 +77,24 @@ TOKEN_CURSOR_FLAG :=
 TOKEN_GRAMMAR_FILE :=
 endif
 
+ifneq ($(CHECKPOINT),)
+CHECKPOINT_FLAG := --checkpoint=$(CHECKPOINT)
+else
+CHECKPOINT_FLAG :=
+endif
+
+ifneq ($(SATURATE),)
+SATURATE_FLAG := --saturate=$(SATURATE)
+else
+SATURATE_FLAG :=
+endif
+
+ifneq ($(TOKEN_CACHE),)
+TOKEN_CACHE_FLAG := --token-cache=$(TOKEN_CACHE) --token-cache-size=$(TOKEN_CACHE_SIZE)
+else
+TOKEN_CACHE_FLAG :=
+endif
+
 output-commit-hashes:
 	echo "NOTFOUND" > klee_commit_hash
 	echo "NOTFOUND" > klee_examples_commit_hash
@@ -73,11 +108,33 @@ output-variables:
 			$(filter-out $(VARS_OLD) VARS_OLD,$(.VARIABLES)), \
 			echo '$(v) = $($(v))'; ) ) >  makefile.variables
 
+KLEE_PARSER_SYMEX = klee $(KLEEFLAGS) --switch-type=$(SWITCH_TYPE) --output-module --libc=uclibc --posix-runtime --recursion-limit=$(RECURSION_LIMIT) --loop-limit=$(LOOP_LIMIT) --deep-input-access-tracking=$(DEEP_INPUT_ACCESS_TRACKING) --only-limit-syntax-loops=$(ONLY_LIMIT_SYNTAX_LOOPS) --only-output-states-covering-new --search=$(SEARCH_STRATEGY) --is-token-cursor=$(TOKEN_CURSOR) --max-time=$(MAX_TIME) --max-memory=$(MAX_MEMORY) --entry-point=kw_ep combined.bc $(MAX_LEN)
+
 mine: output-commit-hashes output-variables pre-mine
 	echo "start_parser_symex,$$(date +%s),$$(date +"%Y-%m-%d %H:%M:%S")" >> timestamps
-	klee $(KLEEFLAGS) --switch-type=$(SWITCH_TYPE) --output-module --libc=uclibc --posix-runtime --recursion-limit=$(RECURSION_LIMIT) --loop-limit=$(LOOP_LIMIT) --deep-input-access-tracking=$(DEEP_INPUT_ACCESS_TRACKING) --only-limit-syntax-loops=$(ONLY_LIMIT_SYNTAX_LOOPS) --only-output-states-covering-new --search=$(SEARCH_STRATEGY) --is-token-cursor=$(TOKEN_CURSOR) --max-time=$(MAX_TIME) --max-memory=$(MAX_MEMORY) --entry-point=kw_ep combined.bc $(MAX_LEN)
+	$(KLEE_PARSER_SYMEX)
 	echo "end_parser_symex,$$(date +%s),$$(date +"%Y-%m-%d %H:%M:%S")" >> timestamps
 
+# mine + convert-%, but the traces are converted while klee is still running.
+# traces_to_grammar.py --watch stops once end_parser_symex follows the last start_parser_symex in timestamps.
+mine-watch-%: output-commit-hashes output-variables pre-mine
+	echo "start_parser_symex,$$(date +%s),$$(date +"%Y-%m-%d %H:%M:%S")" >> timestamps
+	echo "start_traces_to_grammar,$$(date +%s),$$(date +"%Y-%m-%d %H:%M:%S")" >> timestamps
+	python3 ../../system_level_grammar/traces_to_grammar.py reads/ --batch --watch --snapshot-interval=$(SNAPSHOT_INTERVAL) --jobs=$(JOBS) --ctx-$* --window-sizes $(WINDOW_SIZES) $(SCC) $(TOKEN_CURSOR_FLAG) $(TOKEN_GRAMMAR_FILE) $(CHECKPOINT_FLAG) $(TOKEN_CACHE_FLAG) & watcher=$$!; \
+	$(KLEE_PARSER_SYMEX); \
+	echo "end_parser_symex,$$(date +%s),$$(date +"%Y-%m-%d %H:%M:%S")" >> timestamps; \
+	wait $$watcher
+	echo "end_traces_to_grammar,$$(date +%s),$$(date +"%Y-%m-%d %H:%M:%S")" >> timestamps
+
+mine-watch-simplify-%: output-commit-hashes output-variables pre-mine
+	echo "start_parser_symex,$$(date +%s),$$(date +"%Y-%m-%d %H:%M:%S")" >> timestamps
+	echo "start_traces_to_grammar,$$(date +%s),$$(date +"%Y-%m-%d %H:%M:%S")" >> timestamps
+	python3 ../../system_level_grammar/traces_to_grammar.py reads/ --batch --watch --snapshot-interval=$(SNAPSHOT_INTERVAL) --jobs=$(JOBS) --simplify --ctx-$* --window-sizes $(WINDOW_SIZES) $(SCC) $(TOKEN_CURSOR_FLAG) $(TOKEN_GRAMMAR_FILE) $(CHECKPOINT_FLAG) $(TOKEN_CACHE_FLAG) & watcher=$$!; \
+	$(KLEE_PARSER_SYMEX); \
+	echo "end_parser_symex,$$(date +%s),$$(date +"%Y-%m-%d %H:%M:%S")" >> timestamps; \
+	wait $$watcher
+	echo "end_traces_to_grammar,$$(date +%s),$$(date +"%Y-%m-%d %H:%M:%S")" >> timestamps
+
 tokens-jsons:
 	echo "start_token_mining,$$(date +%s),$$(date +"%Y-%m-%d %H:%M:%S")" >> timestamps
 	rm -rf reads-letters/ reads-digits/ reads-punctuation/ reads-none/
@@ -90,7 +147,7 @@ tokens-jsons:
 
 tokens: tokens-jsons
 	echo "start_token_generalization,$$(date +%s),$$(date +"%Y-%m-%d %H:%M:%S")" >> timestamps
-	python3 ../../system_level_grammar/mine_tokens.py
+	python3 ../../system_level_grammar/mine_tokens.py --jobs=$(JOBS) $(TOKEN_CACHE_FLAG)
 	echo "end_token_generalization,$$(date +%s),$$(date +"%Y-%m-%d %H:%M:%S")" >> timestamps
 
 precision:
@@ -99,15 +156,18 @@ precision:
 recall:
 	python3 ../../eval/recall.py --goldengrammar $(GOLDEN_GRAMMAR) --minedgrammar $(GRAMMARFILE) --count $(INPUT_COUNT) --depth $(DEPTH) --put ./a.out
 
+pack-traces:
+	python3 ../../system_level_grammar/trace_archive.py reads/ $(TRACE_ARCHIVE)
+
 convert-%:
 	echo "start_traces_to_grammar,$$(date +%s),$$(date +"%Y-%m-%d %H:%M:%S")" >> timestamps
-	time python3 ../../system_level_grammar/traces_to_grammar.py reads/ --batch --ctx-$* $(SCC) $(TOKEN_CURSOR_FLAG) $(TOKEN_GRAMMAR_FILE)
+	time python3 ../../system_level_grammar/traces_to_grammar.py $(TRACES) --batch --jobs=$(JOBS) --ctx-$* --window-sizes $(WINDOW_SIZES) $(SCC) $(TOKEN_CURSOR_FLAG) $(TOKEN_GRAMMAR_FILE) $(CHECKPOINT_FLAG) $(SATURATE_FLAG) $(TOKEN_CACHE_FLAG)
 	echo "end_traces_to_grammar,$$(date +%s),$$(date +"%Y-%m-%d %H:%M:%S")" >> timestamps
 
-# "none", "coarse", "fine" are possible
+# "none", "coarse", "fine", "window" and "all" are possible
 convert-simplify-%:
 	echo "start_traces_to_grammar,$$(date +%s),$$(date +"%Y-%m-%d %H:%M:%S")" >> timestamps
-	time python3 ../../system_level_grammar/traces_to_grammar.py reads/ --batch --simplify --ctx-$* $(SCC) $(TOKEN_CURSOR_FLAG) $(TOKEN_GRAMMAR_FILE)
+	time python3 ../../system_level_grammar/traces_to_grammar.py $(TRACES) --batch --jobs=$(JOBS) --simplify --ctx-$* --window-sizes $(WINDOW_SIZES) $(SCC) $(TOKEN_CURSOR_FLAG) $(TOKEN_GRAMMAR_FILE) $(CHECKPOINT_FLAG) $(SATURATE_FLAG) $(TOKEN_CACHE_FLAG)
 	echo "end_traces_to_grammar,$$(date +%s),$$(date +"%Y-%m-%d %H:%M:%S")" >> timestamps
 
 clean:
@@ -118,6 +178,8 @@ clean:
 
 	rm -f -r reads
 	mkdir reads
+	rm -f $(TRACE_ARCHIVE)
+	$(if $(CHECKPOINT),rm -f $(CHECKPOINT))
 
 	rm -f -r traces_last_read
 	mkdir traces_last_read
@@ -125,6 +187,8 @@ clean:
 	rm -f -r traces_ordered
 	mkdir traces_ordered
 
+	rm -f -r snapshots
+
 clean-grammars:
 	rm -f *grammar.json
 
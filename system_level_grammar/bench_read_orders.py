@@ -0,0 +1,65 @@
+import sys
+import copy
+import time
+import random
+import argparse
+
+from read_orders import repair_read_orders, repair_read_orders_naive
+
+# Benchmark for read_orders.py on synthetic traces.
+# The traces mimic a parser reading its input: mostly in order, with lookahead
+# (reading a few positions ahead and coming back), backtracking (re-reading a few
+# positions) and an occasional position that is never read.
+
+def synthetic_read_orders(length: int, rng: random.Random, lookahead=0.05, backtrack=0.02, skip=0.005, max_distance=5) -> dict:
+    inp_pos_to_orders = {}
+    order = 0
+    def read(inp_pos):
+        nonlocal order
+        inp_pos_to_orders.setdefault(inp_pos, []).append(order)
+        order += 1
+
+    inp_pos = 0
+    while inp_pos < length:
+        if inp_pos == 0 or rng.random() >= skip:
+            read(inp_pos)
+        if rng.random() < lookahead:
+            read(min(length-1, inp_pos + rng.randint(1, max_distance)))
+        if inp_pos > 0 and rng.random() < backtrack:
+            for back in range(max(0, inp_pos - rng.randint(1, max_distance)), inp_pos):
+                read(back)
+        inp_pos += 1
+    return inp_pos_to_orders
+
+def run(repair, inp_pos_to_orders, length):
+    inp_pos_to_orders = copy.deepcopy(inp_pos_to_orders)
+    start = time.perf_counter()
+    result = repair(inp_pos_to_orders, length)
+    return time.perf_counter() - start, result
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark read order repair (read_orders.py) on synthetic traces')
+    parser.add_argument('--lengths', type=int, nargs='+', default=[1000, 10000, 100000], help='Trace lengths (input positions)')
+    parser.add_argument('--naive-max', type=int, default=10000, help='Also run the naive algorithm for traces up to this length')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    print(f"{'length':>8} {'reads':>8} {'fixed':>7} {'incremental [s]':>16} {'naive [s]':>10} {'speedup':>8}")
+    for length in args.lengths:
+        rng = random.Random(args.seed)
+        inp_pos_to_orders = synthetic_read_orders(length, rng)
+        num_reads = sum(len(read_orders) for read_orders in inp_pos_to_orders.values())
+
+        t_incremental, result = run(repair_read_orders, inp_pos_to_orders, length)
+        num_fixed = len(result[2] | result[3])
+        if length <= args.naive_max:
+            t_naive, result_naive = run(repair_read_orders_naive, inp_pos_to_orders, length)
+            if result_naive != result:
+                print(f"Results differ for length {length}")
+                sys.exit(1)
+            print(f"{length:>8} {num_reads:>8} {num_fixed:>7} {t_incremental:>16.3f} {t_naive:>10.3f} {t_naive/t_incremental:>7.0f}x")
+        else:
+            print(f"{length:>8} {num_reads:>8} {num_fixed:>7} {t_incremental:>16.3f} {'-':>10} {'-':>8}")
+
+if __name__ == "__main__":
+    main()
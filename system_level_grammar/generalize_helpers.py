@@ -1,5 +1,11 @@
 import os
+import re
 import json
+import codecs
+
+from common import get_logger, analyze
+
+log = get_logger("generalize_helpers")
 
 ####### <json load helpers> ##########
 
@@ -21,13 +27,95 @@ def load_jsons(directory_path):
             json_data = load_json_file(file_path)
             d[file_path] = json_data
     
-    print(f"Loaded {len(files)} json files")
+    log.info("Loaded %d json files", len(files))
     return d
 
+_re_ws = re.compile(r'[ \t\n\r]*')
+
+class JsonStreamReader:
+    """Decodes JSON values one at a time from a binary file, starting at a byte offset.
+    Only the current value (plus one read chunk) is held in memory."""
+    def __init__(self, f, offset=0, chunk_size=1 << 16):
+        self.f = f
+        self.f.seek(offset)
+        self.chunk_size = chunk_size
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.json_decoder = json.JSONDecoder()
+        self.buf = ''
+        self.idx = 0
+        self.base = offset # byte offset of buf[0]
+        self.eof = False
+
+    def _fill(self, size) -> bool:
+        if self.eof: return False
+        data = self.f.read(size)
+        if not data: self.eof = True
+        self.buf += self.decoder.decode(data, final=self.eof)
+        return True
+
+    def _trim(self):
+        # Drop everything before idx, so the buffer does not grow with the file.
+        self.base += len(self.buf[:self.idx].encode('utf-8'))
+        self.buf = self.buf[self.idx:]
+        self.idx = 0
+
+    def offset(self):
+        return self.base + len(self.buf[:self.idx].encode('utf-8'))
+
+    def peek(self):
+        while True:
+            self.idx = _re_ws.match(self.buf, self.idx).end()
+            if self.idx < len(self.buf):
+                return self.buf[self.idx]
+            if not self._fill(self.chunk_size):
+                return None
+
+    def expect(self, c):
+        assert self.peek() == c, f"JSON stream: expected {c!r} at byte {self.offset()}"
+        self.idx += 1
+
+    def value(self):
+        self.peek()
+        self._trim()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = self.json_decoder.raw_decode(self.buf, self.idx)
+                # A number at the end of the buffer may continue in the next chunk.
+                if end < len(self.buf) or self.eof:
+                    self.idx = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof: raise
+            self._fill(size)
+            size *= 2 # amortize re-decoding of long values
+
+def iter_json_object_items(file_path, chunk_size=1 << 16):
+    """Yields (key, value, offset) for each member of the top-level JSON object in file_path,
+    in file order. offset is the byte offset of the value, see load_json_value_at."""
+    with open(file_path, 'rb') as f:
+        reader = JsonStreamReader(f, chunk_size=chunk_size)
+        reader.expect('{')
+        if reader.peek() == '}':
+            return
+        while True:
+            key = reader.value()
+            reader.expect(':')
+            reader.peek()
+            offset = reader.offset()
+            yield key, reader.value(), offset
+            if reader.peek() == '}':
+                return
+            reader.expect(',')
+
+def load_json_value_at(f, offset, chunk_size=1 << 12):
+    # f must be opened in binary mode
+    return JsonStreamReader(f, offset, chunk_size).value()
+
 def serialize_grammar(grammar, path):
     with open(path, 'w') as f:
         json.dump(grammar, f, indent=1)
-    print(f"Wrote grammar to {path}")
+    log.info("Wrote grammar to %s", path)
 
 def print_grammar(name, grammar):
     print(f"{name}:")
@@ -40,22 +128,10 @@ def is_nt(s):
     return len(s) > 2 and s[0] == '<' and s[-1] == '>'
 
 def reachable_nonterminals(grammar, start_symbol: str) -> set[str]:
-    reachable = set()
-
-    def _find_reachable_nonterminals(grammar, symbol):
-        nonlocal reachable
-        reachable.add(symbol)
-        for rule in grammar[symbol]:
-            for tok in rule:
-                if is_nt(tok):
-                    if tok not in reachable:
-                        _find_reachable_nonterminals(grammar, tok)
-
-    _find_reachable_nonterminals(grammar, start_symbol)
-    return reachable
+    return set(analyze(grammar).reachable(start_symbol))
 
 def unreachable_nonterminals(grammar, start_symbol) -> set[str]:
-    return grammar.keys() - reachable_nonterminals(grammar, start_symbol)
+    return grammar.keys() - analyze(grammar).reachable(start_symbol)
 
 def undefined_nts(grammar):
     all_nts = set()
@@ -69,34 +145,156 @@ def undefined_nts(grammar):
                     all_nts.add(elem)
     return all_nts - defined_nts
 
-def find_reachable_keys(grammar, key, reachable_keys=None, found_so_far=None):
-    if reachable_keys is None: reachable_keys = {}
-    if found_so_far is None: found_so_far = set()
-
-    for rule in grammar[key]:
-        for token in rule:
-            if not is_nt(token): continue
-            if token in found_so_far: continue
-            found_so_far.add(token)
-            if token in reachable_keys:
-                for k in reachable_keys[token]:
-                    found_so_far.add(k)
-            else:
-                keys = find_reachable_keys(grammar, token, reachable_keys, found_so_far)
-    return found_so_far
-
-def replace_references(grammar, replacee, replace_with):
-    new_grammar = {}
-    for key, ruleset in grammar.items():
-        new_ruleset = []
-        for rule in ruleset:
-            new_rule = []
-            for tok in rule:
-                if tok == replacee:
-                    new_rule.append(replace_with)
+def find_reachable_keys(grammar, key):
+    # The nts reachable from the rules of key (key itself only if it is recursive)
+    found = set()
+    work = [key]
+    while work:
+        for rule in grammar.get(work.pop(), ()):
+            for token in rule:
+                if is_nt(token) and token not in found:
+                    found.add(token)
+                    work.append(token)
+    return found
+
+class MutableGrammar:
+    """A grammar (nt => list of rules) that is changed in place. refs indexes where each
+    nonterminal occurs in the rules, so renaming or deleting a nonterminal only touches its
+    references, instead of rebuilding the whole grammar. The rules are copied into lists."""
+    def __init__(self, grammar: dict = None):
+        self.rules = {} # nt => list of rules
+        self.refs = {} # nt => {(nt of the rule, rule index, position)}
+        if grammar:
+            for nt, rules in grammar.items():
+                self.set_rules(nt, rules)
+
+    def __contains__(self, nt):
+        return nt in self.rules
+
+    def __getitem__(self, nt) -> list:
+        # Do not modify the returned list, use set_rules/rename
+        return self.rules[nt]
+
+    def __len__(self):
+        return len(self.rules)
+
+    def _index(self, nt, add: bool):
+        for i, rule in enumerate(self.rules[nt]):
+            for pos, tok in enumerate(rule):
+                if not is_nt(tok): continue
+                if add:
+                    self.refs.setdefault(tok, set()).add((nt, i, pos))
                 else:
-                    new_rule.append(tok)
-            new_ruleset.append(new_rule)
-        new_grammar[key] = new_ruleset
-    return new_grammar
+                    self.refs[tok].discard((nt, i, pos))
+
+    def set_rules(self, nt, rules: list):
+        if nt in self.rules:
+            self._index(nt, add=False)
+        self.rules[nt] = [list(rule) for rule in rules]
+        self._index(nt, add=True)
+
+    def delete(self, nt):
+        # Removes the definition of nt, references to it stay
+        self._index(nt, add=False)
+        del self.rules[nt]
+
+    def referrers(self, nt) -> set:
+        # The nts with a rule that refers to nt
+        return set(ref_nt for ref_nt, _, _ in self.refs.get(nt, ()))
+
+    def rename(self, old, new):
+        # Replaces old by new in all rules, and renames the definition of old (if any)
+        refs = self.refs.pop(old, set())
+        new_refs = self.refs.setdefault(new, set())
+        for nt, i, pos in refs:
+            self.rules[nt][i][pos] = new
+            new_refs.add((nt, i, pos))
+        if old in self.rules:
+            assert new not in self.rules, f"{new} is already defined"
+            self._index(old, add=False)
+            self.rules[new] = self.rules.pop(old)
+            self._index(new, add=True)
+
+    def to_dict(self) -> dict:
+        return {nt: [list(rule) for rule in rules] for nt, rules in self.rules.items()}
+
+class GrammarBuilder:
+    """Accumulates a grammar rule by rule. Keeps the alternatives of each nonterminal in
+    insertion order, plus a set of them (as tuples) so that adding a rule that is already
+    there is a hash lookup instead of a scan over all alternatives.
+
+    If stamp (a function) is given, each nonterminal and each alternative also gets the
+    stamp returned by stamp() when it is added the first time (see get_stamps)."""
+    def __init__(self, grammar: dict = None, stamp=None):
+        self.rules = {} # nt => list of rules
+        self.index = {} # nt => {tuple(rule): stamp of rule} (stamps are None without stamp)
+        self.stamp = stamp
+        self.nt_stamps = {} # nt => stamp of nt (only with stamp)
+        self.count_alternatives = 0 # over all nts
+        if grammar:
+            for nt, rules in grammar.items():
+                self.set_rules(nt, rules)
+
+    def __contains__(self, nt):
+        return nt in self.rules
+
+    def __getitem__(self, nt) -> list:
+        # Do not modify the returned list, use add/set_rules
+        return self.rules[nt]
+
+    def __len__(self):
+        return len(self.rules)
+
+    def has_rule(self, nt, rule) -> bool:
+        index = self.index.get(nt)
+        return index is not None and tuple(rule) in index
+
+    def _new_stamp(self):
+        return self.stamp() if self.stamp else None
+
+    def define(self, nt):
+        # Adds nt without alternatives (if it is not there yet)
+        if nt not in self.rules:
+            self.rules[nt] = []
+            self.index[nt] = {}
+            if self.stamp: self.nt_stamps[nt] = self.stamp()
+
+    def add(self, nt, rule: list) -> bool:
+        # Appends rule to the alternatives of nt unless it is already one of them
+        index = self.index.get(nt)
+        if index is None:
+            self.define(nt)
+            index = self.index[nt]
+        key = tuple(rule)
+        if key in index:
+            return False
+        index[key] = self._new_stamp()
+        self.rules[nt].append(rule)
+        self.count_alternatives += 1
+        return True
+
+    def set_rules(self, nt, rules: list):
+        self.define(nt)
+        old_index = self.index[nt]
+        index = {}
+        for rule in rules:
+            key = tuple(rule)
+            index[key] = old_index[key] if key in old_index else self._new_stamp()
+        self.count_alternatives += len(rules) - len(self.rules[nt])
+        self.rules[nt] = [list(rule) for rule in rules]
+        self.index[nt] = index
+
+    def to_dict(self) -> dict:
+        # The usual grammar shape (nt => list of rules), independent of the builder
+        return {nt: [list(rule) for rule in rules] for nt, rules in self.rules.items()}
+
+    def get_stamps(self) -> dict:
+        # nt => [stamp of nt, [stamp of each rule, in the order of to_dict()]]
+        return {nt: [self.nt_stamps.get(nt), [self.index[nt][tuple(rule)] for rule in rules]] for nt, rules in self.rules.items()}
+
+    def set_stamps(self, stamps: dict):
+        # The inverse of get_stamps, for a builder created from the same grammar
+        for nt, (nt_stamp, rule_stamps) in stamps.items():
+            self.nt_stamps[nt] = nt_stamp
+            self.index[nt] = {tuple(rule): stamp for rule, stamp in zip(self.rules[nt], rule_stamps)}
 ####### </grammar helpers> ##########
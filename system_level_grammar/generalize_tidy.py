@@ -1,107 +1,218 @@
-import copy
-from itertools import combinations
+import heapq
+from collections import deque
 
 from generalize_tokens import patterns
-from generalize_helpers import is_nt
+from generalize_helpers import is_nt, MutableGrammar
+from common import get_logger
+
+log = get_logger("generalize_tidy")
 
 def inline_single_rules_and_opt_generalization(grammar):
     # Do (inline fix point, opt fix point) in another fix point loop,
     # as they depend on each other.
-    global_change = True
-    while global_change:
-        global_change = False
-        # Inline single rule non-terminals.
-        # Fix-point iteration, because inlined rules, in turn, can have inlineable nts.
+    return GrammarSimplifier(grammar).simplify()
+
+class GrammarSimplifier:
+    """Inlines single rule nonterminals and generalizes optional elements (<opt_...>) until
+    neither changes the grammar any more. Instead of passes over the whole grammar, a
+    worklist holds the nonterminals that need to be inlined into (or deduplicated) again,
+    and the reference index of the grammar (MutableGrammar.referrers) tells which ones are
+    affected when a nonterminal gets a single rule or its single rule changes. Likewise,
+    opt_dirty holds the nonterminals whose rules changed since opt_generalization last
+    looked at them.
+
+    The result is the same as alternating the passes: inlining reaches the same fix point
+    in any order, and opt_generalization visits the nonterminals in grammar order, skipping
+    only those it would not change."""
+    def __init__(self, grammar):
+        # We do not want to inline pattern nts,
+        # to preserve their structure, and because
+        # they could prevent some further opts.
+        self.ignore_nts = set(p[1] for p in patterns)
+        self.g = MutableGrammar()
+        self.worklist = deque()
+        self.in_worklist = set()
+        self.opt_dirty = set()
+        for key, rules in grammar.items():
+            self.set_rules(key, rules)
+
+    def simplify(self) -> dict:
         change = True
         while change:
-            grammar, change = inline_single_rule_nts(grammar)
-            global_change = change
+            self.inline_single_rule_nts()
+            change = self.opt_generalization()
+        return self.g.rules
 
-        # Do "<opt>" cleanup
-        grammar, _global_change = opt_generalization(grammar)
-        global_change |= _global_change
+    def set_rules(self, key, rules):
+        old_rules = self.g.rules.get(key)
+        self.g.set_rules(key, rules)
+        if key not in self.ignore_nts and (len(rules) == 1 or (old_rules is not None and len(old_rules) == 1)):
+            # key is (or was) inlined into these
+            for ref in sorted(self.g.referrers(key) - self.ignore_nts):
+                self.push(ref)
+        self.push(key)
+        self.opt_dirty.add(key)
 
-    return grammar
+    def push(self, key):
+        if key not in self.in_worklist:
+            self.in_worklist.add(key)
+            self.worklist.append(key)
 
-def inline_single_rule_nts(grammar):
-    # We do not want to inline pattern nts,
-    # to preserve their structure, and because
-    # they could prevent some further opts.
-    ignore_nts = [p[1] for p in patterns]
+    def inlineable(self, token) -> bool:
+        return token not in self.ignore_nts and is_nt(token) and token in self.g and len(self.g[token]) == 1
 
-    change = False
-    temp_grammar = {}
-    for key, rules in grammar.items():
-        temp_grammar[key] = []
+    def inline_single_rule_nts(self):
+        # Fix-point iteration, because inlined rules, in turn, can have inlineable nts.
+        # Like the passes over the whole grammar that this replaces, it stops right away if
+        # nothing is inlineable, even if removing duplicate rules makes some nts single rule.
+        # The worklist is kept for the next call then.
+        if not any(self.g.referrers(nt) - self.ignore_nts for nt, rules in self.g.rules.items() if len(rules) == 1 and nt not in self.ignore_nts):
+            for key in list(self.worklist):
+                self.inline_key(key, inline=False)
+            return
+        while self.worklist:
+            key = self.worklist.popleft()
+            self.in_worklist.discard(key)
+            self.inline_key(key)
+
+    def inline_key(self, key, inline=True):
+        rules = self.g[key]
+        new_rules = []
+        seen = set()
         for rule in rules:
-            new_rule = []
-            for token in rule:
-                if key not in ignore_nts and token not in ignore_nts and \
-                    is_nt(token) and token in grammar and len(grammar[token])==1:
-                    print(f"Inlining {token} to {grammar[token][0]}")
-                    new_rule.extend(grammar[token][0])
-                    change = True
-                else:
-                    new_rule.append(token)
-            if new_rule not in temp_grammar[key]:
+            if inline and key not in self.ignore_nts:
+                while any(self.inlineable(token) for token in rule):
+                    new_rule = []
+                    for token in rule:
+                        if self.inlineable(token):
+                            log.debug("Inlining %s to %s", token, self.g[token][0])
+                            new_rule.extend(self.g[token][0])
+                        else:
+                            new_rule.append(token)
+                    rule = new_rule
+            if tuple(rule) not in seen:
                 # Avoid duplicates
-                temp_grammar[key].append(new_rule)
-    return temp_grammar, change
+                seen.add(tuple(rule))
+                new_rules.append(rule)
+        if new_rules != rules:
+            self.set_rules(key, new_rules)
 
-#<opt generalization>
-def gen_dummy_rules(rule: list[str]):
-    rules = []
-    for i in range(len(rule)+1):
-        new = rule[:i] + ["<dummy>"] + rule[i:]
-        rules.append(new)
-    return rules
-
-def one_matches_modulo_dummy(rule, dummy_rules):
-    match = True
-    for dummy_rule in dummy_rules:
-        assert len(rule) == len(dummy_rule)
-        match = True
-        for i in range(len(rule)):
-            if rule[i] != dummy_rule[i] and dummy_rule[i] != "<dummy>":
-                # actual mismatch
-                match = False
-                break
-        if match: return dummy_rule
-    return None
-
-def opt_generalization(grammar):
-    global_change = False
-    temp_grammar = copy.deepcopy(grammar)
-    g_keys = list(temp_grammar.keys())
-    for key in g_keys:
+    def opt_generalization(self) -> bool:
+        global_change = False
+        for key in list(self.g.rules):
+            if key not in self.opt_dirty: continue
+            self.opt_dirty.discard(key)
+            global_change |= self.opt_generalize_key(key)
+            self.opt_dirty.discard(key)
+        return global_change
+
+    def opt_generalize_key(self, key) -> bool:
+        if not key.startswith("<opt_"):
+            # All rewrites in one sweep over an OptionalIndex. (The rewrites of an <opt_...>
+            # nt could redefine that nt itself, so those take the loop below.)
+            index = OptionalIndex(self.g[key])
+            while (found := index.first()) is not None:
+                short, long, dummy_idx = found
+                optional = index.rules[long][dummy_idx]
+                log.debug("Found optional element: %s", optional)
+                opt_nt = f"<opt_{optional[1:-1]}>"
+                index.rewrite(short, long, dummy_idx, opt_nt)
+                self.set_rules(opt_nt, [[""], [optional]])
+            if index.rewrites:
+                self.set_rules(key, index.to_list())
+            return index.rewrites > 0
+
+        global_change = False
         change = True
         while change:
             change = False
-            # Check if any two rules are equal modulo a single optional NT (i.e. one rule is 1 element shorter)
-
-            for (i, j) in combinations(range(len(temp_grammar[key])), 2):
-                # unique pairs
-                if abs(len(temp_grammar[key][i]) - len(temp_grammar[key][j])) == 1:
-                    if len(temp_grammar[key][i]) < len(temp_grammar[key][j]):
-                        short = i
-                        long = j
-                    else:
-                        short = j
-                        long = i
-                    match_dummy_rule = one_matches_modulo_dummy(temp_grammar[key][long], gen_dummy_rules(temp_grammar[key][short]))
-                    if match_dummy_rule:
-                        dummy_idx = match_dummy_rule.index("<dummy>")
-                        optional = temp_grammar[key][long][dummy_idx]
-                        if not is_nt(optional): continue 
-                        if optional.startswith("<opt_"): continue # We don't want <opt_opt_opt_...
-                        print("Found optional element: ", optional)
-                        assert optional[0] == "<" and optional[-1] == ">"
-                        temp_grammar[key][long][dummy_idx] = f"<opt_{optional[1:-1]}>"
-                        temp_grammar[f"<opt_{optional[1:-1]}>"] = [[""], [optional]]
-                        # - Delete shorter rule
-                        temp_grammar[key] = temp_grammar[key][:short] +  temp_grammar[key][short+1:]
-                        change = True
-                        global_change = True
-                        break
-    return temp_grammar, global_change
+            found = find_optional(self.g[key])
+            if found is not None:
+                short, long, dummy_idx = found
+                rules = self.g[key]
+                optional = rules[long][dummy_idx]
+                log.debug("Found optional element: %s", optional)
+                opt_nt = f"<opt_{optional[1:-1]}>"
+                self.set_rules(key, rules[:long] + [rules[long][:dummy_idx] + [opt_nt] + rules[long][dummy_idx+1:]] + rules[long+1:])
+                self.set_rules(opt_nt, [[""], [optional]])
+                # - Delete shorter rule
+                self.set_rules(key, self.g[key][:short] + self.g[key][short+1:])
+                change = True
+                global_change = True
+        return global_change
+
+#<opt generalization>
+class OptionalIndex:
+    """Finds pairs of rules that are equal modulo a single optional NT: the longer one without
+    that element is the shorter one. Instead of comparing all pairs, each rule is indexed by
+    the rules it becomes with one element removed. first() gives the pair that a scan over
+    combinations() of the rules would find first, and rewrite() applies it (as
+    opt_generalization does) and updates only the pairs of the two rules involved.
+
+    Rules are identified by their initial position. Deleting a rule does not change the order
+    of the others, so the order of the ids is the order of the positions."""
+    def __init__(self, rules):
+        self.rules = {idx: tuple(rule) for idx, rule in enumerate(rules)} # id => rule
+        self.by_rule = {} # rule => ids
+        self.by_short = {} # rule with one element removed => {id of the longer rule: index of that element}
+        self.pairs = [] # heap of (first id, second id, short id, long id, index of the optional element)
+        self.rewrites = 0
+        for idx in self.rules:
+            self._add(idx)
+
+    @staticmethod
+    def short_rules(rule):
+        # (rule without the element, index of the element) for the elements that can be optional.
+        # Only the first index at which an element can be removed to get a certain rule counts.
+        seen = set()
+        for dummy_idx in range(len(rule)):
+            short_rule = rule[:dummy_idx] + rule[dummy_idx+1:]
+            if short_rule in seen: continue
+            seen.add(short_rule)
+            optional = rule[dummy_idx]
+            if not is_nt(optional): continue
+            if optional.startswith("<opt_"): continue # We don't want <opt_opt_opt_...
+            yield short_rule, dummy_idx
+
+    def _add(self, idx):
+        rule = self.rules[idx]
+        self.by_rule.setdefault(rule, set()).add(idx)
+        for short_rule, dummy_idx in OptionalIndex.short_rules(rule):
+            self.by_short.setdefault(short_rule, {})[idx] = dummy_idx
+            for short in self.by_rule.get(short_rule, ()):
+                heapq.heappush(self.pairs, (min(short, idx), max(short, idx), short, idx, dummy_idx))
+        for long, dummy_idx in self.by_short.get(rule, {}).items():
+            heapq.heappush(self.pairs, (min(idx, long), max(idx, long), idx, long, dummy_idx))
+
+    def _remove(self, idx):
+        rule = self.rules.pop(idx)
+        self.by_rule[rule].discard(idx)
+        for short_rule, _ in OptionalIndex.short_rules(rule):
+            del self.by_short[short_rule][idx]
+
+    def first(self):
+        # (short id, long id, index of the optional element in long), or None
+        while self.pairs:
+            _, _, short, long, dummy_idx = self.pairs[0]
+            if short in self.rules and self.by_short.get(self.rules[short], {}).get(long) == dummy_idx:
+                return short, long, dummy_idx
+            heapq.heappop(self.pairs) # one of the rules was rewritten or deleted since
+        return None
+
+    def rewrite(self, short, long, dummy_idx, opt_nt):
+        # Replaces the optional element of long by opt_nt and deletes short
+        rule = self.rules[long]
+        self._remove(long)
+        self._remove(short)
+        self.rules[long] = rule[:dummy_idx] + (opt_nt,) + rule[dummy_idx+1:]
+        self._add(long)
+        self.rewrites += 1
+
+    def to_list(self) -> list:
+        return [list(self.rules[idx]) for idx in sorted(self.rules)]
+
+def find_optional(rules):
+    # Returns (short, long, index of the optional element in long) of the first pair of rules
+    # that are equal modulo a single optional NT, see OptionalIndex
+    return OptionalIndex(rules).first()
 #</opt generalization>
\ No newline at end of file
@@ -1,13 +1,21 @@
+import os
+import json
 import string
 import re
+import hashlib
 import config
 from typing import Type
-import copy
+import logging
+import random
+import zlib
+import multiprocessing
 
-from common import LimitFuzzer, is_nt
+from common import LimitFuzzer, is_nt, get_logger, ASCII_MAP
 from collections import namedtuple
 
-from generalize_helpers import replace_references
+from generalize_helpers import MutableGrammar
+
+log = get_logger("generalize_tokens")
 
 def is_external_function(s):
     return s.startswith('<__external_')
@@ -155,11 +163,14 @@ all_pattern_nts = _all_pattern_nts + [f"<opt_{p[1:-1]}>" for p in _all_pattern_n
 
 ALLOWED_TOKEN_MISMATCH_RATE = 0.05
 
+compiled_patterns = {} # regexp => compiled ^regexp$ (more than fit into the cache of re)
 def all_match(unique_strs: set[str], regexp: str):
-    regexp = r'^' + regexp + r'$'
+    compiled = compiled_patterns.get(regexp)
+    if compiled is None:
+        compiled = compiled_patterns[regexp] = re.compile(r'^' + regexp + r'$', re.DOTALL) # re.DOTALL => `.` also matches NEWLINE
     mismatches = 0
     for s in unique_strs:
-        if not re.match(regexp, s, re.DOTALL): # re.DOTALL => `.` also matches NEWLINE
+        if not compiled.match(s):
             mismatches += 1
             if mismatches/len(unique_strs) >= ALLOWED_TOKEN_MISMATCH_RATE:
                 # If less than 5% mismatches, we still consider this "all match".
@@ -167,6 +178,89 @@ def all_match(unique_strs: set[str], regexp: str):
                 return False
     return True
 
+# Patterns of the form ATOM+ or [WS]*ATOM+ (see ws_grammar), where ATOM matches a single character
+re_char_class_pattern = re.compile(r'(?:\[([^\]]*)\]\*)?(\\[dsw]|\.|\[(?:\\.|[^\]\\])*\])\+', re.DOTALL)
+
+class PatternClassifier:
+    """all_match for many patterns over the same inputs, scanning each input only once.
+
+    Whether an input matches ATOM+ only depends on which atoms match each of its characters,
+    so a scan computes the set of atoms (a bitmask) that every character matches, and the
+    same for the characters after the leading whitespace (for [WS]*ATOM+). The inputs are
+    grouped by these bitmasks, which gives the mismatch rate of every atom at once. The
+    atoms are the ones of the simple patterns, plus the character class of token_alphabet
+    (refined patterns, see generalize_patterns). Other patterns fall back to all_match."""
+    atoms = None # atom => bit, for the simple patterns
+    char_masks = {} # char => bitmask of the atoms (of simple patterns) that match it
+
+    def __init__(self, inputs: set[str], ws_alphabet: set, token_atom: str = None, token_alphabet: set = None):
+        if PatternClassifier.atoms is None:
+            simple_atoms = [pattern.regex[:-1] for pattern in patterns if is_simple_pattern(pattern)]
+            PatternClassifier.atoms = {atom: 1 << i for i, atom in enumerate(simple_atoms)}
+        self.inputs = inputs
+        self.ws_alphabet = frozenset(ws_alphabet)
+        self.token_atom = token_atom
+        self.token_alphabet = token_alphabet or set()
+        self.token_bit = 1 << len(PatternClassifier.atoms)
+        self.plain = {} # bitmask of the matching ATOM+ => number of inputs
+        self.ws = {} # bitmask of the matching [WS]*ATOM+ => number of inputs
+        for inp in inputs:
+            plain, ws = self.scan(inp)
+            if inp.endswith("\n"):
+                # $ (see all_match) also matches before a trailing newline
+                plain_, ws_ = self.scan(inp[:-1])
+                plain |= plain_
+                ws |= ws_
+            self.plain[plain] = self.plain.get(plain, 0) + 1
+            self.ws[ws] = self.ws.get(ws, 0) + 1
+
+    def char_mask(self, c) -> int:
+        mask = PatternClassifier.char_masks.get(c)
+        if mask is None:
+            mask = 0
+            for atom, bit in PatternClassifier.atoms.items():
+                if re.fullmatch(atom, c, re.DOTALL):
+                    mask |= bit
+            PatternClassifier.char_masks[c] = mask
+        if c in self.token_alphabet:
+            mask |= self.token_bit
+        return mask
+
+    def scan(self, inp) -> tuple[int, int]:
+        # The atoms that match all of inp, and the atoms that match all of inp after its
+        # leading whitespace (or its last character, if it is whitespace only)
+        if inp == "":
+            return 0, 0
+        plain = ws = -1
+        in_prefix = True
+        for c in inp:
+            mask = self.char_mask(c)
+            plain &= mask
+            if in_prefix and c not in self.ws_alphabet:
+                in_prefix = False
+            if not in_prefix:
+                ws &= mask
+        if in_prefix:
+            ws = self.char_mask(inp[-1])
+        return plain, ws
+
+    def all_match(self, regexp: str) -> bool:
+        m = re_char_class_pattern.fullmatch(regexp)
+        if m is not None and m.group(2) == self.token_atom and self.token_alphabet:
+            bit = self.token_bit
+        elif m is not None and m.group(2) in PatternClassifier.atoms:
+            bit = PatternClassifier.atoms[m.group(2)]
+        else:
+            return all_match(self.inputs, regexp)
+        if m.group(1) is None:
+            counts = self.plain
+        elif set(m.group(1)) == self.ws_alphabet:
+            counts = self.ws
+        else:
+            return all_match(self.inputs, regexp)
+        mismatches = sum(n for mask, n in counts.items() if not mask & bit)
+        return mismatches == 0 or mismatches/len(self.inputs) < ALLOWED_TOKEN_MISMATCH_RATE
+
 ws_chars = ''.join([chr(i) for i in [0x20, 0x09, 0x0a, 0x0b, 0x0c, 0x0d]])
 control_chars = ''.join([chr(i) for i in range(1, 32)] + [chr(127)])
 ws_control_chars = ws_chars + control_chars
@@ -235,30 +329,171 @@ def concrete_grammar(unique: set[str]) -> tuple[NonTerminal, Grammar]:
     pattern_grammar = {start_nt: alts}
     return start_nt, pattern_grammar
 
-def generate_inputs(fuzzer, nt, num_inputs=1000, max_depth=10):
+class LanguageEnumerator:
+    """The strings that fuzzer.fuzz(nt, max_depth) can produce. Below max_depth, the fuzzer
+    picks any rule, from there on only the cheapest ones (fuzzer.cheap_grammar). So the
+    strings of (nt, depth) only depend on min(depth, max_depth).
+
+    count() gives the number of derivations, up to limit (limit + 1 means more than limit,
+    or infinitely many). If there are at most limit, strings() enumerates them exactly."""
+    def __init__(self, fuzzer: LimitFuzzer, max_depth: int = 10, limit: int = 1000):
+        self.fuzzer = fuzzer
+        self.max_depth = max_depth
+        self.limit = limit
+        self.counts = {} # (nt, depth) => number of derivations, capped at limit + 1
+        self.languages = {} # (nt, depth) => set of strings
+
+    def rules(self, nt, depth) -> list:
+        return self.fuzzer.grammar[nt] if depth < self.max_depth else self.fuzzer.cheap_grammar[nt]
+
+    def count(self, nt, depth=0, active=None) -> int:
+        if active is None: active = set()
+        key = (nt, min(depth, self.max_depth))
+        if key in self.counts:
+            return self.counts[key]
+        unbounded = self.limit + 1
+        if key in active:
+            return unbounded # recursion in the cheap grammar
+        active.add(key)
+        total = 0
+        for rule in self.rules(nt, depth):
+            derivations = 1
+            for tok in rule:
+                if tok in ASCII_MAP or (tok and tok[-1] == '+' and tok[:-1] in ASCII_MAP):
+                    derivations *= unbounded # random characters, see LimitFuzzer.iter_gen_key
+                elif is_nt(tok):
+                    derivations *= self.count(tok, depth + 1, active)
+                derivations = min(derivations, unbounded)
+            total = min(total + derivations, unbounded)
+        active.remove(key)
+        self.counts[key] = total
+        return total
+
+    def strings(self, nt, depth=0) -> set[str]:
+        # Only if count(nt, depth) <= limit
+        key = (nt, min(depth, self.max_depth))
+        if key in self.languages:
+            return self.languages[key]
+        language = set()
+        for rule in self.rules(nt, depth):
+            prefixes = {""}
+            for tok in rule:
+                if is_nt(tok):
+                    prefixes = {prefix + s for prefix in prefixes for s in self.strings(tok, depth + 1)}
+                else:
+                    prefixes = {prefix + tok for prefix in prefixes}
+            language |= prefixes
+        self.languages[key] = language
+        return language
+
+def generate_inputs(fuzzer, nt, num_inputs=1000, max_depth=10, enumerator: LanguageEnumerator = None):
+    # All strings the fuzzer can produce for nt if there are at most num_inputs derivations
+    # (e.g. keywords), otherwise the distinct ones of num_inputs samples
+    if enumerator is None:
+        enumerator = LanguageEnumerator(fuzzer, max_depth, num_inputs)
+    if enumerator.count(nt) <= num_inputs:
+        return set(enumerator.strings(nt))
     inputs: set[str] = set()
     for _ in range(num_inputs):
         inp, _ = fuzzer.fuzz(nt, max_depth=max_depth)
         inputs.add(inp)
     return inputs
 
-def get_nt_alphabet(g, nt) -> set:
-    # Get all terminals
-    visited = set()
-    alphabet = set()
-    q = [nt]
-    while q != []:
-        cur_nt = q.pop()
-        visited.add(cur_nt)
-        for rule in g[cur_nt]:
-            for tok in rule:
-                if not is_nt(tok):
-                    for c in tok:
-                        alphabet.add(c)
-                else:
-                    if tok not in visited:
-                        q.append(tok)
-    return alphabet
+class AlphabetIndex:
+    """The terminal characters each nonterminal of g can reach, as bitsets (ints) over the
+    characters of g. The nonterminals of a strongly connected component share one alphabet,
+    which is the union of their own terminals and the alphabets of the components they
+    refer to. The components are indexed on demand, in one pass (Tarjan) from the queried
+    nonterminal that visits each nonterminal of g at most once over all queries."""
+    def __init__(self, g):
+        self.g = g
+        self.bits = {} # char => bit
+        self.chars = [] # bit index => char
+        self.masks = {} # nt => alphabet bitset
+        self.alphabets = {} # alphabet bitset => set of chars
+        self.pattern_masks = {} # char_nt of a simple pattern => its alphabet bitset
+
+    def mask_of(self, chars) -> int:
+        mask = 0
+        for c in chars:
+            bit = self.bits.get(c)
+            if bit is None:
+                bit = self.bits[c] = 1 << len(self.chars)
+                self.chars.append(c)
+            mask |= bit
+        return mask
+
+    def chars_of(self, mask: int) -> set:
+        alphabet = self.alphabets.get(mask)
+        if alphabet is None:
+            alphabet = self.alphabets[mask] = {c for i, c in enumerate(self.chars) if mask >> i & 1}
+        return alphabet
+
+    def mask(self, nt) -> int:
+        if nt not in self.masks:
+            self._index(nt)
+        return self.masks[nt]
+
+    def alphabet(self, nt) -> set:
+        # Do not modify the returned set
+        return self.chars_of(self.mask(nt))
+
+    def pattern_mask(self, pattern: Pattern) -> int:
+        mask = self.pattern_masks.get(pattern.char_nt)
+        if mask is None:
+            mask = self.pattern_masks[pattern.char_nt] = self.mask_of(rule[0] for rule in pattern.grammar[pattern.char_nt])
+        return mask
+
+    @staticmethod
+    def is_subset(mask: int, of_mask: int) -> bool:
+        return mask & ~of_mask == 0
+
+    def _index(self, root):
+        # Iterative Tarjan. A component is complete once all components it refers to are,
+        # so its alphabet is final when it is popped.
+        order = {} # nt => DFS number
+        low = {}
+        stack = [] # nts of the open components
+        on_stack = set()
+        work = [(root, None)]
+        while work:
+            nt, it = work[-1]
+            if it is None:
+                order[nt] = low[nt] = len(order)
+                stack.append(nt)
+                on_stack.add(nt)
+                it = iter(tok for rule in self.g[nt] for tok in rule if is_nt(tok))
+                work[-1] = (nt, it)
+            for tok in it:
+                if tok in self.masks:
+                    continue
+                if tok not in order:
+                    work.append((tok, None))
+                    break
+                if tok in on_stack:
+                    low[nt] = min(low[nt], order[tok])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[nt])
+                if low[nt] == order[nt]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == nt: break
+                    mask = 0
+                    for member in component:
+                        for rule in self.g[member]:
+                            for tok in rule:
+                                if not is_nt(tok):
+                                    mask |= self.mask_of(tok)
+                                elif tok in self.masks:
+                                    mask |= self.masks[tok]
+                    for member in component:
+                        self.masks[member] = mask
 
 def generalize_concrete_with_ws(nt, stripped_inputs, ws_alphabet):
     start, pattern_grammar = concrete_grammar(stripped_inputs)
@@ -268,41 +503,43 @@ def generalize_concrete_with_ws(nt, stripped_inputs, ws_alphabet):
     grammar = _p.grammar
     start = _p.string_nt
     grammar[nt] = [[start]]
-    print(f"Generalized {nt} to: {stripped_inputs} + leading WS")
+    log.info("Generalized %s to: %s + leading WS", nt, stripped_inputs)
     return grammar
 
-def generalize_patterns(_g, nt, inputs, ws_alphabet, ws_prefixes, token_to_alphabet: None) -> dict:
+def generalize_patterns(_g, nt, inputs, ws_alphabet, ws_prefixes, token_to_alphabet: None, alphabet_index: AlphabetIndex = None) -> dict:
     g = {}
+    if alphabet_index is None:
+        alphabet_index = AlphabetIndex(_g)
+    isTokenCursor = bool(token_to_alphabet)
+    if isTokenCursor:
+        token_alphabet: set = token_to_alphabet[nt]
+        token_mask = alphabet_index.mask_of(token_alphabet)
+    else:
+        token_mask = alphabet_index.mask(nt)
+        token_alphabet = alphabet_index.alphabet(nt)
+    token_atom = rf'[{"".join(re.escape(c) for c in token_alphabet)}]' # for refined patterns
+    classifier = PatternClassifier(inputs, ws_alphabet, token_atom, token_alphabet)
     pattern: Pattern
     for pattern in patterns:
         if is_simple_pattern(pattern):
-            isTokenCursor = bool(token_to_alphabet)
-            if isTokenCursor:
-                token_alphabet: set = token_to_alphabet[nt]
-            else:
-                token_alphabet = get_nt_alphabet(_g, nt)
-        
-            pattern_alphabet = set(ll[0] for ll in pattern.grammar[pattern.char_nt])
-            print("DBG: token alphabet: ", token_alphabet)
-            print("DBG: pattern alphabet: ", pattern_alphabet)
-            if (token_alphabet != pattern_alphabet and
-                token_alphabet.issubset(pattern_alphabet)):
-                print("DBG: proper subset token alphabet: ", token_alphabet)
-                print("DBG: proper diff token alphabet: ", pattern_alphabet - token_alphabet)
-
-                refined_pattern = copy.deepcopy(pattern)
-                refined_pattern.grammar[pattern.char_nt] = [[c] for c in sorted(list(token_alphabet))]
+            pattern_mask = alphabet_index.pattern_mask(pattern)
+            log.debug("DBG: token alphabet: %s", token_alphabet)
+            if (token_mask != pattern_mask and
+                AlphabetIndex.is_subset(token_mask, pattern_mask)):
+                log.debug("DBG: proper subset token alphabet: %s", token_alphabet)
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug("DBG: proper diff token alphabet: %s", alphabet_index.chars_of(pattern_mask & ~token_mask))
+
+                rpg = MutableGrammar(pattern.grammar)
+                rpg.set_rules(pattern.char_nt, [[c] for c in sorted(list(token_alphabet))])
                 # Update all NT names in the grammar with unique suffix, so subsequent generalization are not affected or override.
                 next_id: int = new_id()
-                nts = refined_pattern.grammar.keys()
-                rpg = refined_pattern.grammar
-                for __nt in nts:
-                    rpg = replace_references(rpg, __nt, f"{__nt[:-1]}_{next_id}>")
-                rpg = {f"{__nt[:-1]}_{next_id}>": rpg[__nt] for __nt in nts}
-                pattern = Pattern(rf'[{"".join(re.escape(c) for c in token_alphabet)}]+',
+                for __nt in pattern.grammar:
+                    rpg.rename(__nt, f"{__nt[:-1]}_{next_id}>")
+                pattern = Pattern(token_atom + '+',
                                   f"{pattern.string_nt[:-1]}_{next_id}>",
                                   f"{pattern.char_nt[:-1]}_{next_id}>",
-                                  rpg)
+                                  rpg.rules)
 
 
         candidates: list[Pattern] = [pattern]
@@ -313,50 +550,226 @@ def generalize_patterns(_g, nt, inputs, ws_alphabet, ws_prefixes, token_to_alpha
                 candidates.append(ws_p)
 
         for pc in candidates:
-            if all_match(inputs, pc.regex):
+            if classifier.all_match(pc.regex):
                 g.update(pc.grammar)
                 g[nt] = [[pc.string_nt]]
-                print(f"Generalized {nt} to {pc.string_nt}")
                 return g
             
     assert False, "Error: generalize_patterns() should not read this point."
 
 
 GENERALIZATION_THRESHOLD = 10
-def generalize_tokens(g, token_to_alphabet: dict = None):
+def generalize_token(g, nt, fuzzer, enumerator, alphabet_index, token_to_alphabet: dict = None) -> dict:
+    # The rules for nt (an external token) and the new nonterminals they use
+    log.debug("DBG: generalize_tokens of nt=%s", nt)
+
+    inputs: set[str] = generate_inputs(fuzzer, nt, enumerator=enumerator)
+    ws_alphabet, ws_prefixes, stripped_inputs = strip_inputs(inputs)
+
+    # Case 1: concrete (keywords) w/ leading ws
+    # We require this *threshold* to distinguish this from "the odd space" originating from a <any_str>
+    if len(ws_prefixes) >= len(inputs)*config.WS_RATIO:
+        if len(stripped_inputs) <= GENERALIZATION_THRESHOLD:
+            log.debug("DBG: generalize_tokens of nt=%s case 1", nt)
+            return generalize_concrete_with_ws(nt, stripped_inputs, ws_alphabet)
+
+    # Case 2: concrete (keywords) w/o leading ws
+    if len(inputs) <= GENERALIZATION_THRESHOLD:
+        log.info("Did not generalize %s (<10 inputs). It remains: %s", nt, g[nt])
+        log.debug("DBG: generalize_tokens of nt=%s case 2", nt)
+        return {nt: g[nt]}
+
+    # Case 3: abstract pattern
+    # Case 4: abstract pattern w/ leading ws
+    new_g = generalize_patterns(g, nt, inputs, ws_alphabet, ws_prefixes, token_to_alphabet, alphabet_index)
+    log.debug("DBG: generalize_tokens of nt=%s case 3", nt)
+    assert nt in new_g
+    return new_g
+
+# Each token is generalized with fresh counters (new_id, new_nt, ws_grammar) and its own
+# random seed, so the result does not depend on which tokens were generalized before, or in
+# which process. merge_token_grammar then numbers the new nonterminals in token order.
+re_refined_nt = re.compile(r'<(.+)_(\d+)>') # see generalize_patterns
+re_ws_nt = re.compile(r'<ws(\d+)_(str|char)>') # see ws_grammar
+re_tok_nt = re.compile(r'<toknt(\d+)>') # see new_nt
+pattern_grammar_nts = {_nt for pattern in patterns for _nt in pattern.grammar}
+
+class TokenCache:
+    """On-disk cache of the results of _generalize_token_worker, one file per token, so that
+    re-mining a subject does not generalize the same tokens again. The key is a hash of the
+    token's sub-grammar (with the nonterminals numbered in the order they are reached, so
+    the mined names do not matter), its alphabet and the thresholds of the generalization.
+    The stored grammar uses the same numbering, see canonical_names.
+
+    A hit does not depend on the random seed: a token that is sampled rather than enumerated
+    gets the generalization of the run that stored it. evict() removes the least recently
+    used entries once the cache is larger than max_bytes."""
+    VERSION = 2 # of the generalization, part of the key
+
+    def __init__(self, directory, max_bytes: int = 256 << 20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def canonical_names(g, nt) -> dict:
+        # nt => "<#0>", and the nonterminals reachable from it => "<#1>", ... in DFS order
+        names = {}
+        stack = [nt]
+        while stack:
+            cur_nt = stack.pop()
+            if cur_nt in names: continue
+            names[cur_nt] = f"<#{len(names)}>"
+            stack.extend(reversed([tok for rule in g[cur_nt] for tok in rule if tok in g and tok not in names]))
+        return names
+
+    def key(self, g, nt, names: dict, token_to_alphabet: dict = None) -> str:
+        sub_grammar = [[[names.get(tok, tok) for tok in rule] for rule in g[_nt]] for _nt in names]
+        alphabet = sorted(token_to_alphabet[nt]) if token_to_alphabet else None
+        thresholds = [config.WS_RATIO, config.ALLOWED_TOKEN_MISMATCH_RATE, config.THRESHOLD_GENERALIZATION,
+                      ALLOWED_TOKEN_MISMATCH_RATE, GENERALIZATION_THRESHOLD]
+        key = json.dumps([TokenCache.VERSION, sub_grammar, alphabet, thresholds])
+        return hashlib.blake2b(key.encode('utf-8'), digest_size=16).hexdigest()
+
+    def path(self, key) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        try:
+            with open(self.path(key), 'r') as f:
+                entry = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        os.utime(self.path(key)) # for evict
+        return entry
+
+    def put(self, key, entry):
+        # Written to a temporary file first, so concurrent readers never see a partial entry
+        tmp = f"{self.path(key)}.{os.getpid()}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp, self.path(key))
+
+    def evict(self):
+        entries = []
+        for fname in os.listdir(self.directory):
+            if not fname.endswith(".json"): continue
+            st = os.stat(os.path.join(self.directory, fname))
+            entries.append((st.st_mtime, st.st_size, fname))
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+        for _, size, fname in sorted(entries):
+            if total <= self.max_bytes: break
+            os.remove(os.path.join(self.directory, fname))
+            total -= size
+            evicted += 1
+        if evicted:
+            log.info("Evicted %d token cache entries from %s", evicted, self.directory)
+
+def rename_nts(token_g: dict, renames: dict) -> dict:
+    # The rules of <ws{id}_char> are single characters, not lists (see ws_grammar)
+    return {renames.get(_nt, _nt): [rule if isinstance(rule, str) else [renames.get(tok, tok) for tok in rule] for rule in rules]
+            for _nt, rules in token_g.items()}
+
+_worker = None # (g, fuzzer, enumerator, alphabet_index, token_to_alphabet, cache) of a pool worker
+
+def _init_worker(g, token_to_alphabet, cache: TokenCache = None):
+    global _worker
     fuzzer = LimitFuzzer(g)
+    # The enumerator and the index are shared by the tokens, as they have common sub-grammars
+    _worker = (g, fuzzer, LanguageEnumerator(fuzzer), AlphabetIndex(g), token_to_alphabet, cache)
+
+def _generalize_token_worker(args):
+    global UNIQUE_ID, nt_ctr, WS_CTR, ws_set_to_id
+    nt, seed = args
+    g, fuzzer, enumerator, alphabet_index, token_to_alphabet, cache = _worker
+    if cache:
+        names = TokenCache.canonical_names(g, nt)
+        key = cache.key(g, nt, names, token_to_alphabet)
+        entry = cache.get(key)
+        if entry is not None:
+            log.debug("Token cache hit for %s", nt)
+            token_g, (unique_ids, nts, ws_sets) = entry
+            token_g = rename_nts(token_g, {canonical: _nt for _nt, canonical in names.items()})
+            return token_g, (unique_ids, nts, [tuple(ws_tup) for ws_tup in ws_sets]), True
+    UNIQUE_ID = nt_ctr = WS_CTR = 0
+    ws_set_to_id = {}
+    random.seed(seed ^ zlib.crc32(nt.encode('utf-8')))
+    token_g = generalize_token(g, nt, fuzzer, enumerator, alphabet_index, token_to_alphabet)
+    counters = (UNIQUE_ID, nt_ctr, list(ws_set_to_id))
+    if cache:
+        cache.put(key, [rename_nts(token_g, names), counters])
+    return token_g, counters, False
+
+def merge_token_grammar(g, new_g: dict, token_g: dict, counters):
+    # Adds token_g (from _generalize_token_worker) to new_g, with its new nonterminals
+    # numbered after the ones of the tokens merged before
+    global UNIQUE_ID, nt_ctr, WS_CTR, ws_set_to_id
+    unique_ids, nts, ws_sets = counters
+    ws_ids = {}
+    for local_id, ws_tup in enumerate(ws_sets, start=1):
+        if ws_tup not in ws_set_to_id:
+            WS_CTR += 1
+            ws_set_to_id[ws_tup] = WS_CTR
+        ws_ids[local_id] = ws_set_to_id[ws_tup]
+
+    def rename(_nt):
+        if _nt in g or _nt in pattern_grammar_nts:
+            return _nt
+        if _nt.startswith("<pre_ws_"):
+            return "<pre_ws_" + rename("<" + _nt[len("<pre_ws_"):])[1:]
+        if m := re_tok_nt.fullmatch(_nt):
+            return f"<toknt{nt_ctr + int(m.group(1))}>"
+        if m := re_ws_nt.fullmatch(_nt):
+            return f"<ws{ws_ids[int(m.group(1))]}_{m.group(2)}>"
+        m = re_refined_nt.fullmatch(_nt)
+        assert m and f"<{m.group(1)}>" in pattern_grammar_nts, f"Unexpected nonterminal in token grammar: {_nt}"
+        return f"<{m.group(1)}_{UNIQUE_ID + int(m.group(2))}>"
+
+    renames = {_nt: rename(_nt) for _nt in token_g}
+    UNIQUE_ID += unique_ids
+    nt_ctr += nts
+    new_g.update(rename_nts(token_g, renames))
+
+def build_token_grammar(g, token_grammars) -> dict:
+    # token_grammars: the results of _generalize_token_worker, in the order of the tokens in g
     new_g = {}
-
+    token_grammars = iter(token_grammars)
+    cached = 0
     for nt, rules in g.items():
         if not is_external_function(nt):
             new_g[nt] = rules
             continue
-
-        print("DBG: generalize_tokens of nt=", nt)
-    
-        inputs: set[str] = generate_inputs(fuzzer, nt)
-        ws_alphabet, ws_prefixes, stripped_inputs = strip_inputs(inputs)
-
-        # Case 1: concrete (keywords) w/ leading ws
-        # We require this *threshold* to distinguish this from "the odd space" originating from a <any_str>
-        if len(ws_prefixes) >= len(inputs)*config.WS_RATIO:
-            if len(stripped_inputs) <= GENERALIZATION_THRESHOLD:
-                new_g = {**new_g, **generalize_concrete_with_ws(nt, stripped_inputs, ws_alphabet)}
-                print("DBG: generalize_tokens of nt=", nt, "case 1")
-                continue
-
-        # Case 2: concrete (keywords) w/o leading ws
-        if len(inputs) <= GENERALIZATION_THRESHOLD:
-            new_g[nt] = rules
-            print(f"Did not generalize {nt} (<10 inputs). It remains: ", rules)
-            print("DBG: generalize_tokens of nt=", nt, "case 2")
-
-        # Case 3: abstract pattern
-        # Case 4: abstract pattern w/ leading ws
-        else:
-            new_g = {**new_g, **generalize_patterns(g, nt, inputs, ws_alphabet, ws_prefixes, token_to_alphabet)}
-            print("DBG: generalize_tokens of nt=", nt, "case 3")
-            assert nt in new_g
-
-
-    return new_g
\ No newline at end of file
+        token_g, counters, hit = next(token_grammars)
+        merge_token_grammar(g, new_g, token_g, counters)
+        if new_g[nt] != rules:
+            # Here, as the names in token_g are local to the token (see merge_token_grammar)
+            log.info("Generalized %s to %s", nt, new_g[nt][0][0])
+        cached += hit
+    if cached:
+        log.info("Took %d token generalizations from the token cache", cached)
+    return new_g
+
+def generalize_tokens(g, token_to_alphabet: dict = None, jobs: int = 1, cache: TokenCache = None):
+    # With jobs > 1, the external tokens are generalized in a pool of that many processes.
+    # The grammar is the same for any number of jobs.
+    global UNIQUE_ID, nt_ctr, WS_CTR, ws_set_to_id
+    externals = [nt for nt in g if is_external_function(nt)]
+    seed = random.getrandbits(32) # the tokens' seeds are derived from it
+    work = [(nt, seed) for nt in externals]
+    if jobs > 1 and len(externals) > 1:
+        chunksize = max(1, len(work) // (jobs * 16))
+        with multiprocessing.Pool(jobs, initializer=_init_worker, initargs=(g, token_to_alphabet, cache)) as pool:
+            new_g = build_token_grammar(g, pool.imap(_generalize_token_worker, work, chunksize=chunksize))
+        if cache: cache.evict()
+        return new_g
+
+    # As a pool worker would, but in this process
+    counters = (UNIQUE_ID, nt_ctr, WS_CTR, ws_set_to_id)
+    state = random.getstate()
+    _init_worker(g, token_to_alphabet, cache)
+    token_grammars = [_generalize_token_worker(w) for w in work]
+    UNIQUE_ID, nt_ctr, WS_CTR, ws_set_to_id = counters
+    random.setstate(state)
+    if cache: cache.evict()
+    return build_token_grammar(g, token_grammars)
@@ -1,6 +1,7 @@
 from bisect import bisect_right
 
-def longest_increasing_subsequence(nums):
+def longest_increasing_subsequence_indices(nums):
+    """Indices of the (non-decreasing) subsequence that longest_increasing_subsequence returns."""
     if not nums:
         return []
 
@@ -25,14 +26,17 @@ def longest_increasing_subsequence(nums):
             lis[pos] = i
 
     length_of_lis = len(dp)
-    lis_sequence = [0] * length_of_lis
+    lis_indices = [0] * length_of_lis
     k = lis[-1]
 
     for j in range(length_of_lis-1, -1, -1):
-        lis_sequence[j] = nums[k]
+        lis_indices[j] = k
         k = prev_indices[k]
 
-    return lis_sequence
+    return lis_indices
+
+def longest_increasing_subsequence(nums):
+    return [nums[i] for i in longest_increasing_subsequence_indices(nums)]
 
 def max_longest_increasing_subsequence(nums):
     if not nums:
@@ -1,20 +1,27 @@
 import random
 import json
+import logging
+import argparse
 
 import config
 
 from generalize_helpers import load_jsons
-from generalize_tokens import generalize_tokens
+from generalize_tokens import generalize_tokens, TokenCache
+from common import get_logger
+
+log = get_logger("mine_tokens")
 
 def build_token_dicts(d):
-    d_token_to_samples = {}
+    d_token_to_samples = {} # token id => distinct samples, in order
+    d_token_seen_samples = {} # token id => set of sample tuples, for de-duplication
     d_token_to_alphabet = {}
     for json_file_path, j in d.items():
-        print(json_file_path)
+        log.debug("%s", json_file_path)
         token_id = int(j["token_id"])
         del j["token_id"]
         if token_id not in d_token_to_samples:
             d_token_to_samples[token_id] = []
+            d_token_seen_samples[token_id] = set()
         if token_id not in d_token_to_alphabet:
             d_token_to_alphabet[token_id] = set()
 
@@ -42,13 +49,16 @@ def build_token_dicts(d):
             for c in solutions:
                 if c == 0: continue
                 d_token_to_alphabet[token_id].add(chr(c))
-        if chars not in d_token_to_samples[token_id]:
+        if tuple(chars) not in d_token_seen_samples[token_id]:
+            d_token_seen_samples[token_id].add(tuple(chars))
             d_token_to_samples[token_id].append(chars)
     return d_token_to_samples, d_token_to_alphabet
 
 class TokenMiner:
-    def __init__(self):
+    def __init__(self, jobs: int = 1, token_cache: TokenCache = None):
         self.log_file = "tokenklee.log"
+        self.jobs = jobs # for generalize_tokens
+        self.token_cache = token_cache
 
     def mine_grammar(self):
         d_letters = load_jsons('reads-letters/')
@@ -58,8 +68,9 @@ class TokenMiner:
         d = {**d_letters, **d_digits, **d_punctuation, **d_none}
 
         d_token_to_samples, d_token_to_alphabet = build_token_dicts(d)
-        print("debug: d_token_to_samples: ")
-        print(json.dumps(d_token_to_samples, indent=1), flush=True)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("debug: d_token_to_samples: ")
+            log.debug("%s", json.dumps(d_token_to_samples, indent=1))
 
         g = {}
         token_to_alphabet = {}
@@ -69,20 +80,27 @@ class TokenMiner:
             g[f"<TOK_{token_id}>"] = [[f"<__external_{token_id}>"]]
             token_to_alphabet[f"<__external_{token_id}>"] = d_token_to_alphabet[token_id]
 
-        g = generalize_tokens(g, token_to_alphabet)
+        g = generalize_tokens(g, token_to_alphabet, jobs=self.jobs, cache=self.token_cache)
         
         with open(config.token_grammar_json, "w") as f:
             json.dump(g, f, indent=1)
 
-        print(f"serialized token grammar to {config.token_grammar_json}")
+        log.info("serialized token grammar to %s", config.token_grammar_json)
         return g
 
     def mine(self):
         self.mine_grammar()
 
 def main():
-    print("Generating grammar from traces in reads-{letters,digits,punctuation,none}")
-    tm = TokenMiner()
+    parser = argparse.ArgumentParser(description='Mine the token grammar from the traces in reads-{letters,digits,punctuation,none}')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of worker processes that generalize tokens')
+    parser.add_argument('--token-cache', type=str, help='Directory of the token generalization cache, shared with traces_to_grammar.py')
+    parser.add_argument('--token-cache-size', type=int, default=256, help='Size limit of the token cache in MB')
+    args = parser.parse_args()
+
+    log.info("Generating grammar from traces in reads-{letters,digits,punctuation,none}")
+    token_cache = TokenCache(args.token_cache, args.token_cache_size << 20) if args.token_cache else None
+    tm = TokenMiner(args.jobs, token_cache)
     tm.mine_grammar()
 
 if __name__ == "__main__":
@@ -0,0 +1,244 @@
+import heapq
+from bisect import bisect_left
+
+from longest_inc_subseq import longest_increasing_subsequence, longest_increasing_subsequence_indices
+
+# Selecting one read per input position such that the read orders increase along the input.
+#
+# Both functions below take the read orders of a trace (int input position => read orders,
+# in the order of the reads) and the trace length, and return
+#   - the selected order per input position,
+#   - the (inp_pos, index into readorders/executioncontexts) each selected order comes from,
+#   - the positions whose read was replaced by the one of the predecessor position,
+#   - the positions whose last read(s) were dropped,
+#   - the positions that have no reads at all.
+# inp_pos_to_orders is modified in the same way by both: dropped reads are popped,
+# and positions without reads end up with the (fake) order taken from the predecessor.
+
+def repair_read_orders_naive(inp_pos_to_orders: dict, length: int):
+    """The original algorithm: recompute the LIS after every dropped read. O(n^2 log n)."""
+    fix_inp_pos_prev = set()
+    fix_inp_pos_bt = set()
+
+    order_to_inp_pos = {}
+    order_to_source = {} # order => (inp_pos, index into readorders/executioncontexts)
+    for inp_pos, read_orders in inp_pos_to_orders.items():
+        for i, order in enumerate(read_orders):
+            order_to_inp_pos[order] = inp_pos
+            order_to_source[order] = (inp_pos, i)
+
+    missing_positions = set()
+    lis = [] # Longest Increasing Subsequence
+    while True:
+        orders = []
+        for inp_pos in range(length):
+            if inp_pos not in inp_pos_to_orders:
+                missing_positions.add(inp_pos)
+            if inp_pos not in inp_pos_to_orders or \
+                inp_pos_to_orders[inp_pos] == []:
+                # This is not a re-read, we cannot "backtrack" to get a complete LIS
+                # Hence, we now have to set context of inp_pos to context of inp_pos-1.
+                assert inp_pos!=0
+                prev_orders = inp_pos_to_orders[inp_pos-1]
+                fake_orders = [prev_orders[-1] + 0.1] # this is now in order by construction
+                inp_pos_to_orders[inp_pos] = fake_orders
+                order_to_inp_pos[fake_orders[-1]] = inp_pos
+                order_to_source[fake_orders[-1]] = order_to_source[prev_orders[-1]]
+                fix_inp_pos_prev.add(inp_pos)
+            orders.append(inp_pos_to_orders[inp_pos][-1])
+
+        lis = longest_increasing_subsequence(orders)
+        if len(lis) == length:
+            # done
+            break
+        else:
+            odd = sorted(list(set(orders) - set(lis))) # "orders" which are not in lis
+            assert len(odd) > 0
+            inp_pos_to_orders[order_to_inp_pos[odd[0]]].pop()
+            fix_inp_pos_bt.add(order_to_inp_pos[odd[0]])
+
+    sources = [order_to_source[order] for order in lis]
+    return lis, sources, fix_inp_pos_prev, fix_inp_pos_bt, missing_positions
+
+class _OrderCollision(Exception):
+    pass
+
+def repair_read_orders(inp_pos_to_orders: dict, length: int):
+    """Same result as repair_read_orders_naive, but keeps the LIS up to date instead of
+    recomputing it after every dropped read.
+
+    The naive algorithm always drops the last read of the position p whose order is the
+    smallest one not on the LIS. If the order p falls back to lies between the orders of
+    its LIS neighbours, the next LIS is the current one plus p (bisect_right patience
+    sorting picks exactly that one), so we only insert p. Otherwise only the part of the
+    LIS between two separators around p is recomputed: a separator is an order that is
+    larger than all orders before it and smaller than all orders after it. The LIS that
+    patience sorting picks is the concatenation of the ones it picks for the parts
+    between separators, so the parts outside of the window stay the same."""
+    registered = set() # every order the naive algorithm would put into order_to_inp_pos
+    num_reads = 0
+    for read_orders in inp_pos_to_orders.values():
+        registered.update(read_orders)
+        num_reads += len(read_orders)
+    if len(registered) != num_reads:
+        # Duplicate orders: the naive algorithm resolves them through its dicts, keep its behavior
+        return repair_read_orders_naive(inp_pos_to_orders, length)
+    try:
+        return _repair_read_orders(inp_pos_to_orders, length, registered)
+    except _OrderCollision:
+        return repair_read_orders_naive(inp_pos_to_orders, length)
+
+def _repair_read_orders(inp_pos_to_orders: dict, length: int, registered: set):
+    fix_inp_pos_prev = set()
+    fix_inp_pos_bt = set()
+    missing_positions = set()
+
+    orders = [] # current order per input position
+    sources = [] # (inp_pos, index into readorders/executioncontexts) per input position
+    top = [] # index of the current read per input position, -1 if it was taken from the predecessor
+
+    def fake_order(inp_pos):
+        # Same as in the naive algorithm: the context of inp_pos-1, ordered right after it
+        assert inp_pos!=0
+        order = orders[inp_pos-1] + 0.1
+        if order in registered:
+            raise _OrderCollision()
+        registered.add(order)
+        fix_inp_pos_prev.add(inp_pos)
+        return order, sources[inp_pos-1]
+
+    for inp_pos in range(length):
+        read_orders = inp_pos_to_orders.get(inp_pos)
+        if read_orders is None:
+            missing_positions.add(inp_pos)
+        if read_orders:
+            top.append(len(read_orders) - 1)
+            orders.append(read_orders[-1])
+            sources.append((inp_pos, len(read_orders) - 1))
+        else:
+            order, source = fake_order(inp_pos)
+            top.append(-1)
+            orders.append(order)
+            sources.append(source)
+
+    lis = longest_increasing_subsequence_indices(orders) # indices into orders
+    on_lis = bytearray(length)
+    for i in lis:
+        on_lis[i] = 1
+    # Orders that are not on the LIS. Entries become stale when their position joins
+    # the LIS or gets a new order; they are skipped when popped.
+    odd = [(order, i) for i, order in enumerate(orders) if not on_lis[i]]
+    heapq.heapify(odd)
+    ranges = _RangeMinMax(orders)
+
+    def is_separator(i):
+        return ranges.max(0, i) < orders[i] < ranges.min(i+1, length)
+
+    while odd:
+        old_order, inp_pos = heapq.heappop(odd)
+        if on_lis[inp_pos] or orders[inp_pos] != old_order:
+            continue
+        # Drop the last read of the position with the smallest order that is not on the LIS
+        fix_inp_pos_bt.add(inp_pos)
+        if top[inp_pos] > 0:
+            top[inp_pos] -= 1
+            order = inp_pos_to_orders[inp_pos][top[inp_pos]]
+            source = (inp_pos, top[inp_pos])
+        else:
+            top[inp_pos] = -1
+            order, source = fake_order(inp_pos)
+        orders[inp_pos] = order
+        sources[inp_pos] = source
+        ranges.update(inp_pos, order)
+
+        i = bisect_left(lis, inp_pos)
+        if (i == 0 or orders[lis[i-1]] < order) and (i == len(lis) or order < orders[lis[i]]):
+            lis.insert(i, inp_pos)
+            on_lis[inp_pos] = 1
+            continue
+
+        # Recompute the LIS between the closest separators around inp_pos. The right one
+        # must also have been a separator before, so that the LIS after it did not change.
+        start = i - 1
+        while start >= 0 and not is_separator(lis[start]):
+            start -= 1
+        end = i
+        while end < len(lis) and not (old_order < orders[lis[end]] and is_separator(lis[end])):
+            end += 1
+        lo = lis[start] if start >= 0 else 0
+        hi = lis[end] + 1 if end < len(lis) else length
+
+        window = [lo + k for k in longest_increasing_subsequence_indices(orders[lo:hi])]
+        for k in lis[max(start, 0):end+1]:
+            on_lis[k] = 0
+        for k in window:
+            on_lis[k] = 1
+        lis[max(start, 0):end+1] = window
+        for k in range(lo, hi):
+            if not on_lis[k]:
+                heapq.heappush(odd, (orders[k], k)) # might duplicate an entry, which is harmless
+
+    # Leave inp_pos_to_orders as the naive algorithm does
+    for inp_pos in range(length):
+        if top[inp_pos] == -1:
+            inp_pos_to_orders[inp_pos] = [orders[inp_pos]]
+        else:
+            del inp_pos_to_orders[inp_pos][top[inp_pos]+1:]
+
+    return orders, sources, fix_inp_pos_prev, fix_inp_pos_bt, missing_positions
+
+class _RangeMinMax:
+    """Minimum and maximum of a range of a list, with point updates (two segment trees)."""
+    def __init__(self, values):
+        size = 1
+        while size < len(values):
+            size *= 2
+        self.size = size
+        self.mins = [float('inf')] * (2*size)
+        self.maxs = [float('-inf')] * (2*size)
+        self.mins[size:size+len(values)] = values
+        self.maxs[size:size+len(values)] = values
+        for k in range(size-1, 0, -1):
+            self.mins[k] = min(self.mins[2*k], self.mins[2*k+1])
+            self.maxs[k] = max(self.maxs[2*k], self.maxs[2*k+1])
+
+    def update(self, i, value):
+        k = self.size + i
+        self.mins[k] = self.maxs[k] = value
+        k //= 2
+        while k:
+            self.mins[k] = min(self.mins[2*k], self.mins[2*k+1])
+            self.maxs[k] = max(self.maxs[2*k], self.maxs[2*k+1])
+            k //= 2
+
+    def min(self, lo, hi):
+        # min(values[lo:hi])
+        result = float('inf')
+        lo += self.size
+        hi += self.size
+        while lo < hi:
+            if lo & 1:
+                result = min(result, self.mins[lo])
+                lo += 1
+            if hi & 1:
+                hi -= 1
+                result = min(result, self.mins[hi])
+            lo //= 2
+            hi //= 2
+        return result
+
+    def max(self, lo, hi):
+        # max(values[lo:hi])
+        result = float('-inf')
+        lo += self.size
+        hi += self.size
+        while lo < hi:
+            if lo & 1:
+                result = max(result, self.maxs[lo])
+                lo += 1
+            if hi & 1:
+                hi -= 1
+                result = max(result, self.maxs[hi])
+            lo //= 2
+            hi //= 2
+        return result
@@ -6,11 +6,13 @@ import time
 
 import config
 from typing import Union
-from common import put_can_parse, is_nt, tree_to_str, LimitFuzzer
-from generalize_helpers import serialize_grammar, load_json_file, replace_references
+from common import put_can_parse, is_nt, tree_to_str, LimitFuzzer, CompactGrammar, get_logger
+from generalize_helpers import serialize_grammar, load_json_file
 
 from fuzzingbook.Parser import IterativeEarleyParser
 
+log = get_logger("reduce_overapproximation")
+
 def replace_path(tree, path, new_node=None):
     if new_node is None: new_node = []
     if not path: return copy.deepcopy(new_node)
@@ -33,30 +35,30 @@ def alarm_handler(signum, frame):
     raise TimeoutException("Parse function timed out")
 
 def is_underapproximating(grammar, grammar_update, valid_inputs, valid_discriminating_inputs):
-    print("is_underapproximating called on grammar_update: ", grammar_update, flush=True)
+    log.debug("is_underapproximating called on grammar_update: %s", grammar_update)
     updated_grammar = {**grammar, **grammar_update}
     parser = IterativeEarleyParser(updated_grammar, canonical=True)
     timeouts = 0
     for i, inp in enumerate(valid_discriminating_inputs+valid_inputs):
-        print(f"is_underapproximating ({i}/{len(valid_discriminating_inputs+valid_inputs)}) trying to parse inp=", repr(inp), flush=True)
+        log.debug("is_underapproximating (%d/%d) trying to parse inp=%r", i, len(valid_discriminating_inputs)+len(valid_inputs), inp)
         signal.signal(signal.SIGALRM, alarm_handler)
         signal.alarm(config.parse_timeout_seconds)
         start = time.time()
         try:
             next(parser.parse(inp))
         except (SyntaxError, StopIteration):
-            print("is_underapproximating=True (could not parse  input: ", repr(inp), ")")
+            log.debug("is_underapproximating=True (could not parse  input: %r)", inp)
             valid_discriminating_inputs.append(inp)
             return True
         except TimeoutException:
-            print('Timeout, skip parsing of: ', inp, flush=True)
+            log.info("Timeout, skip parsing of: %s", inp)
             timeouts += 1
             if config.stop_after_k_timeouts == timeouts:
                 break
         finally:
             signal.alarm(0)
-            print("is_underapproximating; parsing of cur input took ", time.time() - start, " s")
-    print("is_underapproximating=False")
+            log.debug("is_underapproximating; parsing of cur input took %s s", time.time() - start)
+    log.debug("is_underapproximating=False")
     return False
 
 def replace_in_rule(replace, replace_with, rule):
@@ -70,21 +72,40 @@ def does_not_introduce_infinite_loop(node, ruleset):
             return True
     return False
 
-def dedup(grammar):
-    pruned_grammar = copy.deepcopy(grammar)
-
-    dup = {} # maps values to keys
-    for key, l_value in grammar.items():
-        value = tuple(tuple(l) for l in l_value)
-        if value not in dup:
-            dup[value] = key
-        else:
-            # ruleset already exists
-            del pruned_grammar[key]
-            existing_key = dup[value]
-            pruned_grammar = replace_references(pruned_grammar, replacee=key, replace_with=existing_key)
-
-    return pruned_grammar
+def minimize(grammar):
+    """Merges equivalent nonterminals, i.e. those with the same rules once equivalent
+    nonterminals are identified. As in DFA minimization, all nonterminals start in one
+    block, and blocks are split by their rules (with each nonterminal replaced by its block)
+    until no block splits any more. This does all merges of repeated passes over identical
+    rulesets in one go, plus the ones within recursion (e.g. <a> ::= x <a> and <b> ::= x <b>).
+    A block is kept as its first nonterminal (or <start>). The result keeps the input grammar
+    order, which is deterministic and leaves the serialized grammars diffable against the input."""
+    compact = CompactGrammar(grammar)
+    alternatives = [(code, compact.alternatives(code)) for code in compact.spans]
+    # code => block. Terminals (and undefined nts) keep ~code < 0, the blocks of the nts are >= 0.
+    block = [~code for code in range(len(compact.symbols) << 1)]
+    for code in compact.spans: block[code] = 0
+    count_blocks = 1
+    while True:
+        signatures = {}
+        new_block = block[:]
+        for code, rules in alternatives:
+            # Old block first, so that blocks are only ever split
+            signature = (block[code], tuple(tuple(map(block.__getitem__, rule)) for rule in rules))
+            new_block[code] = signatures.setdefault(signature, len(signatures))
+        block = new_block
+        if len(signatures) == count_blocks:
+            break
+        count_blocks = len(signatures)
+
+    start = compact.codes.get("<start>")
+    representative = {}
+    for code in compact.spans:
+        if block[code] not in representative or code == start:
+            representative[block[code]] = code
+    rename = {code: representative[block[code]] for code in compact.spans}
+    return {compact.name(code): [[compact.name(rename.get(tok, tok)) for tok in rule] for rule in rules]
+            for code, rules in alternatives if rename[code] == code}
 
 refinements = {}
 def refine_nt(nt: str):
@@ -103,7 +124,7 @@ def evaluate_rule_quality(grammar, node, fuzzer, orig_tree, path, put):
     for choice in range(len(grammar[node])):
         for i in range(config.k_subtrees):
             inp, subtree = fuzzer.fuzz(key=node, first_choice=choice)
-            new_tree = replace_path(copy.deepcopy(orig_tree), path, subtree)
+            new_tree = replace_path(orig_tree, path, subtree) # copies only the nodes on path
             if put_can_parse(put, tree_to_str(new_tree)):
                 rule_quality[choice] = (rule_quality[choice][0], rule_quality[choice][1] + 1)
     return rule_quality
@@ -133,7 +154,7 @@ class GrammarRefiner:
             try:
                 inp, tree = f.fuzz()
             except TimeoutException:
-                print('Timeout in generate_and_classify_inputs')
+                log.info("Timeout in generate_and_classify_inputs")
                 continue
             finally:
                 signal.alarm(0)
@@ -146,16 +167,16 @@ class GrammarRefiner:
                 valid.add(inp)
             i += 1
 
-        print("valid inputs: ", valid)
-        print("invalid inputs: ", invalid)
-        print(f"Precision ({len(valid)}/{len(valid)+len(invalid)})", flush=True)
+        log.debug("valid inputs: %s", valid)
+        log.debug("invalid inputs: %s", invalid)
+        log.info("Precision (%d/%d)", len(valid), len(valid)+len(invalid))
 
         return list(valid), list(invalid)
 
 
     def evaluate_and_refine_rule_alternatives(self, orig_tree, grammar, node, fuzzer, valid_inputs, path):
         rule_quality = evaluate_rule_quality(grammar, node, fuzzer, orig_tree, path, self.put)
-        print(f"Rule quality list for node {node}: {rule_quality}", flush=True)
+        log.debug("Rule quality list for node %s: %s", node, rule_quality)
 
         max_quality = max(rule_quality, key=lambda x: x[1])[1]
         best_rules = [rule for rule, quality in rule_quality if quality == max_quality]
@@ -170,7 +191,7 @@ class GrammarRefiner:
         else:
             refined_nt = refine_nt(node)
             refinement_grammar = {refined_nt: best_rules}
-            print(f"(cur node: {node}) returning best_rules: {best_rules}, all with quality {max_quality}", flush=True)
+            log.debug("(cur node: %s) returning best_rules: %s, all with quality %s", node, best_rules, max_quality)
             return RefinementResult(refinement_grammar, refined_nt, max_quality, False)
 
     def refine_in_parent_context(self, cur_tree, grammar, best_result, best_refinement_idx, valid_inputs):
@@ -202,7 +223,7 @@ class GrammarRefiner:
             path = []
         
         node, children = cur_tree
-        print("refine_bottomup called on node: ", node)
+        log.debug("refine_bottomup called on node: %s", node)
 
         # Recursion anchor: Terminals cannot be refined.
         if not is_nt(node):
@@ -217,7 +238,7 @@ class GrammarRefiner:
 
         # If we reach here, we have traversed all children, but refining the productions of the children did not yield a non-underapproximating refinement.
         # Here, we're checking if applying children refinements to the current node itself yields a non-underapproximating refinement.
-        print("Current root: ", node)
+        log.debug("Current root: %s", node)
         if best_refinements:
             best_refinement_idx = best_refinements.index(max(best_refinements, key=lambda x: x.quality))
             best_result = best_refinements[best_refinement_idx]
@@ -236,24 +257,20 @@ class GrammarRefiner:
         try:
             tree = next(parser.parse(inp))
         except TimeoutException:
-            print('Timeout in refine_grammar_for_input. Returning.')
+            log.info("Timeout in refine_grammar_for_input. Returning.")
             return None
         finally:
             signal.alarm(0)
 
         fuzzer = LimitFuzzer(grammar)
         tree = tree[1][0]
-        orig_tree = copy.deepcopy(tree)
+        orig_tree = tree # not modified by refine_bottomup
 
         refinement_grammar, refined_nt, max_quality, success = self.refine_bottomup(orig_tree, tree, grammar, fuzzer, inp, valid_inputs)
         if not success: return None
 
         refined_grammar = {**grammar, **refinement_grammar}
-        dedup_refined_grammar = refined_grammar
-        # dedup until no change
-        while (deduped := dedup(refined_grammar)) != dedup_refined_grammar:
-            dedup_refined_grammar = deduped
-        return dedup_refined_grammar
+        return minimize(refined_grammar)
 
     def refine_grammar_once(self, grammar: dict) -> Union[dict, None]:
         self.valid_discriminating_inputs = list(set(self.valid_discriminating_inputs))
@@ -261,18 +278,18 @@ class GrammarRefiner:
         current_precision = len(valid_inputs)/(len(valid_inputs)+len(invalid_inputs))
 
         if current_precision >= config.precision_threshold:
-            print("Reached precision >= config.precision_threshold -- Stopping.")
+            log.info("Reached precision >= config.precision_threshold -- Stopping.")
             return None
 
         l_valid_inputs = list(valid_inputs)
         l_valid_inputs.sort(key=len)
         invalid_inputs.sort(key=len)
         for inp in invalid_inputs[:config.k_shortest]:
-            print("Trying to refine based on input: ", repr(inp), flush=True)
+            log.info("Trying to refine based on input: %r", inp)
             refined_grammar = self.refine_grammar_for_input(grammar, inp, l_valid_inputs)
             if refined_grammar: return refined_grammar
 
-        print("Unable to find refineable input", flush=True)
+        log.info("Unable to find refineable input")
         return None
 
     def refine_grammar(self):
@@ -286,7 +303,7 @@ class GrammarRefiner:
                time.time() - start < config.max_refinement_time_seconds):
             refinements += 1
             if refinements: serialize_grammar(grammar, f"refined_grammar_{refinements}.json")
-            print("Refinements: ", refinements, flush=True)
+            log.info("Refinements: %d", refinements)
             final_grammar = grammar
             grammar = self.refine_grammar_once(grammar)
 
@@ -295,7 +312,7 @@ class GrammarRefiner:
         if self.output_grammar_file:
             serialize_grammar(final_grammar, self.output_grammar_file)
 
-        print(f"Final grammar after {refinements} refinements and {time.time() - start} seconds serialized.", flush=True)
+        log.info("Final grammar after %d refinements and %s seconds serialized.", refinements, time.time() - start)
 
 
 def main():
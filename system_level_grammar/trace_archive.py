@@ -0,0 +1,294 @@
+import os
+import sys
+import mmap
+import json
+import struct
+import hashlib
+import argparse
+import contextlib
+
+from generalize_helpers import list_files_in_directory, load_json_file, iter_json_object_items, load_json_value_at
+
+# Packed trace archive: all traces of a reads/ directory in a single file.
+#
+# Layout (little endian):
+#   header:  MAGIC, u64 string table offset, u64 index offset, u64 trace count
+#   records: one per trace, see _write_record
+#   strings: u32 count, then (u32 length, utf-8 bytes) per string
+#   index:   (u32 name string id, u64 record offset, u32 digest string id) per trace, sorted by name
+#
+# Call sites, callees, loop headers, trace names and digests (file_digest of the trace files)
+# are interned in the string table, records refer to them by id. Read orders, iteration counts
+# and solutions are stored as integers.
+
+MAGIC = b"STLGTRC2" # "STLGTRC" and the format version
+
+HEADER = struct.Struct('<8sQQQ')
+U32 = struct.Struct('<I')
+POSITION = struct.Struct('<II') # input position, number of reads
+READ = struct.Struct('<QI') # readorder, number of frames
+FRAME = struct.Struct('<III') # callsite id, callee id, number of loop iterations
+LOOP = struct.Struct('<II') # loopheader id, iterationcount
+INDEX_ENTRY = struct.Struct('<IQI')
+
+def check_magic(path, magic: bytes):
+    assert magic == MAGIC, f"{path} is a trace archive of another format version, re-pack the traces (trace_archive.py)"
+
+def is_trace_archive(path) -> bool:
+    if not os.path.isfile(path):
+        return False
+    with open(path, 'rb') as f:
+        magic = f.read(len(MAGIC))
+    if not magic.startswith(MAGIC[:-1]):
+        return False
+    check_magic(path, magic)
+    return True
+
+def file_digest(path) -> str:
+    # Identifies a trace by its content: KLEE numbers the trace files from 0 on every run
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        while chunk := f.read(1 << 20):
+            h.update(chunk)
+    return h.hexdigest()
+
+def bytes_digest(data) -> str:
+    # file_digest of a file with content data
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+class _StringTable:
+    def __init__(self):
+        self.ids = {}
+        self.strings = []
+
+    def intern(self, s: str) -> int:
+        if s not in self.ids:
+            self.ids[s] = len(self.strings)
+            self.strings.append(s)
+        return self.ids[s]
+
+def _write_record(out, j: dict, strings: _StringTable):
+    out.write(U32.pack(len(j)))
+    for inp_pos in sorted(int(k) for k in j.keys()):
+        entry = j[str(inp_pos)]
+        read_orders = entry["readorders"]
+        execution_contexts = entry["executioncontexts"]
+        assert len(read_orders) == len(execution_contexts)
+        out.write(POSITION.pack(inp_pos, len(read_orders)))
+        for order, execution_context in zip(read_orders, execution_contexts):
+            assert isinstance(order, int), f"read order {order!r} is not an integer"
+            out.write(READ.pack(order, len(execution_context)))
+            for frame in execution_context:
+                loopiterations = frame["loopiterations"]
+                out.write(FRAME.pack(strings.intern(frame["callsite"]), strings.intern(frame["callee"]), len(loopiterations)))
+                for loopiteration in loopiterations:
+                    out.write(LOOP.pack(strings.intern(loopiteration["loopheader"]), loopiteration["iterationcount"]))
+        solutions = entry["solutions"]
+        out.write(U32.pack(len(solutions)))
+        out.write(struct.pack(f'<{len(solutions)}I', *solutions))
+
+def pack_traces(directory, archive_path):
+    strings = _StringTable()
+    index = []
+    with open(archive_path, 'wb') as out:
+        out.write(HEADER.pack(MAGIC, 0, 0, 0))
+        for name in sorted(list_files_in_directory(directory)):
+            path = os.path.join(directory, name)
+            j = load_json_file(path)
+            index.append((strings.intern(name), out.tell(), strings.intern(file_digest(path))))
+            _write_record(out, j, strings)
+
+        strings_offset = out.tell()
+        out.write(U32.pack(len(strings.strings)))
+        for s in strings.strings:
+            b = s.encode('utf-8')
+            out.write(U32.pack(len(b)))
+            out.write(b)
+
+        index_offset = out.tell()
+        for name_id, offset, digest_id in index:
+            out.write(INDEX_ENTRY.pack(name_id, offset, digest_id))
+
+        out.seek(0)
+        out.write(HEADER.pack(MAGIC, strings_offset, index_offset, len(index)))
+    print(f"Packed {len(index)} traces from {directory} into {archive_path}")
+
+class TraceArchive:
+    """Read-only view of a packed trace archive. Records are decoded directly from an mmap of the file."""
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, 'rb')
+        self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, strings_offset, index_offset, count = HEADER.unpack_from(self.mm, 0)
+        check_magic(path, magic)
+
+        (num_strings,) = U32.unpack_from(self.mm, strings_offset)
+        off = strings_offset + U32.size
+        self.strings = []
+        for _ in range(num_strings):
+            (length,) = U32.unpack_from(self.mm, off)
+            off += U32.size
+            self.strings.append(str(self.mm[off:off+length], 'utf-8'))
+            off += length
+
+        self.offsets = {}
+        self.digests = {} # name => file_digest of the trace file
+        with memoryview(self.mm) as view:
+            for name_id, offset, digest_id in INDEX_ENTRY.iter_unpack(view[index_offset:index_offset + count*INDEX_ENTRY.size]):
+                self.offsets[self.strings[name_id]] = offset
+                self.digests[self.strings[name_id]] = self.strings[digest_id]
+
+    def __reduce__(self):
+        # Pickled into pool workers (and back); each process maps the archive once.
+        return (open_trace_archive, (self.path,))
+
+    def names(self) -> list[str]:
+        return sorted(self.offsets.keys())
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def close(self):
+        self.mm.close()
+        self.f.close()
+
+    def _decode_position(self, off):
+        mm = self.mm
+        strings = self.strings
+        inp_pos, num_reads = POSITION.unpack_from(mm, off)
+        off += POSITION.size
+        read_orders = []
+        execution_contexts = []
+        for _ in range(num_reads):
+            order, num_frames = READ.unpack_from(mm, off)
+            off += READ.size
+            execution_context = []
+            for _ in range(num_frames):
+                callsite_id, callee_id, num_loops = FRAME.unpack_from(mm, off)
+                off += FRAME.size
+                loopiterations = []
+                for _ in range(num_loops):
+                    loopheader_id, iterationcount = LOOP.unpack_from(mm, off)
+                    off += LOOP.size
+                    loopiterations.append({"loopheader": strings[loopheader_id], "iterationcount": iterationcount})
+                execution_context.append({"callsite": strings[callsite_id], "callee": strings[callee_id], "loopiterations": loopiterations})
+            read_orders.append(order)
+            execution_contexts.append(execution_context)
+        (num_solutions,) = U32.unpack_from(mm, off)
+        off += U32.size
+        solutions = list(struct.unpack_from(f'<{num_solutions}I', mm, off))
+        off += 4*num_solutions
+        entry = {"readorders": read_orders, "executioncontexts": execution_contexts, "solutions": solutions}
+        return inp_pos, entry, off
+
+    def iter_positions(self, name):
+        # Yields (inp_pos, entry, offset); entry has the same shape as in the JSON trace files.
+        off = self.offsets[name]
+        (num_positions,) = U32.unpack_from(self.mm, off)
+        off += U32.size
+        for _ in range(num_positions):
+            inp_pos, entry, next_off = self._decode_position(off)
+            yield inp_pos, entry, off
+            off = next_off
+
+    def load_position_at(self, offset) -> dict:
+        return self._decode_position(offset)[1]
+
+    def position_loader(self, name):
+        # Context manager that gives a function offset => entry (offsets from iter_positions)
+        return contextlib.nullcontext(self.load_position_at)
+
+    def load(self, name) -> dict:
+        # Same shape as load_json_file on the original trace file
+        return {str(inp_pos): entry for inp_pos, entry, _ in self.iter_positions(name)}
+
+    def digest(self, name) -> str:
+        return self.digests[name]
+
+    def load_with_digest(self, name):
+        # See TraceDirectory.load_with_digest
+        return self.load(name), (None, self.digests[name])
+
+    def add_digest(self, name, entry):
+        pass # the digests are in the index
+
+    def describe(self, name) -> str:
+        return f"{self.path}:{name}"
+
+class TraceDirectory:
+    """A directory with one JSON file per trace, as written by KLEE (reads/).
+    Offers the same interface as TraceArchive."""
+    def __init__(self, path):
+        self.path = path
+        self.digests = {} # name => ((size, mtime), file_digest), so unchanged files are hashed once
+
+    def __reduce__(self):
+        # Pickled into pool workers with every trace, so leave the digests behind
+        return (TraceDirectory, (self.path,))
+
+    def names(self) -> list[str]:
+        return sorted(list_files_in_directory(self.path))
+
+    def digest(self, name) -> str:
+        path = self.describe(name)
+        st = os.stat(path)
+        stat = (st.st_size, st.st_mtime_ns)
+        cached = self.digests.get(name)
+        if cached is None or cached[0] != stat:
+            cached = self.digests[name] = (stat, file_digest(path))
+        return cached[1]
+
+    def load_with_digest(self, name):
+        # The trace and its digest from a single read of the file. The digest comes as the
+        # entry ((size, mtime), file_digest) for add_digest, e.g. in the main process after
+        # a pool worker loaded the trace.
+        with open(self.describe(name), 'rb') as f:
+            st = os.fstat(f.fileno())
+            data = f.read()
+        entry = ((st.st_size, st.st_mtime_ns), bytes_digest(data))
+        self.add_digest(name, entry)
+        return json.loads(data), entry
+
+    def add_digest(self, name, entry):
+        self.digests[name] = entry
+
+    def iter_positions(self, name):
+        for key, entry, offset in iter_json_object_items(self.describe(name)):
+            yield int(key), entry, offset
+
+    @contextlib.contextmanager
+    def position_loader(self, name):
+        with open(self.describe(name), 'rb') as f:
+            yield lambda offset: load_json_value_at(f, offset)
+
+    def load(self, name) -> dict:
+        return load_json_file(self.describe(name))
+
+    def describe(self, name) -> str:
+        return os.path.join(self.path, name)
+
+def open_traces(path):
+    # A trace directory or a trace archive
+    if is_trace_archive(path):
+        return open_trace_archive(path)
+    return TraceDirectory(path)
+
+_open_archives = {}
+def open_trace_archive(path) -> TraceArchive:
+    if path not in _open_archives:
+        _open_archives[path] = TraceArchive(path)
+    return _open_archives[path]
+
+def main():
+    parser = argparse.ArgumentParser(description='Pack a directory of trace files into a single trace archive')
+    parser.add_argument('directory', type=str, help='The trace directory (e.g. reads/)')
+    parser.add_argument('archive', type=str, help='The archive file to write')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.directory):
+        print(f"{args.directory} is not a directory")
+        sys.exit(1)
+    pack_traces(args.directory, args.archive)
+
+if __name__ == "__main__":
+    main()
@@ -3,23 +3,37 @@ import os
 import json
 import argparse
 import re
-import ast
+import logging
+import time
+import hashlib
+import random
+import multiprocessing
 
 from pprint import pprint
 
 from fuzzingbook.GrammarFuzzer import display_tree
 
 from generalize_tidy import inline_single_rules_and_opt_generalization
-from generalize_helpers import unreachable_nonterminals, load_json_file, serialize_grammar
-from generalize_tokens import generalize_tokens
+from generalize_helpers import unreachable_nonterminals, serialize_grammar, load_json_file, GrammarBuilder
+from trace_archive import open_traces
+from generalize_tokens import generalize_tokens, TokenCache
 
-from longest_inc_subseq import longest_increasing_subsequence
+from read_orders import repair_read_orders
+from common import get_logger, setup_logging
+
+log = get_logger("traces_to_grammar")
 
 CTX_NONE = 0
 CTX_COARSE = 1
 CTX_FINE = 2
 CTX_WINDOW = 3
-WINDOW_SIZE = 5
+WINDOW_SIZE = 5 # default for CTX_WINDOW, see --window-sizes
+
+# --watch: seconds between two looks at the trace directory, and the events in the
+# timestamps file that tell us that KLEE started and is done (see subjects/common.mk)
+WATCH_POLL_INTERVAL = 5
+WATCH_START_EVENT = "start_parser_symex"
+WATCH_END_EVENT = "end_parser_symex"
 
 count_traces = 0
 count_fixed_traces = 0
@@ -33,17 +47,40 @@ def prune_external(executioncontext):
         return executioncontext[:-1]
     return executioncontext
 
+def order_reads(inp_pos_to_orders: dict, length: int):
+    """Selects one read order per input position such that the orders are increasing.
+    inp_pos_to_orders maps (int) input positions to their read orders and is modified.
+    Returns the final orders, the (inp_pos, read index) whose execution context each final
+    order uses, and the fixed and missing input positions."""
+    lis, sources, fix_inp_pos_prev, fix_inp_pos_bt, missing_positions = repair_read_orders(inp_pos_to_orders, length)
+
+    log.debug("order_trace -- fixed inp indices (set to predecessor ctx [i-1]): %s", fix_inp_pos_prev)
+    log.debug("order_trace -- fixed inp indices (set to previous read [pop]): %s", fix_inp_pos_bt)
+
+    global count_fixed_traces, count_fixed_positions
+    if fix_inp_pos_bt or fix_inp_pos_prev:
+        count_fixed_traces += 1
+    count_fixed_positions += len(fix_inp_pos_prev.union(fix_inp_pos_bt))
+
+    log.debug("final orders: %s", lis)
+
+    return lis, sources, fix_inp_pos_prev | fix_inp_pos_bt, missing_positions
+
+def select_execution_context(i, execution_context, fixed_positions):
+    if i in fixed_positions:
+        pruned_execution_context = prune_external(execution_context)
+        log.debug("Pruned call stack of input position %d", i)
+        log.debug("From: %s", execution_context)
+        log.debug("To:   %s", pruned_execution_context)
+        log.debug("Change?: %s", execution_context != pruned_execution_context)
+        return pruned_execution_context
+    return execution_context
+
 def order_trace(j: dict, all_scc):
     orig = {} # Trace with last reads only (for debugging)
     oj = {} # Ordered trace
 
-    # For statistics:
-    fix_inp_pos_prev = set()
-    fix_inp_pos_bt = set()
-
     # Note: All data structures != {oj,j,orig} use an *int* key.
-    order_to_inp_pos = {}
-    order_to_call_stack = {}
     inp_pos_to_orders = {}
 
     for inp_pos in sorted([int(k) for k in j.keys()]):
@@ -57,65 +94,14 @@ def order_trace(j: dict, all_scc):
             "solutions": solutions
         }
 
-        for i, order in enumerate(read_orders):
-            order_to_inp_pos[order] = inp_pos
-            order_to_call_stack[order] = execution_contexts[i]
-
         inp_pos_to_orders[inp_pos] = read_orders
-    
-    missing_positions = set()
-    lis = [] # Longest Increasing Subsequence
-    while True:
-        orders = []
-        for inp_pos in range(len(j)):
-            if inp_pos not in inp_pos_to_orders:
-                missing_positions.add(inp_pos)
-            if inp_pos not in inp_pos_to_orders or \
-                inp_pos_to_orders[inp_pos] == []:
-                # This is not a re-read, we cannot "backtrack" to get a complete LIS
-                # Hence, we now have to set context of inp_pos to context of inp_pos-1.
-                assert inp_pos!=0
-                prev_orders = inp_pos_to_orders[inp_pos-1]
-                fake_orders = [prev_orders[-1] + 0.1] # this is now in order by construction
-                inp_pos_to_orders[inp_pos] = fake_orders
-                order_to_inp_pos[fake_orders[-1]] = inp_pos
-                order_to_call_stack[fake_orders[-1]] = order_to_call_stack[prev_orders[-1]]
-                fix_inp_pos_prev.add(inp_pos)
-            orders.append(inp_pos_to_orders[inp_pos][-1])
-
-        lis = longest_increasing_subsequence(orders)
-        print("lis: ", lis)
-        if len(lis) == len(j):
-            # done
-            break
-        else:
-            odd = sorted(list(set(orders) - set(lis))) # "orders" which are not in lis
-            assert len(odd) > 0
-            inp_pos_to_orders[order_to_inp_pos[odd[0]]].pop()
-            fix_inp_pos_bt.add(order_to_inp_pos[odd[0]])
-    
-    print("order_trace -- fixed inp indices (set to predecessor ctx [i-1]): ", fix_inp_pos_prev)
-    print("order_trace -- fixed inp indices (set to previous read [pop]): ", fix_inp_pos_bt)
-
-    global count_fixed_traces, count_fixed_positions
-    if fix_inp_pos_bt or fix_inp_pos_prev:
-        count_fixed_traces += 1
-    count_fixed_positions += len(fix_inp_pos_prev.union(fix_inp_pos_bt))
 
-    print("final orders: ", lis)
+    lis, sources, fixed_positions, missing_positions = order_reads(inp_pos_to_orders, len(j))
 
     for i, order in enumerate(lis):
         key = str(i)
-        if i in fix_inp_pos_bt or i in fix_inp_pos_prev:
-            orig_execution_context = order_to_call_stack[order]
-            pruned_execution_context = prune_external(orig_execution_context)
-            execution_context = pruned_execution_context
-            print("Pruned call stack of input position ", i)
-            print("From: ", orig_execution_context)
-            print("To:   ", pruned_execution_context)
-            print("Change?: ", orig_execution_context != pruned_execution_context)
-        else:
-            execution_context = order_to_call_stack[order]
+        src_pos, src_idx = sources[i]
+        execution_context = select_execution_context(i, j[str(src_pos)]["executioncontexts"][src_idx], fixed_positions)
 
         if all_scc:
             assert False, "Not implemented"
@@ -138,7 +124,7 @@ OUTPUT_ORDERED_TRACES = False
 
 class ExecutionTrace:
     def __init__(self, j: dict, all_scc: list, trace_fname):
-        print("Processing: ", trace_fname)
+        log.info("Processing: %s", trace_fname)
         global count_traces
         count_traces += 1
         self.d_inp_pos_to_trace = {}
@@ -155,6 +141,161 @@ class ExecutionTrace:
 
     def get(self):
         return self.ordered_trace
+
+    def __len__(self):
+        return len(self.ordered_trace)
+
+    def positions(self):
+        # (readorder, executioncontext, solutions) for each input position, in input order
+        for inp_pos in sorted(self.ordered_trace.keys(), key=lambda x: int(x)):
+            entry = self.ordered_trace[inp_pos]
+            yield entry["readorder"], entry["executioncontext"], entry["solutions"]
+
+    def fingerprints(self, isTokenCursor, callsite_modes) -> dict:
+        """Digests of what ExecutionTree.add_trace uses from the ordered trace: per input position
+        the call stack (with call sites or not, for each of callsite_modes) and the terminal set.
+        Traces with equal fingerprints yield the same execution tree, so merging more than one
+        of them does not change the grammar. Returns with_callsites => fingerprint."""
+        digests = {with_callsites: hashlib.blake2b(digest_size=16) for with_callsites in callsite_modes}
+        last = len(self) - 1
+        for i, (order, execution_context, solutions) in enumerate(self.positions()):
+            if i == last and solutions == [0]:
+                solutions = [] # as in add_trace
+            solutions_hash = solutions_digest(solutions, isTokenCursor)
+            for with_callsites, h in digests.items():
+                h.update(context_digest(execution_context, with_callsites))
+                h.update(solutions_hash)
+        return {with_callsites: h.hexdigest() for with_callsites, h in digests.items()}
+
+class StreamingExecutionTrace(ExecutionTrace):
+    """Like ExecutionTrace, but never holds the whole trace in memory.
+    A first pass over the file keeps only the read orders (and the file offset)
+    of each input position and orders them; positions() then decodes just the
+    entries needed for each input position, one at a time. The first pass also keeps the
+    digests that fingerprints() needs (see context_digest), so it needs no pass of its own."""
+    def __init__(self, all_scc: list, traces, name):
+        self.trace_fname = traces.describe(name)
+        log.info("Processing: %s", self.trace_fname)
+        global count_traces
+        count_traces += 1
+        self.traces = traces
+        self.name = name
+        self.all_scc = all_scc
+        assert not OUTPUT_ORDERED_TRACES, "not supported for streamed traces"
+
+        inp_pos_to_orders = {}
+        self.offsets = {}
+        self.context_digests = {} # inp_pos => per read (full, pruned) digests without and with call sites
+        self.solutions_digests = {} # inp_pos => (digests without and with token cursor, solutions == [0])
+        for inp_pos, entry, offset in traces.iter_positions(name):
+            inp_pos_to_orders[inp_pos] = entry["readorders"]
+            self.offsets[inp_pos] = offset
+            self.context_digests[inp_pos] = [tuple(context_digest(ctx, with_callsites) for with_callsites in (False, True) for ctx in (execution_context, prune_external(execution_context) if execution_context else execution_context))
+                                             for execution_context in entry["executioncontexts"]]
+            solutions = entry["solutions"]
+            self.solutions_digests[inp_pos] = (solutions_digest(solutions, False), solutions_digest(solutions, True), solutions == [0])
+        self.length = len(self.offsets)
+
+        self.orders, self.sources, self.fixed_positions, self.missing_positions = order_reads(inp_pos_to_orders, self.length)
+        if self.orders and all_scc:
+            assert False, "Not implemented"
+        assert len(self.orders) == self.length, "max lis does not include all input positions!"
+
+    def get(self):
+        return dict((str(i), {"readorder": order, "executioncontext": execution_context, "solutions": solutions})
+                    for i, (order, execution_context, solutions) in enumerate(self.positions()))
+
+    def __len__(self):
+        return self.length
+
+    def positions(self):
+        with self.traces.position_loader(self.name) as load_position:
+            for i, order in enumerate(self.orders):
+                src_pos, src_idx = self.sources[i]
+                entry = load_position(self.offsets[src_pos])
+                execution_context = select_execution_context(i, entry["executioncontexts"][src_idx], self.fixed_positions)
+                if i in self.missing_positions:
+                    solutions = [a for a in range(1, 256)]
+                else:
+                    if src_pos != i:
+                        entry = load_position(self.offsets[i])
+                    solutions = entry["solutions"]
+                yield order, execution_context, solutions
+
+    def fingerprints(self, isTokenCursor, callsite_modes) -> dict:
+        # As ExecutionTrace.fingerprints, from the digests of the first pass
+        missing_solutions = solutions_digest(range(1, 256), isTokenCursor)
+        empty_solutions = solutions_digest([], isTokenCursor)
+        digests = {with_callsites: hashlib.blake2b(digest_size=16) for with_callsites in callsite_modes}
+        for i in range(self.length):
+            src_pos, src_idx = self.sources[i]
+            context_digests = self.context_digests[src_pos][src_idx]
+            pruned = i in self.fixed_positions
+            if i in self.missing_positions:
+                solutions_hash = missing_solutions
+            else:
+                *by_token_cursor, is_zero = self.solutions_digests[i]
+                solutions_hash = empty_solutions if i == self.length - 1 and is_zero else by_token_cursor[isTokenCursor]
+            for with_callsites, h in digests.items():
+                h.update(context_digests[2*with_callsites + pruned])
+                h.update(solutions_hash)
+        return {with_callsites: h.hexdigest() for with_callsites, h in digests.items()}
+
+def context_digest(execution_context, with_callsites: bool) -> bytes:
+    # What ExecutionTree.add_trace uses from a call stack; only CTX_NONE leaves out the call sites
+    parts = []
+    for frame in execution_context:
+        parts.append(frame["callee"])
+        if with_callsites:
+            parts.append(frame["callsite"])
+        for loopiteration in frame["loopiterations"]:
+            parts.append(loopiteration["loopheader"])
+            parts.append(str(loopiteration["iterationcount"]))
+    return hashlib.blake2b("\x1f".join(parts).encode('utf-8'), digest_size=16).digest()
+
+def solutions_digest(solutions, isTokenCursor) -> bytes:
+    if not isTokenCursor:
+        solutions = [s for s in solutions if s != 0] # as in terminal_symbols
+    return hashlib.blake2b(",".join(map(str, sorted(solutions))).encode('utf-8'), digest_size=16).digest()
+
+def trace_fingerprints(et: ExecutionTrace, ctx_modes: list, isTokenCursor) -> list:
+    # One per (ctx_mode, window size), computed together
+    fingerprints = et.fingerprints(isTokenCursor, {ctx_mode != CTX_NONE for ctx_mode, _ in ctx_modes})
+    return [fingerprints[ctx_mode != CTX_NONE] for ctx_mode, _ in ctx_modes]
+
+def load_execution_trace(traces, name, all_scc, stream=False):
+    log.debug("Loading %s", traces.describe(name))
+    if stream:
+        return StreamingExecutionTrace(all_scc, traces, name)
+    j = traces.load(name)
+    return ExecutionTrace(j, all_scc, traces.describe(name))
+
+def load_execution_trace_with_digest(traces, name, all_scc, stream=False):
+    # Also returns the digest entry of the trace (see TraceDirectory.load_with_digest),
+    # from the same read of the file. A streamed trace is hashed separately.
+    if stream:
+        return load_execution_trace(traces, name, all_scc, stream), (None, traces.digest(name))
+    log.debug("Loading %s", traces.describe(name))
+    j, digest = traces.load_with_digest(name)
+    return ExecutionTrace(j, all_scc, traces.describe(name)), digest
+
+def _load_execution_trace_worker(args):
+    # Runs in a pool worker. The statistics counters are process-local,
+    # so we reset them and hand their increments back with the trace.
+    global count_traces, count_fixed_traces, count_fixed_positions
+    count_traces = count_fixed_traces = count_fixed_positions = 0
+    traces, name, all_scc, stream, ctx_modes, isTokenCursor, retry_incomplete, with_digest = args
+    digest = None
+    try:
+        if with_digest:
+            exec_trace, digest = load_execution_trace_with_digest(traces, name, all_scc, stream)
+        else:
+            exec_trace = load_execution_trace(traces, name, all_scc, stream)
+    except json.JSONDecodeError:
+        if not retry_incomplete: raise
+        return None # still being written, see ExecutionForest.watch
+    fingerprints = trace_fingerprints(exec_trace, ctx_modes, isTokenCursor)
+    return exec_trace, fingerprints, (count_traces, count_fixed_traces, count_fixed_positions), digest
     
 
 re_loop_node = re.compile(r'<(.+)@(\d+)_L(\d+)>')
@@ -165,6 +306,25 @@ re_iteration_node = re.compile(r'<(.+)@(\d)+_L(\d+):I(\d+)>')
 def is_iteration(s):
     return re.match(re_iteration_node, s) != None
 
+# Names of call (and loop) symbols: <callee@ctx>, <callee@ctx_L{loop}>, <callee@ctx_L{loop}:I{k}>,
+# <callee@ctx_L{loop}_cont>, <callee@ctx_L{loop}_exit>; and terminal symbols <__T{t}>
+re_call_name = re.compile(r'<(.+)@(\d+)(?:_L(\d+)(:I\d+|_cont|_exit)?)?>$')
+re_terminal_name = re.compile(r'<__T(\d+)>$')
+
+def rename_symbol(s, ctx_map, loop_map, terminal_map):
+    # Renumbers the ctx, loop and terminal ids in the name s; other symbols stay as they are
+    m = re_terminal_name.match(s)
+    if m:
+        return f"<__T{terminal_map[int(m.group(1))]}>"
+    m = re_call_name.match(s)
+    if m:
+        callee, ctx, loop, suffix = m.groups()
+        name = f"<{callee}@{ctx_map[(callee, int(ctx))]}"
+        if loop is not None:
+            name += f"_L{loop_map[(callee, int(loop))]}{suffix or ''}"
+        return name + ">"
+    return s
+
 def get_iteration(s):
     m = re.match(re_iteration_node, s)
     assert m
@@ -172,13 +332,100 @@ def get_iteration(s):
 
 # => Assumption: Every call is unique (json_parse_value@1 etc.).
 # We do this with caller instructions as context, simplified with d_simplify_ctx.
+class SymbolTable:
+    """Integer ids for the nodes of execution trees.
+
+    Trees are built from these ids; their names (as they appear in the grammar) are only
+    built once per symbol, by name(). The ids of call nodes, loops, iterations and terminal
+    sets are cached here, so the naming dicts (d_simplify_ctx etc.) are only consulted the
+    first time a symbol is seen. One table is shared by all trees of a forest."""
+    CALL = 0 # (CALL, callee, ctx id)
+    LOOP = 1 # (LOOP, callee, ctx id, loop id)
+    ITERATION = 2 # (ITERATION, callee, ctx id, loop id, iteration count)
+    TERMINAL = 3 # (TERMINAL, terminal id)
+    SOLUTIONS = 4 # (SOLUTIONS, sorted solutions)
+
+    def __init__(self):
+        self.ids = {}
+        self.keys = []
+        self.names = []
+        # Caches for ExecutionTree.add_trace
+        self.ctx_paths = {} # (parent ctx path id, callsite) => ctx path id
+        self.calls = {} # (callee, ctx) => symbol
+        self.loops = {} # (call symbol, loopheader) => symbol
+        self.iterations = {} # (loop symbol, iteration count) => symbol
+        self.terminals = {} # solutions (as in the trace) => (terminal symbol, solutions symbol)
+
+    def intern(self, key: tuple) -> int:
+        sym = self.ids.get(key)
+        if sym is None:
+            sym = self.ids[key] = len(self.keys)
+            self.keys.append(key)
+            self.names.append(None)
+        return sym
+
+    def kind(self, sym: int) -> int:
+        return self.keys[sym][0]
+
+    def key(self, sym: int) -> tuple:
+        return self.keys[sym]
+
+    def name(self, sym: int) -> str:
+        name = self.names[sym]
+        if name is None:
+            key = self.keys[sym]
+            kind = key[0]
+            if kind == SymbolTable.CALL:
+                name = f"<{key[1]}@{key[2]}>"
+            elif kind == SymbolTable.LOOP:
+                name = f"<{key[1]}@{key[2]}_L{key[3]}>"
+            elif kind == SymbolTable.ITERATION:
+                name = f"<{key[1]}@{key[2]}_L{key[3]}:I{key[4]}>"
+            elif kind == SymbolTable.TERMINAL:
+                name = f"<__T{key[1]}>"
+            else:
+                name = str(list(key[1])) # string repr of list of possible terminals
+            self.names[sym] = name
+        return name
+
+    def named_tree(self, tree):
+        if not tree:
+            return tree
+        node, children = tree
+        return (self.name(node), [self.named_tree(c) for c in children])
+
+    def ctx_path(self, parent: int, callsite: str) -> int:
+        # Id of the call path parent + [callsite] (-1 is the empty path)
+        key = (parent, callsite)
+        path = self.ctx_paths.get(key)
+        if path is None:
+            path = self.ctx_paths[key] = len(self.ctx_paths)
+        return path
+
 class ExecutionTree:
-    def __init__(self, g, isTokenCursor, token_grammar: dict, ctx_mode, d_terminals, ctr_terminals, d_simplify_ctx, d_ctr_simplify_ctx, d_simple_loops):
-        self.tree = [] #("<start>", [])
+    """Adds the execution tree of a trace to the grammar g, without building the tree.
+
+    The call stacks of a trace are the root-to-leaf paths of its execution tree, in
+    depth-first order. Only the path of open nodes (the spine) is kept: a node is done once
+    the next call stack diverges from it, and its rule is emitted then. Rules are added to
+    g in to_grammar, in the breadth-first order of the tree, as before. Nodes at the same
+    depth are done from left to right, so this only needs the emitted rules per depth, and
+    only those that are new to g.
+
+    keep_tree also keeps the tree itself, for get()."""
+    def __init__(self, g: GrammarBuilder, isTokenCursor, token_grammar: dict, ctx_mode, d_terminals, ctr_terminals, d_simplify_ctx, d_ctr_simplify_ctx, d_simple_loops, symbols: SymbolTable = None, window_size: int = WINDOW_SIZE, stamps=None, keep_tree: bool = False):
+        self.spine = [] # open nodes, from the root: [symbol, names of its children, rule of its last iteration (loops), subtree (keep_tree)]
+        self.root = None # symbol
+        self.done = False # only the first top-level node of the tree is added to g
+        self.levels = [] # per depth: the operations on g (see emit), None if superseded
+        self.pending = {} # operation => (depth, index into levels[depth])
+        self.keep_tree = keep_tree
+        self.tree = [] # only with keep_tree
         self.g = g
         self.isTokenCursor = isTokenCursor
         self.token_grammar = token_grammar
         self.ctx_mode = ctx_mode
+        self.window_size = window_size # CTX_WINDOW only
         self.execution_trace = None
 
         self.d_terminals = d_terminals #{}
@@ -186,23 +433,28 @@ class ExecutionTree:
 
         self.d_simplify_ctx: dict = d_simplify_ctx # maps (f, 0x123) => 1...
         self.d_ctr_simplify_ctx: dict = d_ctr_simplify_ctx # maps f => 1,2,3..
-        
+
         self.d_simple_loops: dict = d_simple_loops
 
+        # Paths are compared by symbol ids; names are only built for the rules (once per symbol)
+        self.symbols = symbols if symbols is not None else SymbolTable()
+
+        # The ForestGrammar, if it records where names are first seen (see ForestGrammar.next_stamp)
+        self.stamps = stamps
+
     def add_trace(self, et: ExecutionTrace):
-        trace = et.get()
         assert self.execution_trace is None
         self.execution_trace = et
-        inp_pos: str
-        for i, inp_pos in enumerate(sorted(trace.keys(), key=lambda x: int(x))):
-            order = trace[inp_pos]["readorder"]
-            execution_context: dict = trace[inp_pos]["executioncontext"]
-            solutions: list = trace[inp_pos]["solutions"]
-            if i == len(trace.keys()) - 1 and solutions == [0]:
+        trace_len = len(et)
+        execution_context: dict
+        solutions: list
+        for i, (order, execution_context, solutions) in enumerate(et.positions()):
+            if i == trace_len - 1 and solutions == [0]:
                 # Remove trailing 0x00
                 solutions = []
             call_stack = []
             ctxs = [] # only using call_ctx; this implies f in our case.
+            ctx_path = -1
             for frame in execution_context:
                 callsite = frame["callsite"]
                 callee = frame["callee"]
@@ -215,187 +467,458 @@ class ExecutionTree:
                 # CTX_FINE => Merge all traces based on entire call path.
                 # CTX_WINDOW => Merge all traces based on a window of k frames.
 
+                # ctx identifies joined_ctx without joining the call sites for every frame
                 if self.ctx_mode == CTX_NONE:
-                    joined_ctx = ""
+                    ctx = ""
                 elif self.ctx_mode == CTX_COARSE:
-                    joined_ctx = ctxs[-1]
+                    ctx = callsite
                 elif self.ctx_mode == CTX_FINE:
-                    joined_ctx = ",".join(ctxs)
+                    ctx_path = self.symbols.ctx_path(ctx_path, callsite)
+                    ctx = ctx_path
                 elif self.ctx_mode == CTX_WINDOW:
-                    joined_ctx = ",".join(ctxs[len(ctxs)-WINDOW_SIZE:])
+                    ctx = tuple(ctxs[len(ctxs)-self.window_size:])
                 else:
                     assert False, "not implemented"
 
-                # Convert loop_iterations to string for visualization
-                if callee not in self.d_ctr_simplify_ctx:
-                    self.d_ctr_simplify_ctx[callee] = 0
-                if (callee, joined_ctx) not in self.d_simplify_ctx:
-                    self.d_simplify_ctx[(callee, joined_ctx)] = self.d_ctr_simplify_ctx[callee]
-                    self.d_ctr_simplify_ctx[callee] += 1
-
-                call_stack.append(f"{callee}@{self.d_simplify_ctx[(callee, joined_ctx)]}")
-
-                if loopiterations != []:
-                    for loopiteration in loopiterations:
-                        loopheader: str = loopiteration["loopheader"]
-                        iterationcount: int = loopiteration["iterationcount"]
-
-                        if callee not in self.d_simple_loops:
-                            self.d_simple_loops[callee] = {}
-                        if loopheader not in self.d_simple_loops[callee]:
-                            if len(self.d_simple_loops[callee]) == 0:
-                                self.d_simple_loops[callee][loopheader] = 0
-                            else:
-                                self.d_simple_loops[callee][loopheader] = max(self.d_simple_loops[callee].values()) + 1
-
-                        simple_loop_id = self.d_simple_loops[callee][loopheader]
-                        call_stack.append(f"{callee}@{self.d_simplify_ctx[(callee, joined_ctx)]}_L{simple_loop_id}") # loop
-                        call_stack.append(f"{callee}@{self.d_simplify_ctx[(callee, joined_ctx)]}_L{simple_loop_id}:I{iterationcount}") # loop iter
-
-            print("inserting call_stack: ", call_stack)
-            self.insert_path(self.tree, call_stack, solutions)
-        self.tree = self.tree[0] if self.tree else ()
-
-    def insert_path(self, tree, path, solutions):
-        if not path:
+                call = self.symbols.calls.get((callee, ctx))
+                if call is None:
+                    call = self.symbols.calls[(callee, ctx)] = self.call_symbol(callee, ctxs)
+                call_stack.append(call)
+
+                for loopiteration in loopiterations:
+                    loopheader: str = loopiteration["loopheader"]
+                    iterationcount: int = loopiteration["iterationcount"]
+
+                    loop = self.symbols.loops.get((call, loopheader))
+                    if loop is None:
+                        loop = self.symbols.loops[(call, loopheader)] = self.loop_symbol(call, loopheader)
+                    iteration = self.symbols.iterations.get((loop, iterationcount))
+                    if iteration is None:
+                        _, loop_callee, simple_ctx, simple_loop_id = self.symbols.key(loop)
+                        iteration = self.symbols.intern((SymbolTable.ITERATION, loop_callee, simple_ctx, simple_loop_id, iterationcount))
+                        self.symbols.iterations[(loop, iterationcount)] = iteration
+                    call_stack.append(loop) # loop
+                    call_stack.append(iteration) # loop iter
+
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("inserting call_stack: %s", [self.symbols.name(sym)[1:-1] for sym in call_stack])
+            self.insert_path(call_stack, solutions)
+        self.close_nodes(0)
+        self.done = True
+        if self.keep_tree:
+            self.tree = self.tree[0] if self.tree else ()
+
+    def call_symbol(self, callee, ctxs):
+        # First time (callee, ctx) is seen by this symbol table
+        if self.ctx_mode == CTX_NONE:
+            joined_ctx = ""
+        elif self.ctx_mode == CTX_COARSE:
+            joined_ctx = ctxs[-1]
+        elif self.ctx_mode == CTX_FINE:
+            joined_ctx = ",".join(ctxs)
+        else:
+            joined_ctx = ",".join(ctxs[len(ctxs)-self.window_size:])
+
+        if callee not in self.d_ctr_simplify_ctx:
+            self.d_ctr_simplify_ctx[callee] = 0
+        if (callee, joined_ctx) not in self.d_simplify_ctx:
+            self.d_simplify_ctx[(callee, joined_ctx)] = self.d_ctr_simplify_ctx[callee]
+            self.d_ctr_simplify_ctx[callee] += 1
+            if self.stamps: self.stamps.ctx_stamps[(callee, joined_ctx)] = self.stamps.next_stamp()
+        return self.symbols.intern((SymbolTable.CALL, callee, self.d_simplify_ctx[(callee, joined_ctx)]))
+
+    def loop_symbol(self, call, loopheader):
+        # First time loopheader is seen in call
+        _, callee, simple_ctx = self.symbols.key(call)
+        if callee not in self.d_simple_loops:
+            self.d_simple_loops[callee] = {}
+        if loopheader not in self.d_simple_loops[callee]:
+            if len(self.d_simple_loops[callee]) == 0:
+                self.d_simple_loops[callee][loopheader] = 0
+            else:
+                self.d_simple_loops[callee][loopheader] = max(self.d_simple_loops[callee].values()) + 1
+            if self.stamps: self.stamps.loop_stamps[(callee, loopheader)] = self.stamps.next_stamp()
+
+        simple_loop_id = self.d_simple_loops[callee][loopheader]
+        return self.symbols.intern((SymbolTable.LOOP, callee, simple_ctx, simple_loop_id))
+
+    def terminal_symbols(self, solutions):
+        key = tuple(solutions)
+        syms = self.symbols.terminals.get(key)
+        if syms is None:
             if not self.isTokenCursor:
                 DELETE_NULL = True
                 if DELETE_NULL: solutions = [s for s in solutions if s != 0]
-            solutions_str = str(sorted(solutions))
+            solutions = sorted(solutions)
+            solutions_str = str(solutions)
             if solutions_str not in self.d_terminals:
                 self.ctr_terminals += 1
                 self.d_terminals[solutions_str] = self.ctr_terminals
-            subtree = (f"<__T{self.d_terminals[solutions_str]}>", [(solutions_str, [])]) # string repr of list of possible terminals as leaf
-            tree.append(subtree)
-            return tree
-
-        node, *rest = path
-        node = f"<{node}>"
-
-        # Only insert at rightmost place, if possible; otherwise generate a new subtree.
-        if len(tree) > 0:
-            n, children = tree[-1]
-            if n == node:
-                tree[-1] = (n, self.insert_path(children, rest, solutions))
-                return tree
-            
-        subtree = self.insert_path([], rest, solutions)
-        tree.append((node, subtree))
-        return tree
-    
-    def handle_solutions(self, node, children):
-        solutions = ast.literal_eval(children[0][0])
+                if self.stamps: self.stamps.terminal_stamps[solutions_str] = self.stamps.next_stamp()
+            syms = (self.symbols.intern((SymbolTable.TERMINAL, self.d_terminals[solutions_str])),
+                    self.symbols.intern((SymbolTable.SOLUTIONS, tuple(solutions))))
+            self.symbols.terminals[key] = syms
+        return syms
+
+    def insert_path(self, path, solutions):
+        terminal, solutions_sym = self.terminal_symbols(solutions)
+        if self.done:
+            return
+        # As in a tree: follow the rightmost path as long as it matches, then add new nodes
+        k = 0
+        n = min(len(self.spine), len(path))
+        while k < n and self.spine[k][0] == path[k]:
+            k += 1
+        if k == 0 and self.root is not None:
+            # A second top-level node, which is not added to g
+            self.close_nodes(0)
+            self.done = True
+            return
+        self.close_nodes(k)
+        for sym in path[k:]:
+            self.open_node(sym)
+        self.add_terminal(terminal, solutions_sym)
+
+    def add_child(self, sym) -> int:
+        # Appends sym to the children of the innermost open node; returns its depth
+        depth = len(self.spine)
+        if depth == 0:
+            self.root = sym
+        else:
+            self.spine[-1][1].append(self.symbols.name(sym))
+        return depth
+
+    def open_node(self, sym):
+        depth = self.add_child(sym)
+        node = self.symbols.name(sym)
+        subtree = None
+        if self.keep_tree:
+            subtree = []
+            (self.spine[-1][3] if self.spine else self.tree).append((sym, subtree))
+        self.spine.append([sym, [], None, subtree])
+        self.emit(depth, "define", node)
+        if self.symbols.kind(sym) == SymbolTable.LOOP:
+            continue_nt = node[:-1] + "_cont>"
+            exit_nt = node[:-1] + "_exit>"
+            self.emit(depth, "set_rules", node, ((continue_nt, node), (exit_nt,)))
+            self.emit(depth, "define", continue_nt)
+            self.emit(depth, "define", exit_nt)
+
+    def close_nodes(self, depth):
+        # Closes the open nodes deeper than depth, innermost first
+        while len(self.spine) > depth:
+            sym, names, last_iteration, _ = self.spine.pop()
+            d = len(self.spine)
+            node = self.symbols.name(sym)
+            kind = self.symbols.kind(sym)
+            if kind == SymbolTable.LOOP:
+                # All iterations but the last one continue the loop
+                if last_iteration is not None:
+                    self.emit(d, "add", node[:-1] + "_exit>", last_iteration)
+                continue
+            rule = tuple(names)
+            self.emit(d, "add", node, rule)
+            if kind == SymbolTable.ITERATION:
+                loop = self.spine[-1]
+                if loop[2] is not None:
+                    self.emit(d - 1, "add", self.symbols.name(loop[0])[:-1] + "_cont>", loop[2])
+                loop[2] = rule
+
+    def add_terminal(self, terminal, solutions_sym):
+        # Leaf node with concrete solutions
+        depth = self.add_child(terminal)
+        if self.keep_tree:
+            (self.spine[-1][3] if self.spine else self.tree).append((terminal, [(solutions_sym, [])]))
+        node = self.symbols.name(terminal)
+        # The rules of a terminal symbol only depend on its solutions, so they are all there
+        # (or will be, at this depth or above) once it is defined
+        if node in self.g:
+            return
+        seen = self.pending.get(("define", node, None))
+        if seen is not None and seen[0] <= depth:
+            return
+        self.emit(depth, "define", node)
+        solutions = list(self.symbols.key(solutions_sym)[1])
         if solutions == []:
-            if [] not in self.g[node]:
-                self.g[node].append([]) # epsilon
+            rules = ((),) # epsilon
         else:
             if self.isTokenCursor:
                 # This means the token in unconstrained; 256 is the limit of MiningExecutor::solveToken.
                 if len(solutions) >= 255:
-                    for nt in self.token_grammar:
-                        if nt.startswith("<TOK_"):
-                            rule = [nt]
-                            if rule not in self.g[node]:
-                                self.g[node].append(rule)
+                    rules = tuple((nt,) for nt in self.token_grammar if nt.startswith("<TOK_"))
                 else:
+                    rules = []
                     for sol in solutions:
                         token = f"<TOK_{sol}>"
                         assert token in self.token_grammar, f"Error: Token {token} not found in the token grammar."
-                        rule = [token]
-                        if rule not in self.g[node]:
-                            self.g[node].append(rule)
-            else:
-                for sol in solutions:
-                    rule = [chr(sol)]
-                    if rule not in self.g[node]:
-                        self.g[node].append(rule)
-
-    def handle_loops(self, node, children):
-        iteration_cnt = len(children)
-        continue_nt = node[:-1] + "_cont>"
-        exit_nt = node[:-1] + "_exit>"
-
-        self.g[node] = [[continue_nt, node], [exit_nt]]
-        for n in [continue_nt, exit_nt]:
-            if n not in self.g:
-                self.g[n] = []
-
-        for i, c in enumerate(children):
-            node_, children_ = c
-            assert is_iteration(node_)
-
-            rule = [c_[0] for c_ in children_]
-            if i == iteration_cnt - 1:
-                if rule not in self.g[exit_nt]:
-                    self.g[exit_nt].append(rule)
+                        rules.append((token,))
+                    rules = tuple(rules)
             else:
-                if rule not in self.g[continue_nt]:
-                    self.g[continue_nt].append(rule)
-
-    def handle_general_node(self, node, children):
-        rule = [c[0] for c in children]
-        if rule not in self.g[node]:
-            self.g[node].append(rule)
+                rules = tuple((chr(sol),) for sol in solutions)
+        self.emit(depth, "add_all", node, rules)
+
+    def emit(self, depth, method, nt, rules=None):
+        # Records g.<method>(nt, rules) for to_grammar. Operations that do not change g are
+        # left out: those that are no-ops on g already, and repeated ones (only the first
+        # one in breadth-first order, i.e. the one at the smallest depth, takes effect).
+        if method == "define":
+            if nt in self.g: return
+        elif method == "add":
+            if self.g.has_rule(nt, rules): return
+        elif method == "add_all": # the rules of a terminal symbol, see add_terminal
+            if nt in self.g: return
+        elif nt in self.g and [tuple(rule) for rule in self.g[nt]] == list(rules):
+            return
+        op = (method, nt, rules)
+        seen = self.pending.get(op)
+        if seen is not None:
+            if seen[0] <= depth: return
+            self.levels[seen[0]][seen[1]] = None
+        while len(self.levels) <= depth:
+            self.levels.append([])
+        self.pending[op] = (depth, len(self.levels[depth]))
+        self.levels[depth].append(op)
 
     def to_grammar(self):
-        node, children = self.tree
+        assert self.root is not None, "empty trace"
+        start = self.symbols.name(self.root)
         if "<start>" in self.g:
-            assert self.g["<start>"] == [[node]], "start symbol must match across traces"
+            assert self.g["<start>"] == [[start]], "start symbol must match across traces"
         else:
-            self.g["<start>"] = [[node]]
-        q = [(node, children)]
-        while q:
-            node, children = q.pop(0)
-            if children:
-                if node not in self.g:
-                    self.g[node] = []
-                if node.startswith("<__T"): # Leaf node with concrete solutions
-                    if not self.isTokenCursor: assert len(children) == 1
-                    if self.isTokenCursor: assert len(children) > 0
-                    self.handle_solutions(node, children)
-                elif is_loop(node):
-                    self.handle_loops(node, children)
+            self.g.set_rules("<start>", [[start]])
+        for level in self.levels:
+            for op in level:
+                if op is None: continue
+                method, nt, rules = op
+                if method == "define":
+                    self.g.define(nt)
+                elif method == "add":
+                    self.g.add(nt, list(rules))
+                elif method == "add_all":
+                    for rule in rules:
+                        self.g.add(nt, list(rule))
                 else:
-                    self.handle_general_node(node, children)
-                q.extend(children)
+                    self.g.set_rules(nt, [list(rule) for rule in rules])
+        self.levels = []
+        self.pending = {}
         return self.g
 
     def get(self):
-        return self.tree
-
-class ExecutionForest:
-    def __init__(self, directory, isTokenCursor: bool, token_grammar: dict, ctx_mode: int, all_scc: list, simplify: bool):
-        self.g = {}
+        assert self.keep_tree
+        return self.symbols.named_tree(self.tree)
+
+def ctx_mode_name(ctx_mode, window_size=WINDOW_SIZE) -> str:
+    # As in the --ctx-* flags (and convert-% in subjects/common.mk)
+    if ctx_mode == CTX_WINDOW:
+        return f"window{window_size}"
+    return {CTX_NONE: "none", CTX_COARSE: "coarse", CTX_FINE: "fine"}[ctx_mode]
+
+class ForestGrammar:
+    """The grammar of the traces merged so far, for one context mode (ctx_mode and, for
+    CTX_WINDOW, the window size). ExecutionForest loads and orders every trace once and
+    adds it to one ForestGrammar per mode.
+
+    Every name (ctx, loop and terminal id) and every nonterminal and rule of the grammar is
+    stamped with where it was first seen: (trace, n) for the n-th new one of
+    self.stamp_traces[trace]. The stamps give the order in which a single run over all
+    traces would have numbered and added them, which is what merge_states needs."""
+    def __init__(self, isTokenCursor: bool, token_grammar: dict, ctx_mode: int, window_size: int, simplify: bool, suffix: str = "", jobs: int = 1, token_cache: TokenCache = None):
+        self.rules = GrammarBuilder(stamp=self.next_stamp) # accumulated across traces
+        self.g = None # the post-processed grammar, see build_grammar
         self.isTokenCursor = isTokenCursor
         self.token_grammar = token_grammar
+        self.ctx_mode = ctx_mode
+        self.window_size = window_size
+        self.simplify = simplify
+        self.suffix = suffix # of the output files, to tell the modes apart
+        self.jobs = jobs # for generalize_tokens
+        self.token_cache = token_cache # for generalize_tokens
         self.d_terminals = {}
         self.ctr_terminals = 0
         self.d_simplify_ctx = {}
         self.d_ctr_simplify_ctx = {}
         self.d_simple_loops = {}
-        self.directory = directory
-        self.ctx_mode = ctx_mode
-        self.all_scc = all_scc
-
-        tracefiles = [os.path.join(directory, f) for f in os.listdir(directory) if os.path.isfile(os.path.join(directory, f))]
-        for tracefile in tracefiles:
-            print("Loading ", tracefile)
-            j = load_json_file(tracefile)
-            exec_trace = ExecutionTrace(j, self.all_scc, tracefile)
-            exec_tree = ExecutionTree(self.g, self.isTokenCursor, self.token_grammar, self.ctx_mode, self.d_terminals, self.ctr_terminals, self.d_simplify_ctx, self.d_ctr_simplify_ctx, self.d_simple_loops)
-            exec_tree.add_trace(exec_trace)
-            self.g = exec_tree.to_grammar() # Accumulated across ExecutionTrees
-            self.ctr_terminals = exec_tree.ctr_terminals # passed by value (unlike the dicts), so we need to save it
+        self.fingerprints = set() # ExecutionTrace.fingerprints of the merged traces
+        self.count_duplicate_traces = 0
+        self.symbols = SymbolTable() # shared by the ExecutionTrees
+        self.stamp_traces = [] # names of the merged traces, in merge order
+        self.stamp_ctr = 0
+        self.ctx_stamps = {} # (callee, joined_ctx) => stamp
+        self.loop_stamps = {} # (callee, loopheader) => stamp
+        self.terminal_stamps = {} # solutions_str => stamp
+
+    def next_stamp(self) -> tuple:
+        stamp = (len(self.stamp_traces) - 1, self.stamp_ctr)
+        self.stamp_ctr += 1
+        return stamp
+
+    def output_file(self, name) -> str:
+        return f"{name}{self.suffix}.json"
+
+    def size(self) -> tuple:
+        # (nonterminals, alternatives) of the grammar so far
+        return len(self.rules), self.rules.count_alternatives
+
+    def add_execution_trace(self, exec_trace: ExecutionTrace, fingerprint: str, name: str):
+        # name: of the trace in its directory/archive, as in the values of ExecutionForest.seen_traces
+        if fingerprint in self.fingerprints:
+            log.info("Skipping duplicate trace: %s", exec_trace.trace_fname)
+            self.count_duplicate_traces += 1
+            return
+        self.fingerprints.add(fingerprint)
+        self.stamp_traces.append(name)
+        self.stamp_ctr = 0
+        exec_tree = ExecutionTree(self.rules, self.isTokenCursor, self.token_grammar, self.ctx_mode, self.d_terminals, self.ctr_terminals, self.d_simplify_ctx, self.d_ctr_simplify_ctx, self.d_simple_loops, self.symbols, self.window_size, self)
+        exec_tree.add_trace(exec_trace)
+        exec_tree.to_grammar() # adds to self.rules
+        self.ctr_terminals = exec_tree.ctr_terminals # passed by value (unlike the dicts), so we need to save it
 
-        serialize_grammar(self.g, "intermediate_grammar.json")
+    def build_grammar(self):
+        # Post-processing works on a copy (self.g), so more traces can be merged afterwards
+        self.g = self.rules.to_dict()
+        serialize_grammar(self.g, self.output_file("intermediate_grammar"))
 
         # Post-process the grammar
         self.fix_loops()
         self.generalize_tokens()
-        if simplify: self.simplify_grammar()
+        if self.simplify: self.simplify_grammar()
         for nt in unreachable_nonterminals(self.g, start_symbol="<start>"):
             del self.g[nt]
-    
+
+    def get_state(self) -> dict:
+        # For checkpoints, see ExecutionForest.save_checkpoint
+        return {
+            "ctx_mode": self.ctx_mode,
+            "window_size": self.window_size,
+            "fingerprints": sorted(self.fingerprints),
+            "count_duplicate_traces": self.count_duplicate_traces,
+            "grammar": self.rules.to_dict(),
+            "d_terminals": self.d_terminals,
+            "ctr_terminals": self.ctr_terminals,
+            "d_simplify_ctx": [[callee, ctx, n] for (callee, ctx), n in self.d_simplify_ctx.items()],
+            "d_ctr_simplify_ctx": self.d_ctr_simplify_ctx,
+            "d_simple_loops": self.d_simple_loops,
+            "stamps": {
+                "traces": self.stamp_traces,
+                "ctx": [[callee, ctx, *stamp] for (callee, ctx), stamp in self.ctx_stamps.items()],
+                "loops": [[callee, loopheader, *stamp] for (callee, loopheader), stamp in self.loop_stamps.items()],
+                "terminals": [[solutions_str, *stamp] for solutions_str, stamp in self.terminal_stamps.items()],
+                "grammar": self.rules.get_stamps(),
+            },
+        }
+
+    def set_state(self, state: dict):
+        self.fingerprints = set(state["fingerprints"])
+        self.count_duplicate_traces = state["count_duplicate_traces"]
+        self.rules = GrammarBuilder(state["grammar"])
+        self.d_terminals = state["d_terminals"]
+        self.ctr_terminals = state["ctr_terminals"]
+        self.d_simplify_ctx = {(callee, ctx): n for callee, ctx, n in state["d_simplify_ctx"]}
+        self.d_ctr_simplify_ctx = state["d_ctr_simplify_ctx"]
+        self.d_simple_loops = state["d_simple_loops"]
+        stamps = state["stamps"]
+        self.stamp_traces = stamps["traces"]
+        self.ctx_stamps = {(callee, ctx): (t, n) for callee, ctx, t, n in stamps["ctx"]}
+        self.loop_stamps = {(callee, loopheader): (t, n) for callee, loopheader, t, n in stamps["loops"]}
+        self.terminal_stamps = {solutions_str: (t, n) for solutions_str, t, n in stamps["terminals"]}
+        self.rules.set_stamps({nt: [tuple(nt_stamp), [tuple(stamp) for stamp in rule_stamps]] for nt, (nt_stamp, rule_stamps) in stamps["grammar"].items()})
+        self.rules.stamp = self.next_stamp
+
+    @staticmethod
+    def merge_states(states: list) -> dict:
+        """Merges the states (get_state) of ForestGrammars of the same mode, built from
+        disjoint sets of traces, into the state a single ForestGrammar gets from all of these
+        traces, merged in sorted order. The ctx, loop and terminal ids are numbered in the
+        order in which they were first seen (by their stamps), the grammars are renamed
+        accordingly and united, again ordering nonterminals and rules by their stamps.
+        This requires each state to be built in sorted trace order, as --batch does
+        (see ExecutionForest.sorted_order)."""
+        # First stamp of every name over all states; stamps become (trace name, n)
+        ctx_stamps, loop_stamps, terminal_stamps = {}, {}, {}
+        def first_seen(stamps, key, stamp):
+            if key not in stamps or stamp < stamps[key]:
+                stamps[key] = stamp
+        for state in states:
+            stamps = state["stamps"]
+            traces = stamps["traces"]
+            for callee, ctx, t, n in stamps["ctx"]:
+                first_seen(ctx_stamps, (callee, ctx), (traces[t], n))
+            for callee, loopheader, t, n in stamps["loops"]:
+                first_seen(loop_stamps, (callee, loopheader), (traces[t], n))
+            for solutions_str, t, n in stamps["terminals"]:
+                first_seen(terminal_stamps, solutions_str, (traces[t], n))
+
+        # Number them as call_symbol, loop_symbol and terminal_symbols do
+        d_simplify_ctx, d_ctr_simplify_ctx = {}, {}
+        for callee, ctx in sorted(ctx_stamps, key=ctx_stamps.get):
+            d_ctr_simplify_ctx.setdefault(callee, 0)
+            d_simplify_ctx[(callee, ctx)] = d_ctr_simplify_ctx[callee]
+            d_ctr_simplify_ctx[callee] += 1
+        d_simple_loops = {}
+        for callee, loopheader in sorted(loop_stamps, key=loop_stamps.get):
+            loops = d_simple_loops.setdefault(callee, {})
+            loops[loopheader] = len(loops)
+        d_terminals = {}
+        for solutions_str in sorted(terminal_stamps, key=terminal_stamps.get):
+            d_terminals[solutions_str] = len(d_terminals) + 1
+
+        # Rename and unite the grammars
+        nt_stamps = {}
+        rule_stamps = {} # nt => {tuple(rule): stamp}
+        for state in states:
+            traces = state["stamps"]["traces"]
+            ctx_map = {(callee, n): d_simplify_ctx[(callee, ctx)] for callee, ctx, n in state["d_simplify_ctx"]}
+            loop_map = {(callee, loop): d_simple_loops[callee][loopheader] for callee, loops in state["d_simple_loops"].items() for loopheader, loop in loops.items()}
+            terminal_map = {t: d_terminals[solutions_str] for solutions_str, t in state["d_terminals"].items()}
+            grammar_stamps = state["stamps"]["grammar"]
+            for nt, rules in state["grammar"].items():
+                (t, n), stamps = grammar_stamps[nt]
+                new_nt = rename_symbol(nt, ctx_map, loop_map, terminal_map)
+                first_seen(nt_stamps, new_nt, (traces[t], n))
+                new_rules = rule_stamps.setdefault(new_nt, {})
+                for rule, (t, n) in zip(rules, stamps):
+                    new_rule = tuple(rename_symbol(s, ctx_map, loop_map, terminal_map) for s in rule)
+                    first_seen(new_rules, new_rule, (traces[t], n))
+        start_rules = rule_stamps.get("<start>", {})
+        assert len(start_rules) <= 1, f"start symbol must match across traces: {list(start_rules)}"
+
+        # The stamps of the merged state refer to the union of the traces
+        traces = sorted(set(trace for state in states for trace in state["stamps"]["traces"]))
+        trace_ids = {trace: i for i, trace in enumerate(traces)}
+        def local(stamp):
+            return [trace_ids[stamp[0]], stamp[1]]
+        grammar = {}
+        grammar_stamps = {}
+        for nt in sorted(nt_stamps, key=nt_stamps.get):
+            rules = sorted(rule_stamps[nt], key=rule_stamps[nt].get)
+            grammar[nt] = [list(rule) for rule in rules]
+            grammar_stamps[nt] = [local(nt_stamps[nt]), [local(rule_stamps[nt][rule]) for rule in rules]]
+
+        fingerprints = set()
+        count_duplicate_traces = 0
+        for state in states:
+            count_duplicate_traces += state["count_duplicate_traces"] + len(fingerprints.intersection(state["fingerprints"]))
+            fingerprints.update(state["fingerprints"])
+        return {
+            "ctx_mode": states[0]["ctx_mode"],
+            "window_size": states[0]["window_size"],
+            "fingerprints": sorted(fingerprints),
+            "count_duplicate_traces": count_duplicate_traces,
+            "grammar": grammar,
+            "d_terminals": d_terminals,
+            "ctr_terminals": len(d_terminals),
+            "d_simplify_ctx": [[callee, ctx, n] for (callee, ctx), n in d_simplify_ctx.items()],
+            "d_ctr_simplify_ctx": d_ctr_simplify_ctx,
+            "d_simple_loops": d_simple_loops,
+            "stamps": {
+                "traces": traces,
+                "ctx": [[callee, ctx, *local(stamp)] for (callee, ctx), stamp in ctx_stamps.items()],
+                "loops": [[callee, loopheader, *local(stamp)] for (callee, loopheader), stamp in loop_stamps.items()],
+                "terminals": [[solutions_str, *local(stamp)] for solutions_str, stamp in terminal_stamps.items()],
+                "grammar": grammar_stamps,
+            },
+        }
+
     def fix_loops(self):
         g_copy = {**self.g}
         for nt in g_copy:
@@ -405,50 +928,351 @@ class ExecutionForest:
                 exit_rule = rule_set[1] # [exit_nt]
                 cont_nt = cont_rule[0]
                 if self.g[cont_nt] == []:
-                    print(f"WARN: no continue iterations in {cont_nt}. Will delete this NT. Hence the loop only has an exit iteration now.")
+                    log.warning("WARN: no continue iterations in %s. Will delete this NT. Hence the loop only has an exit iteration now.", cont_nt)
                     del self.g[cont_nt]
                     self.g[nt] = [exit_rule]
 
-        serialize_grammar(self.g, "loopfix_grammar.json")
+        serialize_grammar(self.g, self.output_file("loopfix_grammar"))
 
     def generalize_tokens(self):
         if self.isTokenCursor:
             self.g = {**self.g, **self.token_grammar}
         else:
-            self.g = generalize_tokens(self.g)
+            self.g = generalize_tokens(self.g, jobs=self.jobs, cache=self.token_cache)
 
-        serialize_grammar(self.g, "nonsimplified_grammar.json")
+        serialize_grammar(self.g, self.output_file("nonsimplified_grammar"))
     
     def simplify_grammar(self):
-        print("Doing inline and opt generalization")
+        log.info("Doing inline and opt generalization")
         self.g = inline_single_rules_and_opt_generalization(self.g)
 
     def get_grammar(self):
         return self.g
 
+class ExecutionForest:
+    def __init__(self, directory, isTokenCursor: bool, token_grammar: dict, ctx_modes: list, all_scc: list, simplify: bool, jobs: int = 1, stream: bool = False, checkpoint: str = None, watch: dict = None, partial_forests: list = None, saturation: dict = None, token_cache: TokenCache = None):
+        # ctx_modes: (ctx_mode, window size) pairs, one grammar is built for each
+        # partial_forests: checkpoints to start from (see merge_checkpoints), instead of checkpoint
+        # saturation: see is_saturated
+        self.isTokenCursor = isTokenCursor
+        self.directory = directory
+        self.ctx_modes = ctx_modes
+        self.all_scc = all_scc
+        self.jobs = jobs
+        self.stream = stream
+        self.checkpoint = checkpoint
+        self.seen_traces = {} # digest (content hash, see trace_archive.file_digest) => name of the merged traces
+        # Only checkpoints and --watch need to know which traces are merged already
+        self.track_digests = bool(checkpoint or watch or partial_forests)
+        # Whether the traces were merged in sorted order (of their names), as merge_checkpoints
+        # requires; not with --saturate, or if later traces sort before the ones merged already
+        self.sorted_order = True
+        self.last_merged = None # name of the last merged trace
+        self.saturation = saturation
+        self.saturation_curve = [] # (trace, grammar size per mode) for each merged trace
+        self.traces_since_growth = 0
+        self.grammars = []
+        for ctx_mode, window_size in ctx_modes:
+            suffix = f"-{ctx_mode_name(ctx_mode, window_size)}" if len(ctx_modes) > 1 else ""
+            self.grammars.append(ForestGrammar(isTokenCursor, token_grammar, ctx_mode, window_size, simplify, suffix, jobs, token_cache))
+
+        if partial_forests:
+            self.merge_checkpoints(partial_forests)
+        elif checkpoint and os.path.exists(checkpoint):
+            self.load_checkpoint(checkpoint)
+
+        # `directory` is a trace directory or a trace archive (see trace_archive.py).
+        # Traces are merged in sorted filename order, so the grammar does not depend on
+        # the directory listing order or on the number of jobs.
+        # Without a directory, the grammar is built from the partial forests alone.
+        if directory is not None:
+            self.traces = open_traces(directory)
+            if watch:
+                self.watch(**watch)
+            else:
+                names = self.new_traces()
+                if saturation:
+                    random.Random(saturation["seed"]).shuffle(names)
+                log.info("Loading %d new traces (%d already merged)", len(names), len(self.seen_traces))
+                merged = self.merge_traces(names)
+                if saturation:
+                    self.report_saturation(len(names) - merged)
+        self.build_grammar()
+
+    def new_traces(self) -> list:
+        # The traces whose content is not merged yet. KLEE numbers the trace files from 0 on every
+        # run, so a name that was merged before can now hold another trace.
+        if not self.seen_traces:
+            return self.traces.names()
+        names = []
+        merged_names = set(self.seen_traces.values())
+        for name in self.traces.names():
+            if self.traces.digest(name) in self.seen_traces:
+                continue
+            if name in merged_names:
+                log.warning("%s changed since it was merged, merging it as a new trace", self.traces.describe(name))
+            names.append(name)
+        return names
+
+    def merge_traces(self, names, retry_incomplete=False) -> int:
+        # With retry_incomplete, traces that are not valid JSON (yet) are left out and stay
+        # unseen, so that a later call picks them up. Returns the number of merged traces.
+        if self.jobs > 1:
+            return self.load_traces_parallel(names, retry_incomplete)
+        merged = 0
+        for name in names:
+            digest = None
+            try:
+                if self.track_digests:
+                    exec_trace, digest = load_execution_trace_with_digest(self.traces, name, self.all_scc, self.stream)
+                else:
+                    exec_trace = load_execution_trace(self.traces, name, self.all_scc, self.stream)
+            except json.JSONDecodeError:
+                if not retry_incomplete: raise
+                log.info("Incomplete trace, retrying later: %s", self.traces.describe(name))
+                continue
+            self.add_execution_trace(exec_trace, trace_fingerprints(exec_trace, self.ctx_modes, self.isTokenCursor), name)
+            self.mark_merged(name, digest)
+            merged += 1
+            if self.is_saturated():
+                break
+        return merged
+
+    def mark_merged(self, name, digest):
+        # digest: the entry from load_execution_trace_with_digest, None if not tracked
+        if digest is not None:
+            self.traces.add_digest(name, digest)
+            self.seen_traces[digest[1]] = name
+
+    def add_execution_trace(self, exec_trace: ExecutionTrace, fingerprints: list, name: str):
+        # The trace is loaded and ordered once, and added to the grammar of every mode
+        if self.last_merged is not None and name <= self.last_merged:
+            self.sorted_order = False
+        self.last_merged = name
+        for fg, fingerprint in zip(self.grammars, fingerprints):
+            fg.add_execution_trace(exec_trace, fingerprint, name)
+        if self.saturation:
+            sizes = [fg.size() for fg in self.grammars]
+            if self.saturation_curve and sizes == self.saturation_curve[-1][1]:
+                self.traces_since_growth += 1
+            else:
+                self.traces_since_growth = 0
+            self.saturation_curve.append((name, sizes))
+
+    def is_saturated(self) -> bool:
+        # With saturation, merging stops once the grammars (of all modes) have not grown
+        # for saturation["patience"] traces in a row
+        return bool(self.saturation) and self.traces_since_growth >= self.saturation["patience"]
+
+    def report_saturation(self, skipped):
+        # Writes the saturation curve: the size of the grammars after each merged trace
+        if self.is_saturated():
+            log.info("Saturated: no growth in the last %d traces, skipped %d traces", self.traces_since_growth, skipped)
+        else:
+            log.info("Not saturated: %d traces without growth at the end", self.traces_since_growth)
+        path = self.saturation["curve"]
+        with open(path, "w") as f:
+            f.write(",".join(["traces", "trace"] + [f"{column}{fg.suffix}" for fg in self.grammars for column in ["nonterminals", "alternatives"]]) + "\n")
+            for i, (name, sizes) in enumerate(self.saturation_curve):
+                f.write(",".join([str(i + 1), name] + [str(n) for size in sizes for n in size]) + "\n")
+        log.info("Wrote saturation curve to %s", path)
+
+    def build_grammar(self):
+        if self.checkpoint:
+            self.save_checkpoint(self.checkpoint)
+        for fg in self.grammars:
+            fg.build_grammar()
+
+    def watch(self, snapshot_interval, timestamps, snapshot_dir):
+        # Merges traces while KLEE is still writing them, until WATCH_END_EVENT shows up in
+        # the timestamps file after the last WATCH_START_EVENT (the file is appended to by every run). Every snapshot_interval seconds (if there are new traces), the
+        # grammar so far is written to snapshot_dir and the snapshot is logged in timestamps.
+        assert not self.stream, "--watch does not support --stream"
+        assert os.path.isdir(self.directory), "--watch needs a trace directory"
+        os.makedirs(snapshot_dir, exist_ok=True)
+        ctr_snapshots = 0
+        last_snapshot = time.time()
+        new_traces = 0
+        while True:
+            # Check before listing: every trace that is there once KLEE is done is complete
+            finished = is_event_logged(timestamps, WATCH_END_EVENT, since=WATCH_START_EVENT)
+            names = self.new_traces()
+            if names:
+                log.info("Loading %d new traces (%d already merged)", len(names), len(self.seen_traces))
+                new_traces += self.merge_traces(names, retry_incomplete=not finished)
+            if finished:
+                break
+            if new_traces > 0 and time.time() - last_snapshot >= snapshot_interval:
+                self.build_grammar()
+                for fg in self.grammars:
+                    serialize_grammar(fg.get_grammar(), os.path.join(snapshot_dir, f"initial_grammar{fg.suffix}-{ctr_snapshots}.json"))
+                log_event(timestamps, f"snapshot_traces_to_grammar_{ctr_snapshots}")
+                ctr_snapshots += 1
+                last_snapshot = time.time()
+                new_traces = 0
+            time.sleep(WATCH_POLL_INTERVAL)
+
+    def load_traces_parallel(self, names, retry_incomplete=False):
+        # Workers parse and order the traces (json.load + order_trace dominate the runtime).
+        # The ordered traces are merged here one after another, in the order of `names`,
+        # because the naming dicts (d_simplify_ctx etc.) depend on the merge order.
+        global count_traces, count_fixed_traces, count_fixed_positions
+        chunksize = max(1, len(names) // (self.jobs * 16))
+        merged = 0
+        with multiprocessing.Pool(self.jobs) as pool:
+            work = [(self.traces, name, self.all_scc, self.stream, self.ctx_modes, self.isTokenCursor, retry_incomplete, self.track_digests) for name in names]
+            results = pool.imap(_load_execution_trace_worker, work, chunksize=chunksize)
+            for name, result in zip(names, results):
+                if result is None:
+                    log.info("Incomplete trace, retrying later: %s", self.traces.describe(name))
+                    continue
+                exec_trace, fingerprints, (traces, fixed_traces, fixed_positions), digest = result
+                count_traces += traces
+                count_fixed_traces += fixed_traces
+                count_fixed_positions += fixed_positions
+                self.add_execution_trace(exec_trace, fingerprints, name)
+                self.mark_merged(name, digest)
+                merged += 1
+                if self.is_saturated():
+                    break # leaving the with block terminates the workers
+        return merged
+    
+    # A checkpoint holds everything that is accumulated across traces: per mode the grammar
+    # before post-processing and the naming dicts and counters, the statistics and the digests
+    # and names of the merged traces. Continuing from a checkpoint only merges traces whose
+    # content is not in it.
+    # New traces are merged after the checkpointed ones, so naming continues where it stopped.
+    # Checkpoints of disjoint sets of traces are partial forests, see merge_checkpoints; these
+    # must have been built in sorted trace order (sorted_order).
+    def save_checkpoint(self, path):
+        state = {
+            "isTokenCursor": self.isTokenCursor,
+            "traces": dict(sorted(self.seen_traces.items())),
+            "sorted_order": self.sorted_order,
+            "grammars": [fg.get_state() for fg in self.grammars],
+            "statistics": {
+                "count_traces": count_traces,
+                "count_fixed_traces": count_fixed_traces,
+                "count_fixed_positions": count_fixed_positions,
+            },
+        }
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, path) # never leave a truncated checkpoint behind
+        log.info("Wrote checkpoint (%d traces) to %s", len(self.seen_traces), path)
+
+    def check_checkpoint(self, path, state):
+        modes = [(s["ctx_mode"], s["window_size"]) for s in state["grammars"]]
+        assert modes == [tuple(m) for m in self.ctx_modes], f"checkpoint {path} was created for ctx modes {modes}"
+        assert state["isTokenCursor"] == self.isTokenCursor, f"checkpoint {path} was created with isTokenCursor={state['isTokenCursor']}"
+        assert isinstance(state["traces"], dict), f"checkpoint {path} identifies the traces by name only, it was created by an older version"
+        assert "sorted_order" in state, f"checkpoint {path} does not record the trace order, it was created by an older version"
+
+    def load_checkpoint(self, path):
+        global count_traces, count_fixed_traces, count_fixed_positions
+        state = load_json_file(path)
+        self.check_checkpoint(path, state)
+        self.seen_traces = dict(state["traces"])
+        self.sorted_order = state["sorted_order"]
+        self.last_merged = max(self.seen_traces.values(), default=None)
+        for fg, fg_state in zip(self.grammars, state["grammars"]):
+            fg.set_state(fg_state)
+        count_traces = state["statistics"]["count_traces"]
+        count_fixed_traces = state["statistics"]["count_fixed_traces"]
+        count_fixed_positions = state["statistics"]["count_fixed_positions"]
+        log.info("Loaded checkpoint (%d traces) from %s", len(self.seen_traces), path)
+
+    def merge_checkpoints(self, paths):
+        # Map-reduce mining: every shard of the traces is mined into a checkpoint with --batch
+        # (the partial forest), and the partial forests are merged here (see
+        # ForestGrammar.merge_states). The result is the same as mining all traces at once.
+        global count_traces, count_fixed_traces, count_fixed_positions
+        states = []
+        for path in paths:
+            state = load_json_file(path)
+            self.check_checkpoint(path, state)
+            assert state["sorted_order"], f"partial forest {path} was not built in sorted trace order (--saturate, or continued with traces that sort before the ones in it), so merging it would not give the grammar of a single run"
+            traces = state["traces"]
+            overlap = sorted(traces[digest] for digest in self.seen_traces.keys() & traces.keys())
+            assert not overlap, f"partial forest {path} shares {len(overlap)} traces with the ones before, e.g. {overlap[0]}"
+            self.seen_traces.update(traces)
+            count_traces += state["statistics"]["count_traces"]
+            count_fixed_traces += state["statistics"]["count_fixed_traces"]
+            count_fixed_positions += state["statistics"]["count_fixed_positions"]
+            states.append(state)
+        for i, fg in enumerate(self.grammars):
+            fg.set_state(ForestGrammar.merge_states([state["grammars"][i] for state in states]))
+        self.last_merged = max(self.seen_traces.values(), default=None)
+        log.info("Merged %d partial forests (%d traces)", len(paths), len(self.seen_traces))
+
+    def get_grammar(self):
+        # The grammar of the first mode
+        return self.grammars[0].get_grammar()
+
+# The timestamps file (see subjects/common.mk) has one "event,seconds,formatted" line per event
+def log_event(timestamps, event):
+    now = time.time()
+    with open(timestamps, "a") as f:
+        f.write(f"{event},{int(now)},{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(now))}\n")
+
+def is_event_logged(timestamps, event, since=None):
+    # With since, only event lines after the last since line count
+    if not os.path.exists(timestamps):
+        return False
+    logged = False
+    with open(timestamps, "r") as f:
+        for line in f:
+            name = line.split(",", 1)[0]
+            if name == event:
+                logged = True
+            elif name == since:
+                logged = False
+    return logged
+
 def main():
     parser = argparse.ArgumentParser(description='Argument Parser')
     group_mode = parser.add_mutually_exclusive_group(required=True)
     group_mode.add_argument('--single', action='store_true', help='Mine grammar from one trace')
     group_mode.add_argument('--batch', action='store_true', help='Mine grammar from all traces in directory')
+    group_mode.add_argument('--merge', type=str, nargs='+', metavar='PARTIAL_FOREST', help='Mine grammar from the checkpoints of --batch runs over disjoint sets of traces, plus the traces in path (if given)')
 
     group_ctx = parser.add_mutually_exclusive_group(required=True)
     group_ctx.add_argument('--ctx-none', action='store_true', help='Ctx = None')
     group_ctx.add_argument('--ctx-coarse', action='store_true', help='Ctx = Caller')
     group_ctx.add_argument('--ctx-fine', action='store_true', help='Ctx = Call Path')
-    group_ctx.add_argument('--ctx-window', action='store_true', help='Ctx = Sliding window of call sites; k defined in .py')
+    group_ctx.add_argument('--ctx-window', action='store_true', help='Ctx = Sliding window of call sites; k set by --window-sizes')
+    group_ctx.add_argument('--ctx-all', action='store_true', help='All of the above, from one pass over the traces; writes one grammar per ctx (--batch only)')
+    parser.add_argument('--window-sizes', type=int, nargs='+', default=[WINDOW_SIZE], help=f'Window sizes for --ctx-window and --ctx-all, one grammar per size (default: {WINDOW_SIZE})')
 
     parser.add_argument('--token-cursor', action='store_true', dest='isTokenCursor', help='Set if subject is a token cursor subject')
     parser.add_argument('--token-grammar', type=str, help='Supply the token grammar (JSON) if subject is a token cursor subject')
 
     parser.add_argument('--scc', type=str, help='Supply the strongly connected components (JSON) if available.')
     parser.add_argument('--simplify', action='store_true', help='Simplify grammar (inline, opt generalization)')
+    parser.add_argument('--stream', action='store_true', help='Decode trace files incrementally instead of loading whole JSON documents (--batch only)')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of worker processes that load and order traces (--batch only) and that generalize tokens')
+    parser.add_argument('--token-cache', type=str, help='Directory of the token generalization cache, shared with mine_tokens.py (--batch only)')
+    parser.add_argument('--token-cache-size', type=int, default=256, help='Size limit of the token cache in MB')
+    parser.add_argument('--checkpoint', type=str, help='Continue from this checkpoint (if it exists) and update it; only traces that are not in the checkpoint are loaded (--batch only). With --merge, the merged checkpoint is written to it')
+    parser.add_argument('--watch', action='store_true', help=f'Merge traces while KLEE is still writing them, until {WATCH_END_EVENT} is in the timestamps file after the last {WATCH_START_EVENT} (--batch only)')
+    parser.add_argument('--snapshot-interval', type=int, default=600, help='Seconds between two grammar snapshots (--watch only)')
+    parser.add_argument('--snapshot-dir', type=str, default='snapshots', help='Directory for the grammar snapshots (--watch only)')
+    parser.add_argument('--timestamps', type=str, default='timestamps', help='The timestamps file that KLEE\'s progress is read from and the snapshots are logged to (--watch only)')
+
+    parser.add_argument('--saturate', type=int, metavar='N', help='Merge traces in shuffled order and stop once the grammar has not grown for N traces in a row (--batch only)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the trace order (--saturate only)')
+    parser.add_argument('--saturation-curve', type=str, default='saturation.csv', help='CSV file for the grammar size after each merged trace (--saturate only)')
 
-    parser.add_argument('path', action='store', type=str, help='The path to trace / trace directory')
+    parser.add_argument('--quiet', action='store_true', help='No log output (see common.setup_logging for log levels)')
+
+    parser.add_argument('path', action='store', type=str, nargs='?', help='The path to trace / trace directory or trace archive (see trace_archive.py)')
 
     args = parser.parse_args()
+    if args.quiet: setup_logging(quiet=True)
 
     assert not args.isTokenCursor or args.token_grammar
+    assert args.merge or args.path, "path is required for --single and --batch"
 
     if args.token_grammar:
         with open(args.token_grammar, "r") as f:
@@ -466,33 +1290,38 @@ def main():
                 all_scc = None
 
     if args.ctx_none:
-        ctx = CTX_NONE
+        ctx_modes = [(CTX_NONE, WINDOW_SIZE)]
     elif args.ctx_coarse:
-        ctx = CTX_COARSE
+        ctx_modes = [(CTX_COARSE, WINDOW_SIZE)]
     elif args.ctx_fine:
-        ctx = CTX_FINE
+        ctx_modes = [(CTX_FINE, WINDOW_SIZE)]
+    elif args.ctx_window:
+        ctx_modes = [(CTX_WINDOW, k) for k in args.window_sizes]
     else:
-        assert args.ctx_window
-        ctx = CTX_WINDOW
+        assert args.ctx_all
+        ctx_modes = [(CTX_NONE, WINDOW_SIZE), (CTX_COARSE, WINDOW_SIZE), (CTX_FINE, WINDOW_SIZE)] + [(CTX_WINDOW, k) for k in args.window_sizes]
 
-    print(f"using ctx={ctx}")
+    for ctx, window_size in ctx_modes:
+        log.info("using ctx=%d (%s)", ctx, ctx_mode_name(ctx, window_size))
 
     if args.single:
+        assert len(ctx_modes) == 1, "--single mines one ctx at a time"
+        ctx, window_size = ctx_modes[0]
         fname = args.path
         with open(fname, "r") as f:
             j = json.load(f)
 
         exec_trace = ExecutionTrace(j, all_scc, fname)
 
-        g = {}
+        g = GrammarBuilder()
         d_terminals = {}
         ctr_terminals = 0
         d_simplify_ctx = {}
         d_ctr_simplify_ctx = {}
         d_simple_loops = {}
-        exec_tree = ExecutionTree(g, args.isTokenCursor, token_grammar, ctx, d_terminals, ctr_terminals, d_simplify_ctx, d_ctr_simplify_ctx, d_simple_loops)
+        exec_tree = ExecutionTree(g, args.isTokenCursor, token_grammar, ctx, d_terminals, ctr_terminals, d_simplify_ctx, d_ctr_simplify_ctx, d_simple_loops, window_size=window_size, keep_tree=True)
         exec_tree.add_trace(exec_trace)
-        g = exec_tree.to_grammar()
+        g = exec_tree.to_grammar().to_dict()
         print("g: ", json.dumps(g, indent=1))
         serialize_grammar(g, "single_grammar.json")
         tree = exec_tree.get()
@@ -503,12 +1332,25 @@ def main():
 
     else:
         directory = args.path
-        exec_forest = ExecutionForest(directory, args.isTokenCursor, token_grammar, ctx, all_scc, simplify=args.simplify)
-        g = exec_forest.get_grammar()
-        serialize_grammar(g, "initial_grammar.json")
-        print("Total traces: ", count_traces)
-        print("Fixed traces: ", count_fixed_traces)
-        print("Fixed positions: ", count_fixed_positions)
+        watch = None
+        if args.watch:
+            watch = {"snapshot_interval": args.snapshot_interval, "timestamps": args.timestamps, "snapshot_dir": args.snapshot_dir}
+        saturation = None
+        if args.saturate is not None:
+            assert not args.watch, "--saturate does not support --watch"
+            saturation = {"patience": args.saturate, "seed": args.seed, "curve": args.saturation_curve}
+        token_cache = TokenCache(args.token_cache, args.token_cache_size << 20) if args.token_cache else None
+        exec_forest = ExecutionForest(directory, args.isTokenCursor, token_grammar, ctx_modes, all_scc, simplify=args.simplify, jobs=args.jobs, stream=args.stream, checkpoint=args.checkpoint, watch=watch, partial_forests=args.merge, saturation=saturation, token_cache=token_cache)
+        for fg in exec_forest.grammars:
+            serialize_grammar(fg.get_grammar(), fg.output_file("initial_grammar"))
+        log.info("Total traces: %d", count_traces)
+        log.info("Fixed traces: %d", count_fixed_traces)
+        for fg in exec_forest.grammars:
+            if len(exec_forest.grammars) > 1:
+                log.info("Duplicate traces (%s): %d", ctx_mode_name(fg.ctx_mode, fg.window_size), fg.count_duplicate_traces)
+            else:
+                log.info("Duplicate traces: %d", fg.count_duplicate_traces)
+        log.info("Fixed positions: %d", count_fixed_positions)
 
 
 if __name__ == "__main__":